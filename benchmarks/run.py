@@ -0,0 +1,231 @@
+"""Benchmarks of Config.build against local stand-in sources.
+
+    python -m benchmarks.run --http 50 --bzr 10 --local 50 --jobs 1,4
+
+A config with the requested number of directives of each handler type is
+generated: HTTP files are served by a local threaded server, bzr sources
+are local branches and local sources are directories of files. For each
+--jobs value the config is built twice, cold (into an empty tree) and warm
+(over the tree the cold build produced). Every build runs in a forked
+process, so that its peak RSS, and that of the largest subprocess it ran
+(bzr, rsync...), are its own."""
+from __future__ import print_function
+from argparse import ArgumentParser
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import resource
+import tempfile
+import threading
+import traceback
+import subprocess
+
+from codetree import config as codetree_config
+from codetree.config import Config
+from codetree.fileutils import parse_size
+from tests.httpserver import StandInServer
+
+
+class Fixtures(object):
+    "Sources for the directives of a generated config"
+
+    def __init__(self, path, http=0, bzr=0, local=0, files=10, size=4096):
+        self.path = path
+        self.http = http
+        self.bzr = bzr
+        self.local = local
+        self.files = files
+        self.size = size
+        self.http_files = {}
+
+    def create(self):
+        for i in range(self.local):
+            source = os.path.join(self.path, "local", str(i))
+            os.makedirs(source)
+            for n in range(self.files):
+                with open(os.path.join(source, "file{}".format(n)), "wb") as f:
+                    f.write(os.urandom(self.size))
+        for i in range(self.http):
+            self.http_files["/file{}".format(i)] = os.urandom(self.size * self.files)
+        if self.bzr:
+            seed = os.path.join(self.path, "bzr", "seed")
+            os.makedirs(seed)
+            for n in range(self.files):
+                with open(os.path.join(seed, "file{}".format(n)), "wb") as f:
+                    f.write(os.urandom(self.size))
+            subprocess.check_output(
+                "bzr init -q && bzr add -q && bzr commit -q -m seed",
+                shell=True, cwd=seed, stderr=subprocess.STDOUT)
+            for i in range(self.bzr):
+                subprocess.check_output(
+                    ("bzr", "branch", "-q", seed, os.path.join(self.path, "bzr", str(i))),
+                    stderr=subprocess.STDOUT)
+
+    def lines(self, server):
+        for kind in ("http", "bzr", "local"):
+            yield "{}  @".format(kind)
+        for i in range(self.http):
+            yield "http/file{0}  {1}".format(i, server.url("/file{}".format(i)))
+        for i in range(self.bzr):
+            yield "bzr/{0}  bzr+file://{1}".format(i, os.path.join(self.path, "bzr", str(i)))
+        for i in range(self.local):
+            yield "local/{0}  {1}".format(i, os.path.join(self.path, "local", str(i)))
+
+
+class Instruments(object):
+    "Counts subprocesses and times directives by handler type during a build"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subprocesses = {}
+        self.handler_times = {}
+
+    def install(self):
+        instruments = self
+        popen_init = subprocess.Popen.__init__
+        directive_run = codetree_config.Directive.run
+
+        def counting_init(popen, args, *rest, **kwargs):
+            command = args if isinstance(args, basestring) else args[0]
+            with instruments.lock:
+                instruments.subprocesses[command] = instruments.subprocesses.get(command, 0) + 1
+            popen_init(popen, args, *rest, **kwargs)
+
+        def timed_run(directive):
+            start = time.time()
+            try:
+                return directive_run(directive)
+            finally:
+                handler = type(directive.source).__name__
+                with instruments.lock:
+                    instruments.handler_times[handler] = (
+                        instruments.handler_times.get(handler, 0) + time.time() - start)
+
+        subprocess.Popen.__init__ = counting_init
+        codetree_config.Directive.run = timed_run
+
+
+def tree_size(path):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            filename = os.path.join(dirpath, filename)
+            if not os.path.islink(filename):
+                total += os.path.getsize(filename)
+    return total
+
+
+def build(cfgfile, tree, cache_dir, jobs):
+    """Build cfgfile into tree in a child process. Returns the child's
+    measurements."""
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        status = 1
+        try:
+            instruments = Instruments()
+            instruments.install()
+            os.chdir(tree)
+            start = time.time()
+            ok = Config([cfgfile], cache_dir=cache_dir).build(jobs=jobs)
+            wall = time.time() - start
+            result = {
+                "ok": ok,
+                "wall": wall,
+                "handlers": instruments.handler_times,
+                "subprocesses": instruments.subprocesses,
+                "tree_bytes": tree_size(tree),
+                "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                "peak_child_rss": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+            }
+            with os.fdopen(write_end, "w") as f:
+                json.dump(result, f)
+            status = 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+    os.close(write_end)
+    with os.fdopen(read_end) as f:
+        output = f.read()
+    os.waitpid(pid, 0)
+    if not output:
+        raise RuntimeError("Benchmark build failed")
+    return json.loads(output)
+
+
+def report(results, stream=sys.stdout):
+    "Print results as a table; child rss is that of the largest subprocess"
+    print("{:>4} {:>5} {:>8} {:>6} {:>12} {:>12} {:>8} {:>8}  {}".format(
+        "jobs", "build", "wall", "procs", "http bytes", "tree bytes", "rss MB",
+        "child MB", "per-handler seconds"), file=stream)
+    for r in results:
+        handlers = ", ".join("{} {:.2f}".format(name[:-len("Handler")] or name, seconds)
+                             for name, seconds in sorted(r["handlers"].items()))
+        print("{:>4} {:>5} {:>8.2f} {:>6} {:>12} {:>12} {:>8.1f} {:>8.1f}  {}".format(
+            r["jobs"], r["build"], r["wall"], sum(r["subprocesses"].values()),
+            r["http_bytes"], r["tree_bytes"], r["peak_rss"] / 1024.0 ** 2,
+            r["peak_child_rss"] / 1024.0 ** 2, handlers), file=stream)
+
+
+def main():
+    ap = ArgumentParser(description="Benchmark codetree builds")
+    ap.add_argument("--http", type=int, default=20, metavar="N",
+                    help="Number of HTTP directives (default: 20)")
+    ap.add_argument("--bzr", type=int, default=5, metavar="N",
+                    help="Number of bzr directives (default: 5)")
+    ap.add_argument("--local", type=int, default=20, metavar="N",
+                    help="Number of local directives (default: 20)")
+    ap.add_argument("--files", type=int, default=10, metavar="N",
+                    help="Files per bzr and local source (default: 10)")
+    ap.add_argument("--size", default="4k", metavar="SIZE",
+                    help="Size of each file; HTTP files hold --files of them "
+                    "(default: 4k)")
+    ap.add_argument("--jobs", default="1,4", metavar="N[,N...]",
+                    help="Parallelism to compare (default: 1,4)")
+    ap.add_argument("--json", metavar="FILE",
+                    help="Also write the measurements to FILE as JSON")
+    ap.add_argument("--keep", action="store_true", default=False,
+                    help="Keep the generated sources and trees")
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.CRITICAL)
+
+    workdir = tempfile.mkdtemp(prefix="codetree-bench-")
+    try:
+        fixtures = Fixtures(os.path.join(workdir, "sources"), http=args.http,
+                            bzr=args.bzr, local=args.local, files=args.files,
+                            size=parse_size(args.size))
+        fixtures.create()
+        results = []
+        with StandInServer(fixtures.http_files) as server:
+            cfgfile = os.path.join(workdir, "codetree.cfg")
+            with open(cfgfile, "w") as f:
+                f.write("\n".join(fixtures.lines(server)) + "\n")
+            for jobs in [int(j) for j in args.jobs.split(",")]:
+                tree = os.path.join(workdir, "tree-j{}".format(jobs))
+                cache_dir = os.path.join(workdir, "cache-j{}".format(jobs))
+                os.mkdir(tree)
+                for name in ("cold", "warm"):
+                    sent = server.sent
+                    result = build(cfgfile, tree, cache_dir, jobs)
+                    result.update(jobs=jobs, build=name, http_bytes=server.sent - sent)
+                    results.append(result)
+        report(results)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=1, sort_keys=True)
+        if not all(r["ok"] for r in results):
+            sys.exit(1)
+    finally:
+        if args.keep:
+            print("Sources and trees kept in {}".format(workdir))
+        else:
+            shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
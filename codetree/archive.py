@@ -0,0 +1,277 @@
+"""Streaming extraction of tar and zip archives.
+
+Tarballs (plain, gzip or bzip2, and xz when an lzma module is installed) are
+decoded as they are read, so they are never written to disk whole and memory
+use is bounded by the buffer size. The zip format keeps its index at the end
+of the file, so zips are spooled to a temporary file first."""
+import os
+import stat
+import shutil
+import tarfile
+import zipfile
+import tempfile
+
+import fileutils
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+class ArchiveError(Exception):
+    pass
+
+
+class PeekableStream(object):
+    "A file object whose first bytes can be inspected without consuming them"
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = ""
+
+    def peek(self, size):
+        while len(self.buffer) < size:
+            chunk = self.stream.read(size - len(self.buffer))
+            if not chunk:
+                break
+            self.buffer += chunk
+        return self.buffer[:size]
+
+    def read(self, size=-1):
+        if self.buffer:
+            if size is None or size < 0:
+                data, self.buffer = self.buffer + self.stream.read(), ""
+                return data
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+            if len(data) < size:
+                data += self.stream.read(size - len(data))
+            return data
+        return self.stream.read(size)
+
+
+class XzStream(object):
+    "Decompress an xz stream as it is read"
+
+    def __init__(self, stream, bufsize):
+        self.stream = stream
+        self.bufsize = bufsize
+        self.decompressor = lzma.LZMADecompressor()
+        self.buffer = ""
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = self.stream.read(self.bufsize)
+            if not chunk:
+                break
+            self.buffer += self.decompressor.decompress(chunk)
+        if size < 0:
+            data, self.buffer = self.buffer, ""
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def detect_format(stream):
+    "Identify the archive in a PeekableStream by its magic number"
+    magic = stream.peek(6)
+    if magic.startswith("PK\x03\x04"):
+        return "zip"
+    if magic.startswith("\xfd7zXZ\x00"):
+        return "tar.xz"
+    if magic.startswith("\x1f\x8b"):
+        return "tar.gz"
+    if magic.startswith("BZh"):
+        return "tar.bz2"
+    return "tar"
+
+
+def member_path(name, strip_components=0):
+    """The relative path that an archive member is extracted to, or None if
+    it is stripped away. Members that would escape dest are rejected."""
+    parts = [p for p in name.replace("\\", "/").split("/") if p not in ("", ".")]
+    if name.startswith("/") or ".." in parts:
+        raise ArchiveError("Unsafe path in archive: {}".format(name))
+    parts = parts[strip_components:]
+    if not parts:
+        return None
+    return os.path.join(*parts)
+
+
+class Extractor(object):
+    """Writes archive members below dest. With paths, a PathFilter, only the
+    members it selects are written to dest. The files of a tarball that are
+    left out are kept beside dest until it has been read, since a member
+    selected later may be a hard link to one of them."""
+
+    def __init__(self, dest, strip_components=0, bufsize=64 * 1024, paths=None):
+        self.dest = dest
+        self.strip_components = strip_components
+        self.bufsize = bufsize
+        self.paths = paths
+        self.bytes = 0
+        # Tar member name -> where the data of a left out file is kept
+        self.kept = {}
+
+    def target(self, name, directory=False):
+        relpath = member_path(name, self.strip_components)
+        if relpath is not None and self.paths is not None:
+            relpath = self.paths.member(relpath, directory)
+        if relpath is None:
+            return None
+        path = os.path.join(self.dest, relpath)
+        # A symlink extracted earlier must not lead outside of dest
+        parent = os.path.realpath(os.path.dirname(path))
+        root = os.path.realpath(self.dest)
+        if parent != root and not parent.startswith(root + os.sep):
+            raise ArchiveError("Unsafe path in archive: {}".format(name))
+        return path
+
+    def inside(self, path):
+        return path.startswith(os.path.join(self.dest, ""))
+
+    def directory(self, path, mode=None):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        if mode is not None:
+            os.chmod(path, stat.S_IMODE(mode) | stat.S_IRWXU)
+
+    def file(self, path, data, mode=None, mtime=None):
+        self.directory(os.path.dirname(path))
+        if os.path.lexists(path):
+            fileutils.remove(path)
+        with open(path, "wb") as f:
+            self.bytes += fileutils.copy_stream(data, f, self.bufsize)
+        if mode is not None:
+            os.chmod(path, stat.S_IMODE(mode) & ~fileutils.UMASK)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def symlink(self, path, target):
+        self.directory(os.path.dirname(path))
+        if os.path.lexists(path):
+            fileutils.remove(path)
+        os.symlink(target, path)
+
+    def keep(self, name, data, mode=None, mtime=None):
+        "Keep the data of a file that is not extracted beside dest"
+        tmp = fileutils.temp_beside(self.dest)
+        self.kept[name] = tmp
+        with open(tmp, "wb") as f:
+            fileutils.copy_stream(data, f, self.bufsize)
+        if mode is not None:
+            os.chmod(tmp, stat.S_IMODE(mode) & ~fileutils.UMASK)
+        if mtime is not None:
+            os.utime(tmp, (mtime, mtime))
+
+    def hardlink(self, path, name):
+        source = self.target(name)
+        if source is None:
+            source = self.kept.get(name)
+        if source is not None and not self.inside(source) and os.path.isfile(source):
+            # The target was left out, so the first link gets its data
+            self.directory(os.path.dirname(path))
+            if os.path.lexists(path):
+                fileutils.remove(path)
+            os.rename(source, path)
+            self.bytes += os.path.getsize(path)
+            self.kept[name] = path
+            return
+        if source is None or not os.path.isfile(source):
+            raise ArchiveError("Hard link to missing member: {}".format(name))
+        self.directory(os.path.dirname(path))
+        if os.path.lexists(path):
+            fileutils.remove(path)
+        os.link(source, path)
+
+    def extract_tar(self, stream, compression=""):
+        tar = tarfile.open(fileobj=stream, mode="r|" + compression)
+        try:
+            for member in tar:
+                path = self.target(member.name, member.isdir())
+                if path is None:
+                    if member.isfile():
+                        self.keep(member.name, tar.extractfile(member),
+                                  member.mode, member.mtime)
+                    continue
+                if member.isdir():
+                    self.directory(path, member.mode)
+                elif member.isfile():
+                    self.file(path, tar.extractfile(member), member.mode, member.mtime)
+                elif member.issym():
+                    self.symlink(path, member.linkname)
+                elif member.islnk():
+                    self.hardlink(path, member.linkname)
+                # Devices and fifos are not extracted
+        finally:
+            for kept in self.kept.values():
+                if not self.inside(kept) and os.path.exists(kept):
+                    os.unlink(kept)
+            self.kept = {}
+
+    def extract_zip(self, stream):
+        with tempfile.TemporaryFile() as spool:
+            fileutils.copy_stream(stream, spool, self.bufsize)
+            spool.seek(0)
+            archive = zipfile.ZipFile(spool)
+            for info in archive.infolist():
+                path = self.target(info.filename, info.filename.endswith("/"))
+                if path is None:
+                    continue
+                mode = info.external_attr >> 16
+                if info.filename.endswith("/"):
+                    self.directory(path, mode or None)
+                elif stat.S_ISLNK(mode):
+                    self.symlink(path, archive.read(info))
+                else:
+                    self.file(path, archive.open(info), mode or None)
+
+    def extract(self, stream, archive_format=None):
+        stream = PeekableStream(stream)
+        archive_format = archive_format or detect_format(stream)
+        if archive_format == "zip":
+            self.extract_zip(stream)
+        elif archive_format in ("tar.xz", "txz"):
+            if lzma is None:
+                raise ArchiveError("xz archives need the lzma module")
+            self.extract_tar(XzStream(stream, self.bufsize))
+        elif archive_format in ("tar.gz", "tgz"):
+            self.extract_tar(stream, "gz")
+        elif archive_format in ("tar.bz2", "tbz2"):
+            self.extract_tar(stream, "bz2")
+        elif archive_format == "tar":
+            self.extract_tar(stream)
+        else:
+            raise ArchiveError("Unknown archive format: {}".format(archive_format))
+
+
+def extract(stream, dest, archive_format=None, strip_components=0,
+            bufsize=64 * 1024, verify=None, paths=None):
+    """Extract the archive read from stream into the directory dest, which
+    replaces any existing dest only once extraction has succeeded, and
+    verify() (if given) has returned without raising. Only the members
+    selected by the PathFilter paths (if given) are extracted. Returns the
+    number of bytes extracted."""
+    parent = os.path.dirname(dest) or os.curdir
+    fileutils.mkdir(parent)
+    staging = tempfile.mkdtemp(dir=parent, prefix=".{}.".format(os.path.basename(dest)))
+    try:
+        extractor = Extractor(staging, strip_components, bufsize, paths)
+        try:
+            extractor.extract(stream, archive_format)
+        except (tarfile.TarError, zipfile.BadZipfile, EOFError, IOError) as e:
+            raise ArchiveError("Extracting to {} failed: {}".format(dest, e))
+        if verify is not None:
+            verify()
+        os.chmod(staging, 0o777 & ~fileutils.UMASK)
+        if os.path.lexists(dest):
+            fileutils.remove(dest)
+        os.rename(staging, dest)
+    except BaseException:
+        if os.path.exists(staging):
+            shutil.rmtree(staging)
+        raise
+    return extractor.bytes
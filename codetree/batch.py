@@ -0,0 +1,90 @@
+"""Batching of local directives copied with rsync.
+
+Local directives with method=rsync whose sources share a directory, and
+whose destinations share a directory under the same names, are copied by
+a single rsync that reads their names from a --files-from list. A config
+listing hundreds of files from a few directories then runs a handful of
+rsync processes instead of hundreds.
+
+A batch is scheduled in place of its directives, with their destinations,
+so it runs after the directives that contain any of them and before those
+nested in them, but alongside the rest of their directory. When the batched
+rsync fails, each of its directives is run on its own, so that failures are
+reported against the directive that caused them."""
+from urlparse import urlparse
+import os
+
+import fileutils
+from handlers import LocalHandler
+from pathfilter import OPTIONS as FILTER_OPTIONS
+
+
+class RsyncBatch(object):
+    "Directives whose sources are in source_dir, copied into location"
+
+    lane = None
+    url = None
+
+    def __init__(self, source_dir, location, directives):
+        self.source_dir = source_dir
+        self.location = location
+        self.directives = directives
+
+    @property
+    def dest(self):
+        return os.path.join(self.directives[0].root, self.location)
+
+    @property
+    def locations(self):
+        "The destinations of the directives, which the scheduler orders it by"
+        return [directive.location for directive in self.directives]
+
+    def run(self, directives):
+        "Copy directives, which are some of the batch, with one rsync"
+        fileutils.rsync_many(self.source_dir, self.dest,
+                             [os.path.basename(d.location) for d in directives])
+        return True
+
+
+def batch_key(directive):
+    """The (source directory, destination directory) of a directive that
+    can be batched, or None"""
+    if not isinstance(directive.source, LocalHandler):
+        return None
+    if directive.source_options.get("method") != "rsync":
+        return None
+    if any(directive.source_options.get(name) for name in FILTER_OPTIONS):
+        return None
+    source = directive.source.source
+    if source == "@" or urlparse(source).scheme or os.path.islink(source):
+        return None
+    source = os.path.normpath(source)
+    location = os.path.normpath(directive.location)
+    # rsync gives each listed path the same name in the destination
+    if os.path.basename(source) != os.path.basename(location):
+        return None
+    return os.path.dirname(source) or ".", os.path.dirname(location) or "."
+
+
+def batch_directives(directives):
+    """directives, with those that can share an rsync replaced by an
+    RsyncBatch in the place of the first of them"""
+    groups = {}
+    for directive in directives:
+        key = batch_key(directive)
+        if key is not None:
+            groups.setdefault(key, []).append(directive)
+    batched = {}
+    for (source_dir, location), group in groups.items():
+        if len(group) > 1:
+            batch = RsyncBatch(source_dir, location, group)
+            for directive in group:
+                batched[directive] = batch
+    result = []
+    seen = set()
+    for directive in directives:
+        batch = batched.get(directive, directive)
+        if batch not in seen:
+            seen.add(batch)
+            result.append(batch)
+    return result
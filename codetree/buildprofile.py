@@ -0,0 +1,182 @@
+"""Timing of builds: per directive, and per phase of each directive's work.
+
+The directive being run by a thread is tracked in thread-local state, so
+that handlers and helpers record into it without being handed a profile:
+
+    with buildprofile.phase("fetch"):
+        executor.check_output(cmd)
+
+Outside of a profiled directive both are as cheap as a plain call."""
+from contextlib import contextmanager
+import threading
+import logging
+import json
+import time
+
+PHASES = ("probe", "fetch", "update", "copy")
+
+_current = threading.local()
+
+
+class DirectiveProfile(object):
+    "What one directive spent its time on"
+
+    def __init__(self, location, url, handler):
+        self.location = location
+        self.url = url
+        self.handler = handler
+        self.status = None
+        self.wall = 0.0
+        self.phases = {}
+        self.subprocesses = 0
+        self.subprocess_time = 0.0
+        # Time subprocesses spent waiting for a slot in the executor
+        self.queue_time = 0.0
+        self.commands = []
+        self.bytes = 0
+        # Phases entered and not yet left, innermost last; time is only
+        # attributed to the innermost one
+        self.stack = []
+        self.mark = None
+
+    def enter(self, name):
+        now = time.time()
+        if self.stack:
+            self.add(self.stack[-1], now - self.mark)
+        self.stack.append(name)
+        self.mark = now
+
+    def leave(self):
+        now = time.time()
+        self.add(self.stack.pop(), now - self.mark)
+        self.mark = now
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def command(self, kind, cmd, wait, run):
+        self.subprocesses += 1
+        self.subprocess_time += run
+        self.queue_time += wait
+        self.commands.append({"kind": kind, "cmd": " ".join(cmd),
+                              "wait": round(wait, 6), "run": round(run, 6)})
+
+    def as_dict(self):
+        return {
+            "location": self.location,
+            "url": self.url,
+            "handler": self.handler,
+            "status": self.status,
+            "wall": round(self.wall, 6),
+            "phases": dict((k, round(v, 6)) for k, v in self.phases.items()),
+            "subprocesses": self.subprocesses,
+            "subprocess_time": round(self.subprocess_time, 6),
+            "queue_time": round(self.queue_time, 6),
+            "commands": self.commands,
+            "bytes": self.bytes,
+        }
+
+
+def current():
+    "The DirectiveProfile of the directive this thread is running, if any"
+    return getattr(_current, "record", None)
+
+
+@contextmanager
+def phase(name):
+    "Attribute the time spent in the block to phase name of the directive"
+    record = current()
+    if record is None:
+        yield
+        return
+    record.enter(name)
+    try:
+        yield
+    finally:
+        record.leave()
+
+
+def transferred(count):
+    "Count bytes fetched or written for the running directive"
+    record = current()
+    if record is not None:
+        record.bytes += count
+
+
+class BuildProfile(object):
+    "The DirectiveProfiles of a build"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = []
+        self.start = None
+        self.wall = 0.0
+        self.jobs = 1
+
+    @contextmanager
+    def build(self, jobs=1):
+        self.jobs = jobs
+        self.start = time.time()
+        try:
+            yield
+        finally:
+            self.wall = time.time() - self.start
+
+    @contextmanager
+    def directive(self, directive, handler=None):
+        """Profile the running of directive by this thread. handler names
+        what runs it, by default the type of its source."""
+        record = DirectiveProfile(directive.location, getattr(directive, "url", None),
+                                  handler or type(directive.source).__name__)
+        with self.lock:
+            self.records.append(record)
+        previous = current()
+        _current.record = record
+        start = time.time()
+        try:
+            yield record
+        finally:
+            record.wall = time.time() - start
+            _current.record = previous
+
+    def slowest(self, top=10):
+        return sorted(self.records, key=lambda r: r.wall, reverse=True)[:top]
+
+    def report(self, top=10):
+        phases = {}
+        for record in self.records:
+            for name, seconds in record.phases.items():
+                phases[name] = round(phases.get(name, 0.0) + seconds, 6)
+        statuses = {}
+        for record in self.records:
+            statuses[record.status] = statuses.get(record.status, 0) + 1
+        return {
+            "build": {
+                "wall": round(self.wall, 6),
+                "jobs": self.jobs,
+                "directives": len(self.records),
+                "statuses": statuses,
+                "phases": phases,
+                "subprocesses": sum(r.subprocesses for r in self.records),
+                "subprocess_time": round(sum(r.subprocess_time for r in self.records), 6),
+                "queue_time": round(sum(r.queue_time for r in self.records), 6),
+                "bytes": sum(r.bytes for r in self.records),
+            },
+            "slowest": [
+                {"location": r.location, "wall": round(r.wall, 6),
+                 "handler": r.handler, "status": r.status}
+                for r in self.slowest(top)],
+            "directives": [r.as_dict() for r in self.records],
+        }
+
+    def write(self, path, top=10):
+        with open(path, "w") as f:
+            json.dump(self.report(top), f, indent=1, sort_keys=True)
+
+    def log_summary(self, top=10):
+        logging.info("Build took {:.2f}s; slowest directives:".format(self.wall))
+        for record in self.slowest(top):
+            phases = ", ".join("{} {:.2f}s".format(name, record.phases[name])
+                               for name in PHASES if name in record.phases)
+            logging.info("  {:8.2f}s  {} ({})".format(record.wall, record.location,
+                                                      phases or record.status))
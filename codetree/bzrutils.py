@@ -0,0 +1,333 @@
+"""Inspection of bzr branches with as few bzr invocations as possible.
+
+Local branches are probed by reading their control files directly, which
+costs no subprocess at all; bzr is only run when a branch uses a format
+whose files are not understood here. Remote branches can only be probed by
+running bzr, so their results are cached for the whole build."""
+from urlparse import urlparse
+from subprocess import CalledProcessError, STDOUT
+from contextlib import contextmanager
+import os
+import re
+import json
+import time
+import fcntl
+import shutil
+import urllib
+import hashlib
+import threading
+
+import fileutils
+from executor import check_output
+
+# Kept in the root of a tree exported without history
+EXPORT_MARKER = ".codetree-export"
+
+
+def is_url(location):
+    return bool(urlparse(location).scheme) and not os.path.isabs(location)
+
+
+def location_to_path(location):
+    "Local file system path of a file:// URL (or plain path)"
+    if location.startswith("file://"):
+        return urllib.url2pathname(location[len("file://"):])
+    return location
+
+
+def normalize_location(location, base=None):
+    """Canonical form of a branch location, for comparisons. Relative
+    locations are resolved against the directory base."""
+    location = location.strip()
+    if is_url(location) and not location.startswith("file://"):
+        return urllib.unquote(location).rstrip("/")
+    path = urllib.unquote(location_to_path(location))
+    if base is not None:
+        path = os.path.join(base, path)
+    return os.path.normpath(os.path.abspath(path))
+
+
+def normalize_lp_branch(branch):
+    "The bzr+ssh URL that an lp: (or nosmart+lp:) branch stands for"
+    if branch.startswith(('lp:', 'nosmart+lp:')):
+        if '~' not in branch:
+            branch = branch.replace('lp:', 'lp:+branch/')
+        branch = branch.replace('lp:', 'bzr+ssh://bazaar.launchpad.net/')
+    return branch
+
+
+class BranchState(object):
+    "What is known about a local branch"
+
+    def __init__(self, path, is_branch=False, parent=None, revno=None,
+                 has_tree=False, checkout_of=None, revid=None):
+        self.path = path
+        self.is_branch = is_branch
+        # Normalized locations of the parent branch and, for lightweight
+        # checkouts, the branch that is checked out
+        self.parent = parent
+        self.checkout_of = checkout_of
+        self.revno = revno
+        self.revid = revid
+        self.has_tree = has_tree
+
+    def __repr__(self):
+        return "BranchState({!r}, parent={!r}, revno={!r})".format(
+            self.path, self.parent, self.revno)
+
+
+def read_config(filename):
+    "Parse a bzr configuration file of key = value lines"
+    values = {}
+    with open(filename) as f:
+        for line in f:
+            match = re.match(r"^\s*([\w.]+)\s*=\s*(.*?)\s*$", line)
+            if match:
+                values[match.group(1)] = match.group(2)
+    return values
+
+
+def bzr_revno(location, tree=False):
+    cmd = ["bzr", "revno", location]
+    if tree:
+        cmd.insert(2, "--tree")
+    return int(check_output(cmd, stderr=STDOUT).strip())
+
+
+def bzr_revision_info(location):
+    "(revno, revision id) of the tip of the branch at location"
+    revno, revid = check_output(("bzr", "revision-info", "-d", location),
+                                stderr=STDOUT).split()
+    return int(revno), revid
+
+
+def tree_revno(path):
+    "The revno of the working tree at path, or None if it has none"
+    try:
+        return bzr_revno(path, tree=True)
+    except (CalledProcessError, ValueError):
+        return None
+
+
+def read_branch_state(path):
+    "Probe the local branch at path"
+    control = os.path.join(path, ".bzr")
+    branch_dir = os.path.join(control, "branch")
+    state = BranchState(path)
+    if not os.path.isdir(branch_dir):
+        return state
+    state.is_branch = True
+    state.has_tree = os.path.isdir(os.path.join(control, "checkout"))
+
+    location_file = os.path.join(branch_dir, "location")
+    if os.path.exists(location_file):
+        # A lightweight checkout: the branch itself lives elsewhere
+        with open(location_file) as f:
+            state.checkout_of = normalize_location(f.read(), base=path)
+        state.parent = state.checkout_of
+        return state
+
+    base = os.path.abspath(path)
+    parent = None
+    conf = os.path.join(branch_dir, "branch.conf")
+    if os.path.exists(conf):
+        parent = read_config(conf).get("parent_location")
+    legacy_parent = os.path.join(branch_dir, "parent")
+    if parent is None and os.path.exists(legacy_parent):
+        with open(legacy_parent) as f:
+            parent = f.read().strip() or None
+    if parent:
+        state.parent = normalize_location(parent, base=base)
+
+    try:
+        with open(os.path.join(branch_dir, "last-revision")) as f:
+            revno, state.revid = f.read().split()
+            state.revno = int(revno)
+    except (IOError, ValueError, IndexError):
+        # Older formats keep a revision-history instead; let bzr work it out
+        try:
+            state.revno = bzr_revno(path)
+        except (CalledProcessError, ValueError):
+            pass
+    return state
+
+
+def read_export(path):
+    """What the tree at path was exported from, as recorded by write_export:
+    {"source", "revno", "revid", "selection", "files"}. None if it is not
+    an export."""
+    try:
+        with open(os.path.join(path, EXPORT_MARKER)) as f:
+            export = json.load(f)
+    except (IOError, ValueError):
+        return None
+    return export if isinstance(export, dict) and export.get("source") else None
+
+
+def write_export(path, source, revno, revid=None, selection=None):
+    """Record what the tree at path was exported from, and the files it
+    has, so that an update can tell files that were removed from the branch
+    from files that were put into the tree by other means. selection is the
+    spec() of the PathFilter of a partial export."""
+    files = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        relpath = os.path.relpath(dirpath, path)
+        for name in dirnames:
+            files.append(os.path.normpath(os.path.join(relpath, name)) + "/")
+        for name in filenames:
+            files.append(os.path.normpath(os.path.join(relpath, name)))
+    with fileutils.atomic_write(os.path.join(path, EXPORT_MARKER), "w") as f:
+        json.dump({"source": source, "revno": revno, "revid": revid,
+                   "selection": selection, "files": sorted(files)}, f)
+
+
+class BzrProbes(object):
+    """Per-build cache of remote branch probes. Each remote URL is probed at
+    most once, however many directives use it."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.url_locks = {}
+        self.remote = {}
+        self.probed = 0
+
+    def local(self, path):
+        # Local branches change during a build, so they are never cached
+        return read_branch_state(path)
+
+    def remote_revision(self, url):
+        """(revno, revision id) of the tip of the branch at url, or None if
+        there is no branch. Raises CalledProcessError when bzr fails for any
+        other reason."""
+        with self.lock:
+            url_lock = self.url_locks.setdefault(url, threading.Lock())
+        with url_lock:
+            if url not in self.remote:
+                self.probed += 1
+                try:
+                    self.remote[url] = bzr_revision_info(url)
+                except CalledProcessError as e:
+                    if e.returncode != 3:
+                        raise
+                    self.remote[url] = None
+            return self.remote[url]
+
+    def remote_revno(self, url):
+        "The revno of the branch at url, or None if there is no branch"
+        revision = self.remote_revision(url)
+        return revision[0] if revision else None
+
+
+def repo_key(url):
+    """Name of the shared repository for the branch at url: one per
+    Launchpad project, or per host and top-level directory elsewhere"""
+    parsed = urlparse(url)
+    if parsed.netloc:
+        parts = [p for p in urllib.unquote(parsed.path).split("/") if p]
+        if len(parts) > 1 and (parts[0] == "+branch" or parts[0].startswith("~")):
+            parts = parts[1:]
+        key = "/".join([parsed.netloc] + parts[:1])
+    else:
+        key = "local" + os.path.dirname(normalize_location(url))
+    return re.sub(r"[^\w.+~-]+", "_", key).strip("_")
+
+
+class SharedRepoCache(object):
+    """Persistent bzr shared repositories, one per project, each holding
+    history-only mirrors of the branches that were built from it. Branching
+    or updating from a mirror only transfers the revisions that no branch of
+    the project has fetched before.
+
+    Layout:
+        <key>/              a shared repository without working trees
+        <key>/<hash>        the mirror of one source branch
+        <key>/.codetree-used  touched whenever the repository is used
+        <key>.lock          held while a mirror is updated or pruned
+        <key>.use           held shared while the repository is used, and
+                            exclusively while it is pruned
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.thread_locks = {}
+        # Mirrors already brought up to date during this build
+        self.refreshed = set()
+
+    @staticmethod
+    def branch_url(url):
+        """url as its handler normalizes it, so that lp: shorthands share
+        the repository and mirror of the URLs they stand for"""
+        return normalize_lp_branch(url.strip().rstrip("/"))
+
+    def repository(self, url):
+        return os.path.join(self.path, repo_key(self.branch_url(url)))
+
+    def mirror(self, url):
+        return os.path.join(self.repository(url), hashlib.sha1(
+            normalize_location(self.branch_url(url))).hexdigest()[:16])
+
+    @contextmanager
+    def locked(self, url):
+        "Serialize work on the repository of url between threads and processes"
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        repo = self.repository(url)
+        with self.lock:
+            thread_lock = self.thread_locks.setdefault(repo, threading.Lock())
+        with thread_lock:
+            with open(repo + ".lock", "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                yield
+
+    @contextmanager
+    def in_use(self, url):
+        "Keep the repository of url from being pruned while the block runs"
+        fileutils.mkdir(self.path)
+        with open(self.repository(url) + ".use", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            yield
+
+    def touch(self, url):
+        stamp = os.path.join(self.repository(url), ".codetree-used")
+        with open(stamp, "a"):
+            os.utime(stamp, None)
+
+    def report(self):
+        "(name, size in bytes, last used time) of each cached repository"
+        repos = []
+        if not os.path.isdir(self.path):
+            return repos
+        for name in sorted(os.listdir(self.path)):
+            repo = os.path.join(self.path, name)
+            if not os.path.isdir(repo):
+                continue
+            size = 0
+            for dirpath, dirnames, filenames in os.walk(repo):
+                for filename in filenames:
+                    size += os.path.getsize(os.path.join(dirpath, filename))
+            try:
+                used = os.path.getmtime(os.path.join(repo, ".codetree-used"))
+            except OSError:
+                used = os.path.getmtime(repo)
+            repos.append((name, size, used))
+        return repos
+
+    def prune(self, max_age):
+        """Remove repositories that have not been used for max_age seconds.
+        Repositories in use by a running build are skipped."""
+        removed = []
+        cutoff = time.time() - max_age
+        for name, size, used in self.report():
+            if used >= cutoff:
+                continue
+            repo = os.path.join(self.path, name)
+            with open(repo + ".use", "a") as use, open(repo + ".lock", "a") as lock:
+                try:
+                    fcntl.flock(use, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    continue
+                shutil.rmtree(repo)
+            removed.append((name, size))
+        return removed
@@ -0,0 +1,175 @@
+import os
+import re
+import json
+import time
+import fcntl
+import hashlib
+import logging
+import threading
+
+import fileutils
+
+# Options that pin the content of a source, and the length of their digests
+ALGORITHMS = {
+    "sha256": 64,
+    "sha512": 128,
+}
+
+
+class ChecksumError(Exception):
+    pass
+
+
+def pins(options):
+    "The checksums that options pin the source to: {algorithm: hex digest}"
+    pinned = {}
+    for algorithm, length in ALGORITHMS.items():
+        value = options.get(algorithm)
+        if value is None:
+            continue
+        value = value.strip().lower()
+        if not re.match(r"^[0-9a-f]{%d}$" % length, value):
+            raise ChecksumError("Invalid {} checksum: {}".format(algorithm, value))
+        pinned[algorithm] = value
+    return pinned
+
+
+class Hashers(object):
+    "Computes the pinned checksums of data as it is written"
+
+    def __init__(self, pinned):
+        self.pinned = pinned
+        self.hashes = dict((algorithm, hashlib.new(algorithm)) for algorithm in pinned)
+
+    def update(self, data):
+        for sha in self.hashes.values():
+            sha.update(data)
+
+    def digests(self):
+        return dict((algorithm, sha.hexdigest()) for algorithm, sha in self.hashes.items())
+
+    def check(self, name):
+        "Raise ChecksumError unless every pin matched"
+        for algorithm, digest in sorted(self.digests().items()):
+            if digest != self.pinned[algorithm]:
+                raise ChecksumError("{} has {} {}, expected {}".format(
+                    name, algorithm, digest, self.pinned[algorithm]))
+
+
+class HashingReader(object):
+    "A file object that feeds what is read from stream to hashers"
+
+    def __init__(self, stream, hashers):
+        self.stream = stream
+        self.hashers = hashers
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.hashers.update(data)
+        return data
+
+    def drain(self, bufsize=64 * 1024):
+        "Read (and hash) whatever the consumer left unread"
+        while self.read(bufsize):
+            pass
+
+
+def file_digest(path, algorithm, bufsize=64 * 1024):
+    sha = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(bufsize)
+            if not chunk:
+                return sha.hexdigest()
+            sha.update(chunk)
+
+
+class HashCache(object):
+    """Persistent record of the checksums of files, keyed by their device,
+    inode, size and modification time, so that a file that hasn't changed
+    since it was last hashed is never read again.
+
+    Like the HTTP metadata cache, it is shared by the codetree processes
+    that use the same cache directory, and merged into the file on save.
+    Entries that have not been used for max_age seconds are dropped."""
+
+    def __init__(self, path, max_age=30 * 24 * 60 * 60):
+        self.path = path
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.dirty = set()
+        self.entries = self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except IOError:
+            return {}
+        except ValueError:
+            logging.warning("Ignoring corrupt checksum cache {}".format(self.path))
+            return {}
+
+    @staticmethod
+    def key(stat):
+        return "{}:{}:{}:{!r}".format(stat.st_dev, stat.st_ino, stat.st_size,
+                                      stat.st_mtime)
+
+    def cached(self, path, algorithm):
+        "The cached checksum of the file at path, or None if there is none"
+        key = self.key(os.stat(path))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and algorithm in entry:
+                entry["used"] = time.time()
+                self.dirty.add(key)
+                return entry[algorithm]
+        return None
+
+    def digest(self, path, algorithm):
+        "The checksum of the file at path, computed only if it isn't cached"
+        digest = self.cached(path, algorithm)
+        if digest is None:
+            digest = file_digest(path, algorithm)
+            self.record(path, algorithm, digest)
+        return digest
+
+    def record(self, path, algorithm, digest):
+        "Remember that the file at path has checksum digest"
+        key = self.key(os.stat(path))
+        with self.lock:
+            entry = self.entries.setdefault(key, {})
+            entry[algorithm] = digest
+            entry["used"] = time.time()
+            self.dirty.add(key)
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            fileutils.mkdir(os.path.dirname(self.path))
+            with open(self.path + ".lock", "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                entries = self.load()
+                for key in self.dirty:
+                    entries.setdefault(key, {}).update(self.entries[key])
+                cutoff = time.time() - self.max_age
+                for key in [k for k, entry in entries.items()
+                            if entry.get("used", 0) < cutoff]:
+                    del entries[key]
+                with fileutils.atomic_write(self.path, "w") as f:
+                    json.dump(entries, f)
+            self.entries = entries
+            self.dirty = set()
+
+
+def matches(path, pinned, cache=None):
+    "True if the file at path has every pinned checksum"
+    for algorithm, expected in sorted(pinned.items()):
+        if cache is not None:
+            digest = cache.digest(path, algorithm)
+        else:
+            digest = file_digest(path, algorithm)
+        if digest != expected:
+            return False
+    return True
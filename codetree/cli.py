@@ -1,19 +1,125 @@
+from __future__ import print_function
 from argparse import ArgumentParser
 import logging
-from .config import Config
+import time
+import os
+from .bzrutils import SharedRepoCache
+from .config import Config, default_cache_dir
+from .executor import parse_limits
+from .fanout import FanOut, METHODS, parse_root
+from .generations import Generations
+from .fileutils import parse_size
+from .watch import Watcher
 import sys
 
 
+def bzr_cache_maintenance(args):
+    "Report on or prune the shared bzr repository cache"
+    repos = SharedRepoCache(os.path.join(args.cache_dir or default_cache_dir(), "bzr"))
+    if args.bzr_cache_prune is not None:
+        for name, size in repos.prune(args.bzr_cache_prune * 24 * 60 * 60):
+            print("Removed {} ({} bytes)".format(name, size))
+    if args.bzr_cache_report:
+        total = 0
+        for name, size, used in repos.report():
+            print("{:>14}  {}  {}".format(size, time.strftime(
+                "%Y-%m-%d %H:%M", time.localtime(used)), name))
+            total += size
+        print("{:>14}  total".format(total))
+
+
+def write_profile(args, config):
+    "Write the --profile of the build of config, if it got that far"
+    if args.profile and config is not None:
+        config.context.profile.write(args.profile, top=args.profile_top)
+        config.context.profile.log_summary(top=args.profile_top)
+
+
 def main():
     ap = ArgumentParser()
-    ap.add_argument("cfgfile", nargs="+", help="Codetree configuration file")
+    ap.add_argument("cfgfile", nargs="*", help="Codetree configuration file")
     verbosity = ap.add_mutually_exclusive_group(required=False)
     verbosity.add_argument("-v", "--verbose", action="store_true", default=False)
     verbosity.add_argument("-q", "--quiet", action="store_true", default=False)
     verbosity.add_argument("-f", "--fatality", action="store_true", default=False,
                            help="Any error is fatal")
+    ap.add_argument("-j", "--jobs", type=int, default=1, metavar="N",
+                    help="Run up to N independent directives at once")
+    ap.add_argument("--force", action="store_true", default=False,
+                    help="Run every directive, even those that are unchanged "
+                    "since the last build")
+    ap.add_argument("--cache-dir", default=None, metavar="DIR",
+                    help="Location of persistent caches (default: ~/.cache/codetree)")
+    ap.add_argument("--store", action="store_true", default=False,
+                    help="Share HTTP downloads between trees through a "
+                    "content-addressed store in the cache directory")
+    ap.add_argument("--store-size", default="10G", metavar="SIZE",
+                    help="Evict least recently used files beyond SIZE (default: 10G)")
+    ap.add_argument("--store-max-age", type=int, default=0, metavar="SECONDS",
+                    help="Use stored downloads without revalidating them "
+                    "for up to SECONDS")
+    ap.add_argument("--http-jobs", type=int, default=0, metavar="N",
+                    help="Run up to N HTTP downloads at once, alongside the "
+                    "other directives; by default they count against --jobs")
+    ap.add_argument("--http-connections", type=int, default=4, metavar="N",
+                    help="Keep up to N connections open to each HTTP host (default: 4)")
+    ap.add_argument("--bzr-shared-repos", action="store_true", default=False,
+                    help="Fetch bzr branches through per-project shared "
+                    "repositories in the cache directory")
+    ap.add_argument("--git-cache", action="store_true", default=False,
+                    help="Fetch git repositories through mirrors in the cache "
+                    "directory instead of shallow clones")
+    ap.add_argument("--subprocess-limit", action="append", default=[],
+                    metavar="KIND=N", help="Run at most N commands of KIND "
+                    "(bzr, git, rsync...) at once; may be repeated, or "
+                    "given as a list such as bzr=4,rsync=8")
+    ap.add_argument("--subprocess-timeout", type=int, default=None, metavar="SECONDS",
+                    help="Kill commands that run longer than SECONDS")
+    ap.add_argument("--profile", default=None, metavar="FILE",
+                    help="Write the time spent by each directive, per phase, "
+                    "to FILE as JSON")
+    ap.add_argument("--profile-top", type=int, default=10, metavar="N",
+                    help="Summarize the N slowest directives (default: 10)")
+    ap.add_argument("--root", action="append", default=[], metavar="DIR",
+                    help="Build into DIR instead of the current directory; "
+                    "with several, sources are fetched once into a staging "
+                    "tree and copied into each. Options for the directives "
+                    "of one root may follow a semicolon: DIR;overwrite=true")
+    ap.add_argument("--staging", default=None, metavar="DIR",
+                    help="Staging tree for --root (default: in the cache directory)")
+    ap.add_argument("--fan-out-method", choices=sorted(METHODS), default="reflink",
+                    help="How files are copied from the staging tree into "
+                    "each root: reflinks (falling back to copies), hard links "
+                    "(shared by every root, so never to be edited in place; "
+                    "falling back to reflinks, then copies) or copies "
+                    "(default: reflink)")
+    ap.add_argument("--generations", default=None, metavar="DIR",
+                    help="Build each time into a new generation in DIR, and "
+                    "switch DIR/current to it once the build has succeeded")
+    ap.add_argument("--keep-generations", type=int, default=3, metavar="N",
+                    help="Keep the N most recent generations, including the "
+                    "current one (default: 3)")
+    ap.add_argument("--watch", action="store_true", default=False,
+                    help="Keep running, and rebuild whatever changes: "
+                    "config files and local sources as they change, other "
+                    "sources every --poll-interval")
+    ap.add_argument("--poll-interval", type=int, default=300, metavar="SECONDS",
+                    help="How often --watch checks remote sources (default: 300)")
+    ap.add_argument("--bzr-cache-report", action="store_true", default=False,
+                    help="Report the size of the shared bzr repositories and exit")
+    ap.add_argument("--bzr-cache-prune", type=int, default=None, metavar="DAYS",
+                    help="Remove shared bzr repositories unused for DAYS days and exit")
 
     args = ap.parse_args()
+    if args.bzr_cache_report or args.bzr_cache_prune is not None:
+        bzr_cache_maintenance(args)
+        sys.exit(0)
+    if not args.cfgfile:
+        ap.error("at least one cfgfile is required")
+    try:
+        subprocess_limits = parse_limits(args.subprocess_limit)
+    except ValueError as e:
+        ap.error(str(e))
 
     logfmt = "%(message)s"
     loglevel = logging.INFO
@@ -24,8 +130,49 @@ def main():
         loglevel = logging.CRITICAL
     logging.basicConfig(format=logfmt, level=loglevel)
 
-    config = Config(args.cfgfile)
-    if config.build(args.fatality):
+    config_options = dict(cache_dir=args.cache_dir, store=args.store,
+                          store_size=parse_size(args.store_size),
+                          store_max_age=args.store_max_age,
+                          http_connections=args.http_connections,
+                          bzr_shared_repos=args.bzr_shared_repos,
+                          git_cache=args.git_cache,
+                          subprocess_limits=subprocess_limits,
+                          subprocess_timeout=args.subprocess_timeout)
+    build_options = dict(fatality=args.fatality, jobs=args.jobs, force=args.force,
+                         http_jobs=args.http_jobs)
+    if len([mode for mode in (args.root, args.watch, args.generations) if mode]) > 1:
+        ap.error("--root, --watch and --generations can't be combined")
+    if args.root:
+        fanout = FanOut(args.cfgfile, [parse_root(root) for root in args.root],
+                        staging=args.staging, method=args.fan_out_method,
+                        config_options=config_options, build_options=build_options)
+        try:
+            ok = fanout.build()
+        finally:
+            write_profile(args, fanout.config)
+        sys.exit(0 if ok else 1)
+    if args.generations:
+        generations = Generations(args.generations, keep=args.keep_generations)
+        try:
+            ok = generations.build(args.cfgfile, config_options, build_options)
+        finally:
+            write_profile(args, generations.config)
+        sys.exit(0 if ok else 1)
+    if args.watch:
+        watcher = Watcher(args.cfgfile, config_options, build_options,
+                          poll_interval=args.poll_interval)
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    config = Config(args.cfgfile, **config_options)
+    try:
+        ok = config.build(**build_options)
+    finally:
+        write_profile(args, config)
+    if ok:
         sys.exit(0)
     else:
         sys.exit(1)
@@ -1,7 +1,20 @@
 from urlparse import urlparse
 import fileinput
 import heapq
+import logging
+from batch import RsyncBatch, batch_directives
+from bzrutils import BzrProbes, SharedRepoCache
+from buildprofile import BuildProfile, phase
+from checksum import HashCache
+from fileutils import FileManipulationError
+from executor import Executor
+from gitutils import GitCache
 from handlers import handler_for_url
+from httpcache import HttpMetadataCache
+from httppool import ConnectionPool
+from scheduler import Scheduler, is_path_prefix
+from state import BuildState
+from store import ContentStore, Deduplicator
 import os
 
 
@@ -22,8 +35,8 @@ class Directive(object):
             msg = "Destinations must be relative paths: "
             msg += "{} (line {})".format(D.location, inpfile, lineno)
             raise InvalidDirective(msg)
-        url, D.source_options = cls.parse_source(source)
-        D.source = handler_for_url(url)
+        D.url, D.source_options = cls.parse_source(source)
+        D.source = handler_for_url(D.url)
         return D
 
     @staticmethod
@@ -37,12 +50,100 @@ class Directive(object):
             url = source
         return url, options
 
+    # The directory that location is relative to, when it isn't the
+    # current directory
+    root = ""
+
+    @property
+    def dest(self):
+        "The path that location refers to"
+        return os.path.join(self.root, self.location)
+
+    @property
+    def lane(self):
+        return self.source.lane
+
+    # The locations of the directives nested in this one, relative to it
+    nested = ()
+
     def run(self):
-        return self.source.get(self.location, self.source_options)
+        return self.source.get(self.dest, self.source_options)
+
+
+def default_cache_dir():
+    "Per-user location of codetree's persistent caches"
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "codetree")
+
+
+class BuildContext(object):
+    "Resources shared by the directives of a Config"
+
+    def __init__(self, cache_dir=None, store=False, store_size=None, store_max_age=0,
+                 http_connections=4, bzr_shared_repos=False, git_cache=False,
+                 subprocess_limits=None, subprocess_timeout=None):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.profile = BuildProfile()
+        self.executor = Executor(subprocess_limits, subprocess_timeout)
+        self.http_pool = ConnectionPool(max_per_host=http_connections)
+        self.bzr_probes = BzrProbes()
+        self.bzr_repos = None
+        if bzr_shared_repos:
+            self.bzr_repos = SharedRepoCache(os.path.join(self.cache_dir, "bzr"))
+        self.git_cache = None
+        if git_cache:
+            self.git_cache = GitCache(os.path.join(self.cache_dir, "git"))
+        self.http_metadata = HttpMetadataCache(
+            os.path.join(self.cache_dir, "http-metadata.json"))
+        self.hash_cache = HashCache(os.path.join(self.cache_dir, "checksums.json"))
+        self.store = None
+        if store:
+            self.store = ContentStore(os.path.join(self.cache_dir, "store"),
+                                      max_size=store_size, max_age=store_max_age)
+        # Without --store, deduplicated files are kept in a store of their
+        # own that is never evicted from
+        self.dedupe = Deduplicator(self.store or os.path.join(self.cache_dir, "dedupe"),
+                                   self.hash_cache)
+
+    def start(self):
+        """Forget what was learnt about sources during the previous build,
+        when the context is kept for several (as --watch does)"""
+        self.profile = BuildProfile()
+        self.bzr_probes = BzrProbes()
+        self.dedupe.reset()
+        if self.bzr_repos is not None:
+            self.bzr_repos.refreshed.clear()
+        if self.git_cache is not None:
+            self.git_cache.refreshed.clear()
+
+    def close(self):
+        "Persist cached state at the end of a build"
+        self.http_pool.close()
+        self.executor.log_summary()
+        self.dedupe.log_summary()
+        self.http_metadata.save()
+        self.hash_cache.save()
+        if self.store is not None:
+            self.store.evict()
+
+
+# Kept in the root of the tree being built
+STATE_FILE = ".codetree-state"
+
+# Returned by Config.run_unless_unchanged for a directive that was skipped
+SKIPPED = object()
+
+# The source fingerprint of a directive that was run without probing it
+UNPROBED = object()
 
 
 class Config(object):
-    def __init__(self, config_files):
+    def __init__(self, config_files, cache_dir=None, state_file=STATE_FILE,
+                 context=None, root="", **context_options):
+        self.context = context or BuildContext(cache_dir, **context_options)
+        self.root = root
+        self.state = BuildState(os.path.join(root, state_file)) if state_file else None
+        self.force = False
         self.directives = []
         raw_lines = fileinput.input(config_files)
         for raw_line in raw_lines:
@@ -51,7 +152,18 @@ class Config(object):
             directive = Directive.from_raw_line(raw_line,
                                                 inpfile=fileinput.filename(),
                                                 lineno=fileinput.filelineno())
-            heapq.heappush(self.directives, (len(directive.location), directive))
+            directive.source.context = self.context
+            directive.root = root
+            # Parse order breaks ties between equally deep destinations,
+            # so they are built in the order they were written
+            heapq.heappush(self.directives,
+                           (len(directive.location), len(self.directives), directive))
+        for _, _, directive in self.directives:
+            directive.nested = frozenset(
+                os.path.relpath(other.location, directive.location)
+                for _, _, other in self.directives
+                if other is not directive and
+                is_path_prefix(directive.location, other.location))
 
     def ignored_line(self, raw_line):
         "Blank lines and #Comments are ignored"
@@ -62,13 +174,107 @@ class Config(object):
             return True
         return False
 
-    def build(self, fatality=False):
-        error_free = True
-        for i in range(len(self.directives)):
-            directive = heapq.heappop(self.directives)[1]
+    def build(self, fatality=False, jobs=1, force=False, http_jobs=0, only=None):
+        """Run every directive (or those in only). Directives whose source
+        and destination are unchanged since the last build are skipped,
+        unless force is set.
+
+        Up to jobs directives run at once, plus up to http_jobs HTTP
+        downloads; with http_jobs=0 (the default) downloads count against
+        jobs, so jobs=1 runs everything in order."""
+        self.force = force
+        self.context.start()
+        directives = batch_directives([entry[-1] for entry in sorted(self.directives)
+                                       if only is None or entry[-1] in only])
+        scheduler = Scheduler(directives, jobs=jobs, fatality=fatality,
+                              run=self.run_directive, lanes={"http": http_jobs},
+                              lane=lambda directive: directive.lane,
+                              interrupted=self.context.executor.terminate)
+        try:
+            with self.context.executor.active(), self.context.profile.build(jobs):
+                return scheduler.run()
+        finally:
+            self.context.close()
+            if self.state is not None:
+                self.state.save()
+
+    def run_directive(self, directive):
+        if isinstance(directive, RsyncBatch):
+            return self.run_batch(directive)
+        with self.context.profile.directive(directive) as record:
+            record.status = "error"
+            result = self.run_unless_unchanged(directive)
+            if result is SKIPPED:
+                record.status = "skipped"
+                return True
+            record.status = "ok" if result else "failed"
+            return result
+
+    def probe(self, directive):
+        """The source fingerprint of directive, and whether it is unchanged.
+        The source is only probed if that could skip the directive;
+        otherwise the fingerprint is UNPROBED, and taken once it has run."""
+        if self.state is None:
+            return None, False
+        if self.force or not self.state.may_be_unchanged(directive):
+            return UNPROBED, False
+        with phase("probe"):
+            source = directive.source.source_fingerprint(directive.source_options)
+            return source, self.state.is_unchanged(directive, source)
+
+    def finish(self, directive, source, result):
+        "Record the outcome of running directive in the build state"
+        if self.state is None:
+            return
+        with phase("probe"):
+            if result:
+                if source is UNPROBED:
+                    source = directive.source.source_fingerprint(directive.source_options)
+                self.state.record(directive, source)
+            else:
+                self.state.forget(directive)
+
+    def run_unless_unchanged(self, directive):
+        "Run directive, or return SKIPPED if it is unchanged"
+        source, unchanged = self.probe(directive)
+        if unchanged:
+            logging.info("Skipping unchanged {}".format(directive.location))
+            return SKIPPED
+        try:
             result = directive.run()
-            if not result:
-                error_free = False
-                if fatality:
-                    return False
-        return error_free
+        except Exception:
+            self.finish(directive, source, False)
+            raise
+        self.finish(directive, source, result)
+        return result
+
+    def run_batch(self, batch):
+        """Run the changed directives of batch with one rsync, or one at a
+        time if that fails, so that each failure is attributed to its own
+        directive"""
+        pending = []
+        with self.context.profile.directive(batch, handler="RsyncBatch") as record:
+            record.status = "skipped"
+            for directive in batch.directives:
+                source, unchanged = self.probe(directive)
+                if unchanged:
+                    logging.info("Skipping unchanged {}".format(directive.location))
+                else:
+                    pending.append((directive, source))
+            if pending:
+                logging.info("Rsyncing {} files from {} to {}".format(
+                    len(pending), batch.source_dir, batch.dest))
+                record.status = "ok"
+                try:
+                    batch.run([directive for directive, source in pending])
+                except FileManipulationError as e:
+                    logging.warning("Batched rsync failed, running its directives "
+                                    "one at a time: {}".format(e))
+                    record.status = "failed"
+        ok = True
+        for directive, source in pending:
+            if record.status == "failed":
+                ok = self.run_directive(directive) and ok
+                continue
+            self.finish(directive, source, True)
+        return ok
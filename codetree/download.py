@@ -0,0 +1,160 @@
+import os
+import re
+import json
+import errno
+import socket
+import httplib
+import logging
+
+import fileutils
+from checksum import Hashers
+
+
+class DownloadInterrupted(IOError):
+    """The connection failed or the server sent something unexpected, so
+    the download may succeed if it is tried again. Errors writing the part
+    file are raised as they are, as trying again won't help."""
+    pass
+
+
+def strong_validator(headers):
+    """A validator of the response with headers that If-Range accepts: a
+    strong ETag, or else the Last-Modified date"""
+    etag = headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return headers.get("Last-Modified")
+
+
+def content_range(headers):
+    "(first byte, total size or None) of a 206 response, or None"
+    match = re.match(r"^\s*bytes\s+(\d+)-\d+/(\d+|\*)\s*$",
+                     headers.get("Content-Range") or "")
+    if not match:
+        return None
+    start, total = match.groups()
+    return int(start), None if total == "*" else int(total)
+
+
+def remove(path):
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+class PartialDownload(object):
+    """A download of url to dest in progress. The data received so far is
+    kept beside dest in .<dest>.part, with a .<dest>.part.json sidecar that
+    records the URL and the validator of the response it came from, so that
+    a later attempt can ask for just the rest with Range and If-Range."""
+
+    def __init__(self, dest, url):
+        dirname, basename = os.path.split(dest)
+        self.dest = dest
+        self.url = url
+        self.path = os.path.join(dirname, ".{}.part".format(basename))
+        self.sidecar = self.path + ".json"
+        self.validator = None
+        self.total = None
+        self.size = 0
+        # Checksums of the download so far, when it is pinned to some
+        self.hashers = None
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.sidecar) as f:
+                meta = json.load(f)
+            size = os.path.getsize(self.path)
+        except (IOError, OSError, ValueError):
+            return
+        if meta.get("url") == self.url and meta.get("validator"):
+            self.validator = meta["validator"]
+            self.total = meta.get("total")
+            self.size = size
+
+    def save(self):
+        with fileutils.atomic_write(self.sidecar, "w") as f:
+            json.dump({"url": self.url, "validator": self.validator,
+                       "total": self.total}, f)
+
+    def range_headers(self):
+        "Request headers that ask for the rest of the download, if any"
+        if not (self.size and self.validator):
+            return {}
+        return {"Range": "bytes={}-".format(self.size), "If-Range": self.validator}
+
+    def write(self, response, bufsize, pinned=None):
+        """Write the body of response to the part file: appended to what was
+        received before if response is its continuation, otherwise in place
+        of it. The checksums in pinned are computed on the way, in hashers.
+        Returns the number of bytes received. Raises DownloadInterrupted if
+        the download failed on the server's side or on the way."""
+        headers = response.info()
+        start, total = 0, headers.get("Content-Length")
+        total = int(total) if total and total.isdigit() else None
+        if response.getcode() == 206:
+            start, total = content_range(headers) or (None, None)
+            if start != self.size:
+                self.discard()
+                raise DownloadInterrupted("Unexpected Content-Range {}".format(
+                    headers.get("Content-Range")))
+        elif self.size:
+            logging.info("Server sent all of {}, restarting download".format(self.url))
+        validator = strong_validator(headers)
+        if start and validator != self.validator:
+            self.discard()
+            raise DownloadInterrupted("{} changed during download".format(self.url))
+        self.validator, self.total = validator, total
+        if validator:
+            self.save()
+        else:
+            # Without a validator the download can't be resumed
+            remove(self.sidecar)
+        self.hashers = Hashers(pinned) if pinned else None
+        with open(self.path, "r+b" if start else "wb") as f:
+            f.truncate(start)
+            if self.hashers is not None:
+                # Only the part received earlier is read back
+                while f.tell() < start:
+                    self.hashers.update(f.read(min(bufsize, start - f.tell())))
+            f.seek(start)
+            self.size = start
+            try:
+                received = 0
+                while True:
+                    try:
+                        chunk = response.read(bufsize)
+                    except (IOError, socket.error, httplib.HTTPException) as e:
+                        raise DownloadInterrupted(str(e) or repr(e))
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    if self.hashers is not None:
+                        self.hashers.update(chunk)
+                    self.size += len(chunk)
+                    received += len(chunk)
+            finally:
+                f.flush()
+                os.fsync(f.fileno())
+        if self.total is not None and self.size != self.total:
+            raise DownloadInterrupted("Received {} of {} bytes".format(self.size, self.total))
+        return received
+
+    @property
+    def resumable(self):
+        return bool(self.size and self.validator)
+
+    def finish(self):
+        "Replace dest with the completed download"
+        os.chmod(self.path, 0o666 & ~fileutils.UMASK)
+        os.rename(self.path, self.dest)
+        remove(self.sidecar)
+
+    def discard(self):
+        remove(self.path)
+        remove(self.sidecar)
+        self.validator = self.total = None
+        self.size = 0
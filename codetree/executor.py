@@ -0,0 +1,219 @@
+"""Central execution of external commands.
+
+Every subprocess codetree runs (bzr, git, rsync...) is started by
+check_output here, so that a build can limit how many commands of each
+kind run at once, kill commands that hang, and account for the time each
+command spent waiting for a slot and running:
+
+    executor = Executor(limits={"bzr": 4, "rsync": 8}, timeout=600)
+    with executor.active():
+        check_output(("bzr", "pull", "-d", dest))
+
+Commands are classified by the name of their program. Kinds without a
+limit are not limited."""
+from subprocess import Popen, PIPE, CalledProcessError
+from contextlib import contextmanager
+import os
+import signal
+import logging
+import threading
+import time
+
+import buildprofile
+
+
+class CommandTimeout(CalledProcessError):
+    "A command that was killed for running longer than its timeout"
+
+    def __init__(self, returncode, cmd, output, timeout):
+        CalledProcessError.__init__(self, returncode, cmd, output)
+        self.timeout = timeout
+
+    def __str__(self):
+        return "Command '{}' timed out after {}s".format(" ".join(self.cmd), self.timeout)
+
+
+def command_kind(cmd):
+    return os.path.basename(cmd[0])
+
+
+def parse_limits(specs):
+    """Parse KIND=N specifications, each of which may list several
+    separated by commas, into {kind: N}. Raises ValueError."""
+    limits = {}
+    for spec in specs:
+        for item in spec.split(","):
+            if not item.strip():
+                continue
+            kind, sep, value = item.partition("=")
+            if not (sep and kind.strip() and value.strip().isdigit()):
+                raise ValueError("Invalid subprocess limit: {}".format(item))
+            limits[kind.strip()] = int(value)
+    return limits
+
+
+class KindStats(object):
+    "The commands of one kind that an Executor ran"
+
+    def __init__(self):
+        self.commands = 0
+        self.wait = 0.0
+        self.run = 0.0
+        self.timeouts = 0
+
+
+class Executor(object):
+    """Runs commands with at most limits[kind] of each kind at once, and
+    kills those that run longer than timeout seconds, along with any
+    processes they started."""
+
+    # Seconds a timed out command gets to exit after SIGTERM before SIGKILL
+    kill_grace = 5
+
+    def __init__(self, limits=None, timeout=None):
+        self.limits = dict(limits or {})
+        self.timeout = timeout
+        self.slots = dict((kind, threading.BoundedSemaphore(n))
+                          for kind, n in self.limits.items() if n > 0)
+        self.lock = threading.Lock()
+        self.stats = {}
+        # Commands are in process groups of their own, which don't get the
+        # terminal's SIGINT, so the running ones are killed explicitly
+        self.processes = set()
+
+    @contextmanager
+    def active(self):
+        """Run the commands of the block, in every thread, through this
+        executor. Commands still running when the block fails are killed."""
+        global _active
+        previous, _active = _active, self
+        try:
+            yield self
+        except BaseException:
+            self.terminate()
+            raise
+        finally:
+            _active = previous
+
+    def check_output(self, cmd, timeout=None, consume=None, **kwargs):
+        """subprocess.check_output of cmd, once a slot for its kind is free.
+        Raises CommandTimeout if it runs longer than timeout (by default the
+        timeout of the executor). With consume, the output is passed to
+        consume(stream) as it is produced, instead of being returned."""
+        kind = command_kind(cmd)
+        slot = self.slots.get(kind)
+        queued = time.time()
+        if slot is not None:
+            slot.acquire()
+        try:
+            started = time.time()
+            timed_out = False
+            try:
+                return self.run(cmd, timeout or self.timeout, kwargs, consume)
+            except CommandTimeout:
+                timed_out = True
+                raise
+            finally:
+                self.record(kind, cmd, started - queued, time.time() - started, timed_out)
+        finally:
+            if slot is not None:
+                slot.release()
+
+    def run(self, cmd, timeout, kwargs, consume=None):
+        # In a process group of its own, so that its children can be killed.
+        # preexec_fn is run between fork and exec while other threads may
+        # hold locks, but Python 2's subprocess already runs Python code
+        # there (with gc disabled) to set up the child's file descriptors,
+        # and os.setpgrp is a plain system call that takes no lock
+        process = Popen(cmd, stdout=PIPE, preexec_fn=os.setpgrp, **kwargs)
+        with self.lock:
+            self.processes.add(process)
+        expired = threading.Event()
+        timers = []
+        if timeout:
+            timers = [threading.Timer(timeout, self.kill,
+                                      (process, signal.SIGTERM, expired)),
+                      threading.Timer(timeout + self.kill_grace, self.kill,
+                                      (process, signal.SIGKILL))]
+            for timer in timers:
+                timer.daemon = True
+                timer.start()
+        try:
+            if consume is None:
+                output, _ = process.communicate()
+            else:
+                output = None
+                consume(process.stdout)
+                # Whatever consume left, such as padding, must not block it
+                while process.stdout.read(64 * 1024):
+                    pass
+                process.wait()
+        except BaseException:
+            self.kill(process, signal.SIGKILL)
+            process.wait()
+            raise
+        finally:
+            for timer in timers:
+                timer.cancel()
+            with self.lock:
+                self.processes.discard(process)
+        if expired.is_set():
+            # Whatever it left behind goes too
+            self.kill(process, signal.SIGKILL)
+            logging.warning("Killed '{}' after {}s".format(" ".join(cmd), timeout))
+            raise CommandTimeout(process.returncode, cmd, output, timeout)
+        if process.returncode:
+            raise CalledProcessError(process.returncode, cmd, output=output)
+        return output
+
+    def terminate(self):
+        """Kill every running command and the processes it started: SIGTERM
+        at once, SIGKILL for those still running after kill_grace seconds"""
+        with self.lock:
+            processes = list(self.processes)
+        if processes:
+            logging.warning("Killing {} running commands".format(len(processes)))
+        for process in processes:
+            self.kill(process, signal.SIGTERM)
+            timer = threading.Timer(self.kill_grace, self.kill,
+                                    (process, signal.SIGKILL))
+            timer.daemon = True
+            timer.start()
+
+    @staticmethod
+    def kill(process, sig, expired=None):
+        if expired is not None:
+            expired.set()
+        try:
+            os.killpg(process.pid, sig)
+        except OSError:
+            pass
+
+    def record(self, kind, cmd, wait, run, timed_out):
+        with self.lock:
+            stats = self.stats.setdefault(kind, KindStats())
+            stats.commands += 1
+            stats.wait += wait
+            stats.run += run
+            stats.timeouts += timed_out
+        record = buildprofile.current()
+        if record is not None:
+            record.command(kind, cmd, wait, run)
+
+    def log_summary(self):
+        for kind, stats in sorted(self.stats.items()):
+            limit = self.limits.get(kind)
+            logging.info("{}: {} commands{}, {:.2f}s queued, {:.2f}s running{}".format(
+                kind, stats.commands,
+                " (at most {} at once)".format(limit) if limit else "",
+                stats.wait, stats.run,
+                ", {} timed out".format(stats.timeouts) if stats.timeouts else ""))
+
+
+# Commands run outside of a build are not limited
+_active = Executor()
+
+
+def check_output(cmd, **kwargs):
+    "Run cmd through the executor of the running build"
+    return _active.check_output(cmd, **kwargs)
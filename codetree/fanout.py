@@ -0,0 +1,157 @@
+"""Building one config into many roots, fetching each source once.
+
+The config is built, incrementally as usual, into a staging tree in the
+cache directory. Each root is then made a copy of the staging tree, one
+directive at a time: the files of a directive (without those of the
+directives nested in it) are synced into the root as reflinks, hard links
+or copies, so unchanged files cost nothing, and files that are no longer
+in the staging tree are removed. bzr and git control directories are
+always copied, since their tools rewrite files in place. Links made by
+directives are placed as links.
+
+A directive's destination that exists in a root but was not put there by
+an earlier fan-out is left alone, unless the directive (or the root) has
+overwrite=true. Roots are given like sources, with options after a
+semicolon that apply to every directive in that root:
+
+    codetree --root /srv/a --root "/srv/b;overwrite=true" codetree.cfg
+"""
+import os
+import json
+import hashlib
+import logging
+import threading
+
+import fileutils
+from config import Config, Directive, default_cache_dir
+from scheduler import is_path_prefix
+
+# Kept in each root: the locations that fan-out has put there
+FANOUT_FILE = ".codetree-fanout"
+
+# How files are created in the roots, for each --fan-out-method. Hard
+# links share their contents with the staging tree and the other roots.
+METHODS = {
+    "link": ("hardlink", "reflink", "copy"),
+    "reflink": ("reflink", "copy"),
+    "copy": None,
+}
+
+
+def parse_root(spec):
+    "(path, options) of a --root argument"
+    path, options = Directive.parse_source(spec)
+    return path.strip(), options
+
+
+def default_staging(cache_dir, config_files):
+    key = hashlib.sha1("\0".join(os.path.abspath(f) for f in config_files))
+    return os.path.join(cache_dir, "staging", key.hexdigest()[:16])
+
+
+class FanOut(object):
+    """Builds config_files once into staging (by default a directory in the
+    cache directory), then into each of roots, which are (path, options)
+    pairs. config_options are passed to the Config, build_options to its
+    build, and method is a key of METHODS."""
+
+    def __init__(self, config_files, roots, staging=None, method="reflink",
+                 config_options=None, build_options=None):
+        self.config_files = config_files
+        self.roots = roots
+        self.method = method
+        self.config_options = config_options or {}
+        self.build_options = build_options or {}
+        self.staging = staging
+        self.config = None
+
+    def build(self):
+        "Build the staging tree, then every root. True if all went well."
+        if self.staging is None:
+            self.staging = default_staging(
+                self.config_options.get("cache_dir") or default_cache_dir(),
+                self.config_files)
+        fileutils.mkdir(self.staging)
+        self.config = Config(self.config_files, root=self.staging, **self.config_options)
+        ok = self.config.build(**self.build_options)
+        directives = [entry[-1] for entry in sorted(self.config.directives)]
+        # Roots are independent of each other, so they are filled at once
+        results = [False] * len(self.roots)
+
+        def fan_out(i):
+            results[i] = self.fan_out(self.roots[i], directives)
+        threads = [threading.Thread(target=fan_out, args=(i,))
+                   for i in range(len(self.roots))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return ok and all(results)
+
+    def fan_out(self, root, directives):
+        "Make the root (path, options) a copy of the staging tree"
+        path, root_options = root
+        logging.info("Fanning out {} to {}".format(self.staging, path))
+        record = os.path.join(path, FANOUT_FILE)
+        try:
+            with open(record) as f:
+                placed = set(json.load(f))
+        except (IOError, ValueError):
+            placed = set()
+        ok = True
+        failed = []
+        for directive in directives:
+            if any(is_path_prefix(other, directive.location) for other in failed):
+                continue
+            options = dict(directive.source_options, **root_options)
+            if not self.place(directive, path, placed, options):
+                failed.append(directive.location)
+                ok = False
+        fileutils.mkdir(path)
+        with fileutils.atomic_write(record, "w") as f:
+            json.dump(sorted(placed), f, indent=1)
+        return ok
+
+    def place(self, directive, root, placed, options):
+        """Sync the files of directive from the staging tree into root,
+        except those of the directives nested in it, which place their own"""
+        staged = directive.dest
+        target = os.path.join(root, directive.location)
+        location = os.path.normpath(directive.location)
+        if not os.path.lexists(staged):
+            logging.error("{} was not built, not placing it in {}".format(
+                directive.location, root))
+            return False
+        replace = (os.path.lexists(target) and location not in placed and
+                   directive.url != "@")
+        if replace and not options.get("overwrite"):
+            logging.error("{} exists and was not built by codetree, "
+                          "use overwrite=true to replace it".format(target))
+            return False
+        try:
+            if replace or (os.path.lexists(target) and
+                           (os.path.islink(target) != os.path.islink(staged) or
+                            os.path.isdir(target) != os.path.isdir(staged))):
+                logging.info("Overwriting {}".format(target))
+                fileutils.remove(target)
+            parent = os.path.dirname(target)
+            if parent:
+                fileutils.mkdir(parent)
+            if os.path.islink(staged):
+                # A link made by the directive, which sync would follow
+                link = os.readlink(staged)
+                if os.path.islink(target) and os.readlink(target) != link:
+                    os.unlink(target)
+                if not os.path.lexists(target):
+                    os.symlink(link, target)
+            else:
+                # Files removed from the source go from the roots too, except
+                # from the directories of "@", which are only containers
+                fileutils.sync(staged, target, delete=directive.url != "@", times=True,
+                               methods=METHODS[self.method], exclude=directive.nested,
+                               private=fileutils.PRIVATE_DIRS)
+        except (OSError, fileutils.FileManipulationError) as e:
+            logging.error("Failed to place {} in {}: {}".format(directive.location, root, e))
+            return False
+        placed.add(location)
+        return True
@@ -1,53 +1,469 @@
 import subprocess
 import shutil
 import os
+import re
+import stat
 import errno
+import fcntl
+import hashlib
+import tempfile
 from contextlib import contextmanager
 
+import executor
+
+# ioctl that shares the extents of one file with another (btrfs, xfs)
+FICLONE = 0x40049409
+
+# Read once: os.umask() can only be queried by changing it, which is not
+# safe to do while other threads are creating files
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+# Control directories whose files their tools (bzr, git) modify in place,
+# so they can't share those files with another tree
+PRIVATE_DIRS = (".bzr", ".git")
+
 
 class FileManipulationError(Exception):
     pass
 
 
+def parse_size(value):
+    "Parse a byte count such as 65536, 64k, 10M or 2G"
+    match = re.match(r"^\s*(\d+)\s*([kmgt]?)b?\s*$", str(value), re.I)
+    if not match:
+        raise ValueError("Invalid size: {}".format(value))
+    number, unit = match.groups()
+    return int(number) * 1024 ** " kmgt".index(unit.lower() or " ")
+
+
+def copy_stream(source, dest, bufsize=64 * 1024):
+    "Copy file object source to dest in bufsize chunks. Returns the byte count."
+    total = 0
+    while True:
+        chunk = source.read(bufsize)
+        if not chunk:
+            return total
+        dest.write(chunk)
+        total += len(chunk)
+
+
 @contextmanager
-def cd(dest):
-    here = os.getcwd()
-    os.chdir(dest)
-    yield
-    os.chdir(here)
+def atomic_write(dest, mode="wb"):
+    """Write to a temporary file beside dest, which replaces dest only once
+    the block completes. The data is synced to disk before the rename, so dest
+    is either the old file or the complete new one, never a partial file."""
+    dirname = os.path.dirname(dest) or os.curdir
+    fd, tmp = tempfile.mkstemp(dir=dirname, suffix=".tmp",
+                               prefix=".{}.".format(os.path.basename(dest)))
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp creates files readable only by their owner
+        os.chmod(tmp, 0o666 & ~UMASK)
+        os.rename(tmp, dest)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
 
 
-def copy(source, dest):
-    rsync(source, dest, delete=False)
+def reflink(source, dest):
+    "Create dest as a copy-on-write clone of source"
+    with open(source, "rb") as src:
+        with open(dest, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
 
 
-def rsync(source, dest, delete=True, perms=True, links=True, times=False):
+def temp_beside(dest):
+    "Create an empty temporary file beside dest, returning its name"
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dest) or os.curdir, suffix=".tmp",
+                               prefix=".{}.".format(os.path.basename(dest)))
+    os.close(fd)
+    return tmp
+
+
+def link_beside(source, dest):
+    """Hard link source to a new temporary name beside dest, returning it.
+    A link can't replace a file, so names are tried until one is free."""
+    while True:
+        tmp = tempfile.mktemp(dir=os.path.dirname(dest) or os.curdir, suffix=".tmp",
+                              prefix=".{}.".format(os.path.basename(dest)))
+        try:
+            os.link(source, tmp)
+            return tmp
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+
+def same_filesystem(a, b):
+    "True if the paths a and b are on the same filesystem"
+    return os.stat(a).st_dev == os.lstat(b).st_dev
+
+
+def materialize(source, dest, methods=("hardlink", "reflink", "copy")):
+    """Atomically replace dest with the contents of file source, using the
+    first of methods that the filesystem supports. Returns the method used."""
+    for method in methods:
+        tmp = None
+        try:
+            if method == "hardlink":
+                tmp = link_beside(source, dest)
+            elif method in ("reflink", "copy"):
+                tmp = temp_beside(dest)
+                if method == "reflink":
+                    reflink(source, tmp)
+                else:
+                    shutil.copyfile(source, tmp)
+                shutil.copymode(source, tmp)
+            else:
+                raise FileManipulationError("Unknown method: {}".format(method))
+        except (IOError, OSError) as e:
+            if tmp is not None and os.path.exists(tmp):
+                os.unlink(tmp)
+            if method == methods[-1]:
+                raise FileManipulationError(
+                    "Cannot create {} from {}: {}".format(dest, source, e))
+            continue
+        os.rename(tmp, dest)
+        return method
+
+
+def tree_summary(path, exclude=()):
+    """A digest of the names, types, modes, sizes and mtimes of path and
+    everything below it, except the paths in exclude (relative to path), or
+    None if path does not exist. No file contents are read, so this is cheap
+    enough to detect changes with."""
+    if not os.path.lexists(path):
+        return None
+    sha = hashlib.sha1()
+
+    def add(relpath, path_stat, fullpath):
+        target = os.readlink(fullpath) if stat.S_ISLNK(path_stat.st_mode) else ""
+        if stat.S_ISDIR(path_stat.st_mode):
+            # Changes to its entries are seen in their names; its own mtime
+            # and size would also change with those of excluded entries
+            size, mtime = 0, 0
+        else:
+            size, mtime = path_stat.st_size, path_stat.st_mtime
+        sha.update("{}\0{}\0{}\0{!r}\0{}\n".format(
+            relpath, path_stat.st_mode, size, mtime, target))
+
+    add(os.curdir, os.lstat(path), path)
+    if os.path.isdir(path) and not os.path.islink(path):
+        for dirpath, dirnames, filenames in os.walk(path):
+            for name in [name for name in dirnames
+                         if os.path.relpath(os.path.join(dirpath, name), path) in exclude]:
+                dirnames.remove(name)
+            dirnames.sort()
+            for name in sorted(dirnames + filenames):
+                fullpath = os.path.join(dirpath, name)
+                relpath = os.path.relpath(fullpath, path)
+                if relpath not in exclude:
+                    add(relpath, os.lstat(fullpath), fullpath)
+    return sha.hexdigest()
+
+
+def copy(source, dest, paths=None):
+    return sync(source, dest, delete=False, paths=paths)
+
+
+class SyncStats(object):
+    "What a sync did"
+
+    def __init__(self):
+        self.copied = 0
+        self.skipped = 0
+        self.deleted = 0
+        self.bytes = 0
+
+
+def copy_file_data(source, dest):
+    "Copy the contents of the file source to dest, in the kernel if possible"
+    with open(source, "rb") as src:
+        with open(dest, "wb") as dst:
+            sendfile = getattr(os, "sendfile", None)
+            if sendfile is not None:
+                size = os.fstat(src.fileno()).st_size
+                offset = 0
+                while offset < size:
+                    sent = sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+                    if not sent:
+                        break
+                    offset += sent
+            else:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+
+
+def same_contents(a, b, bufsize=1024 * 1024):
+    "True if the files a and b have the same contents"
+    with open(a, "rb") as fa:
+        with open(b, "rb") as fb:
+            while True:
+                chunk = fa.read(bufsize)
+                if chunk != fb.read(bufsize):
+                    return False
+                if not chunk:
+                    return True
+
+
+def is_unchanged(source, dest, source_stat, dest_stat, times):
+    """The quick check: with times preserved a file is unchanged if its size
+    and mtime match. Otherwise the copy's mtime says nothing about source,
+    so a file of the same size is unchanged if its contents are."""
+    if source_stat.st_size != dest_stat.st_size:
+        return False
+    if times:
+        return int(source_stat.st_mtime) == int(dest_stat.st_mtime)
+    return same_contents(source, dest)
+
+
+def remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+
+def sync_file(source, dest, source_stat, perms, times, stats, methods=None,
+              dedupe=None):
+    try:
+        dest_stat = os.lstat(dest)
+    except OSError:
+        dest_stat = None
+    if dedupe is not None:
+        # dest may be a link into the store, so it is never modified
+        if dest_stat is not None and stat.S_ISDIR(dest_stat.st_mode):
+            shutil.rmtree(dest)
+        if dedupe.place(source, dest, source_stat):
+            stats.copied += 1
+            stats.bytes += source_stat.st_size
+        else:
+            stats.skipped += 1
+        return
+    if dest_stat is not None:
+        if (dest_stat.st_ino, dest_stat.st_dev) == (source_stat.st_ino, source_stat.st_dev):
+            # A hard link to source
+            stats.skipped += 1
+            return
+        if stat.S_ISREG(dest_stat.st_mode) and is_unchanged(source, dest, source_stat, dest_stat,
+                                                       times):
+            mode = stat.S_IMODE(source_stat.st_mode)
+            if not perms or stat.S_IMODE(dest_stat.st_mode) == mode:
+                stats.skipped += 1
+                return
+            if dest_stat.st_nlink == 1:
+                os.chmod(dest, mode)
+                stats.skipped += 1
+                return
+            # Other links to dest (such as an earlier generation's) must
+            # keep their mode, so dest is replaced like a changed file
+        if stat.S_ISDIR(dest_stat.st_mode):
+            shutil.rmtree(dest)
+    if methods is not None:
+        if materialize(source, dest, methods) != "hardlink" and times:
+            os.utime(dest, (source_stat.st_atime, source_stat.st_mtime))
+        stats.copied += 1
+        stats.bytes += source_stat.st_size
+        return
+    # Written beside dest and renamed into place, so that dest is never
+    # partially written and other links to its old inode are left alone
+    tmp = temp_beside(dest)
+    try:
+        copy_file_data(source, tmp)
+        if perms or dest_stat is None or not stat.S_ISREG(dest_stat.st_mode):
+            mode = stat.S_IMODE(source_stat.st_mode)
+            os.chmod(tmp, mode if perms else mode & ~UMASK)
+        else:
+            os.chmod(tmp, stat.S_IMODE(dest_stat.st_mode))
+        if times:
+            os.utime(tmp, (source_stat.st_atime, source_stat.st_mtime))
+        os.rename(tmp, dest)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    stats.copied += 1
+    stats.bytes += source_stat.st_size
+
+
+def sync_link(source, dest, stats):
+    target = os.readlink(source)
+    if os.path.islink(dest) and os.readlink(dest) == target:
+        stats.skipped += 1
+        return
+    if os.path.lexists(dest):
+        remove(dest)
+    os.symlink(target, dest)
+    stats.copied += 1
+
+
+def sync_dir(source, dest, perms, stats):
+    if os.path.lexists(dest) and (os.path.islink(dest) or not os.path.isdir(dest)):
+        os.unlink(dest)
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+    if perms:
+        # The owner keeps access until the contents are written: sync sets
+        # the mode of source afterwards, which may not allow writing
+        os.chmod(dest, stat.S_IMODE(os.stat(source).st_mode) | stat.S_IRWXU)
+
+
+def sync(source, dest, delete=True, perms=True, links=True, times=False,
+         methods=None, exclude=(), dedupe=None, paths=None, private=()):
+    """Copy source to dest in-process, with the semantics of the rsync
+    function: the contents of a source directory are copied into dest, a
+    source file is copied into dest if dest is a directory. Unchanged files
+    are not copied again: with times, those whose size and mtime match;
+    otherwise those whose size and contents match.
+
+    With methods, files are created as by materialize (e.g. as hard links
+    to source) instead of being copied; with dedupe, a store.Deduplicator,
+    as links to the copies of their content in its store. Paths in exclude,
+    relative to source, are neither copied nor deleted. With paths, a
+    pathfilter.PathFilter, only the files it selects are copied, and only
+    the directories that may hold some are visited. Directories named in
+    private, such as PRIVATE_DIRS, are always copied (and mirrored, with
+    deletions), whatever methods says, since their files are rewritten in
+    place by the tools that own them."""
+    stats = SyncStats()
+    if not (os.path.isfile(source) or os.path.isdir(source)):
+        raise FileManipulationError("Only files and directories can be copied")
+    try:
+        if os.path.isfile(source):
+            if os.path.isdir(dest):
+                dest = os.path.join(dest, os.path.basename(source))
+            sync_file(source, dest, os.stat(source), perms, times, stats, methods,
+                      dedupe)
+            return stats
+
+        directories = []
+        for dirpath, dirnames, filenames in os.walk(source):
+            relpath = os.path.relpath(dirpath, source)
+            destdir = os.path.normpath(os.path.join(dest, relpath))
+            sync_dir(dirpath, destdir, perms, stats)
+            directories.append((dirpath, destdir))
+            wanted = set()
+            for name in sorted(dirnames + filenames):
+                member = os.path.normpath(os.path.join(relpath, name))
+                if member in exclude:
+                    if name in dirnames:
+                        dirnames.remove(name)
+                    wanted.add(name)
+                    continue
+                path = os.path.join(dirpath, name)
+                if name in private and name in dirnames and not os.path.islink(path):
+                    dirnames.remove(name)
+                    wanted.add(name)
+                    copied = sync(path, os.path.join(destdir, name), True, perms,
+                                  links, times)
+                    for field in ("copied", "skipped", "deleted", "bytes"):
+                        setattr(stats, field, getattr(stats, field) + getattr(copied, field))
+                    continue
+                if paths is not None:
+                    if name in dirnames:
+                        selected = paths.may_contain(member)
+                    else:
+                        selected = paths.selects(member)
+                    if not selected:
+                        if name in dirnames:
+                            dirnames.remove(name)
+                        continue
+                path_stat = os.lstat(path)
+                if stat.S_ISLNK(path_stat.st_mode):
+                    # os.walk does not descend into symlinked directories
+                    if name in dirnames:
+                        dirnames.remove(name)
+                    if links:
+                        sync_link(path, os.path.join(destdir, name), stats)
+                    wanted.add(name)
+                elif stat.S_ISDIR(path_stat.st_mode):
+                    wanted.add(name)
+                elif stat.S_ISREG(path_stat.st_mode):
+                    sync_file(path, os.path.join(destdir, name), path_stat,
+                              perms, times, stats, methods, dedupe)
+                    wanted.add(name)
+            if delete:
+                for name in set(os.listdir(destdir)) - wanted:
+                    remove(os.path.join(destdir, name))
+                    stats.deleted += 1
+        # Directory modes and mtimes are set last, after their contents changed
+        for dirpath, destdir in reversed(directories):
+            dir_stat = os.stat(dirpath)
+            if perms:
+                os.chmod(destdir, stat.S_IMODE(dir_stat.st_mode))
+            if times:
+                os.utime(destdir, (dir_stat.st_atime, dir_stat.st_mtime))
+    except (IOError, OSError) as e:
+        raise FileManipulationError("Copying {} to {} failed: {}".format(source, dest, e))
+    return stats
+
+
+def rsync_args(directory, delete=True, perms=True, links=True, times=False):
+    "The option string for rsync copying a directory, or a file"
     args = "-"
-    if os.path.isdir(source):
-        if not source.endswith("/"):
-            # The contents of source are always copied into a folder
-            # with the name of dest
-            source = source + "/"
+    if directory:
         args += "r"
         if delete:
             args += "d"
-    elif not os.path.isfile(source):
-        raise FileManipulationError("Only files and directories can be copied")
-
     if perms:
         args += "p"
     if links:
         args += "l"
     if times:
         args += "t"
+    return args
+
+
+def rsync(source, dest, delete=True, perms=True, links=True, times=False,
+          paths=None):
+    """Copy source to dest with rsync. With paths, a pathfilter.PathFilter,
+    only the files it selects in the directory source are listed to rsync."""
+    if paths is not None:
+        if not os.path.isdir(source):
+            raise FileManipulationError("Only directories can be filtered")
+        return rsync_many(source, dest, sorted(paths.walk(source)),
+                          delete, perms, links, times)
+    if os.path.isdir(source):
+        if not source.endswith("/"):
+            # The contents of source are always copied into a folder
+            # with the name of dest
+            source = source + "/"
+    elif not os.path.isfile(source):
+        raise FileManipulationError("Only files and directories can be copied")
+    args = rsync_args(os.path.isdir(source), delete, perms, links, times)
 
     cmd = ("rsync", args, source, dest)
     try:
-        subprocess.check_output(cmd)
+        executor.check_output(cmd)
     except subprocess.CalledProcessError as e:
         raise FileManipulationError(e.message)
 
 
+def rsync_many(source_dir, dest_dir, names, delete=True, perms=True, links=True,
+               times=False):
+    """Copy each of names (files or directories) in source_dir to the same
+    name in dest_dir, as rsync() would one at a time, with a single rsync"""
+    for name in names:
+        path = os.path.join(source_dir, name)
+        if not os.path.isdir(path) and not os.path.isfile(path):
+            raise FileManipulationError("Only files and directories can be copied")
+    args = rsync_args(True, delete, perms, links, times)
+    with tempfile.NamedTemporaryFile(prefix=".codetree-rsync-") as files_from:
+        files_from.write("".join(name + "\n" for name in names))
+        files_from.flush()
+        cmd = ("rsync", args, "--files-from", files_from.name,
+               os.path.join(source_dir, ""), os.path.join(dest_dir, ""))
+        try:
+            executor.check_output(cmd)
+        except subprocess.CalledProcessError as e:
+            raise FileManipulationError(e.message)
+
+
 def link(source, dest=None, symbolic=True, overwrite=True):
     if not dest:
         source_name = os.path.basename(source)
@@ -64,19 +480,15 @@ def link(source, dest=None, symbolic=True, overwrite=True):
         # This won't trigger for a pre-existing symlink
         raise FileManipulationError("Destination already exists: {}".format(dest))
 
-    if symbolic:
-        mklink = os.symlink
-    else:
-        mklink = os.link
-
+    # A relative source is relative to the directory of dest. The working
+    # directory is shared by every thread of a build, so it is never changed.
     try:
-        if os.path.isabs(dest):
-            mklink(source, dest)
+        if symbolic:
+            os.symlink(source, dest)
         else:
-            with cd(os.path.dirname(dest)):
-                mklink(source, os.path.basename(dest))
+            os.link(os.path.join(os.path.dirname(dest), source), dest)
     except OSError as e:
-        raise FileManipulationError(e.message)
+        raise FileManipulationError(str(e))
 
 
 def mkdir(dirname, overwrite=False):
@@ -0,0 +1,129 @@
+"""Generational builds: each build assembles a new tree, which replaces
+the live one all at once.
+
+Layout of the generations directory:
+    current             symlink to the live generation
+    generations/<N>     one tree per build, numbered in build order
+    lock                held for the duration of a build
+
+A new generation starts as a clone of the live one in which every file is
+a hard link, so it costs almost nothing, and directives that are unchanged
+since the last build are skipped as usual. Directives never modify a file
+that has other links: they replace it (by renaming a new file over the
+old one), even when only its mode changes, which leaves the live
+generation's links alone. bzr and git control directories are the
+exception: their tools rewrite files in place, so they are copied instead.
+Once the build has succeeded, current is switched to the new generation
+with a rename, so readers of current see either the old tree or the new
+one, never a tree in the middle of a build."""
+import os
+import fcntl
+import shutil
+import logging
+
+import fileutils
+from config import Config
+from executor import check_output
+
+
+def clone_tree(source, dest):
+    """Make dest a copy of the tree source, in which files are hard links
+    to those of source, except within fileutils.PRIVATE_DIRS. Timestamps are kept
+    exactly (which Python 2 can't do), so that fingerprints of the copy
+    match those of source."""
+    check_output(("cp", "-al", source, dest))
+    for dirpath, dirnames, filenames in os.walk(dest):
+        for name in [name for name in dirnames if name in fileutils.PRIVATE_DIRS]:
+            dirnames.remove(name)
+            private = os.path.join(dirpath, name)
+            shutil.rmtree(private)
+            check_output(("cp", "-a", os.path.join(
+                source, os.path.relpath(private, dest)), private))
+
+
+class Generations(object):
+    """The generations of a tree built in path. The live generation and
+    the generations before it are kept, up to keep generations in all."""
+
+    def __init__(self, path, keep=3):
+        self.path = path
+        self.keep = max(1, keep)
+        self.generations = os.path.join(path, "generations")
+        self.current_link = os.path.join(path, "current")
+        # The Config of the generation being built
+        self.config = None
+
+    def names(self):
+        "The existing generations, oldest first"
+        try:
+            names = os.listdir(self.generations)
+        except OSError:
+            return []
+        return sorted((name for name in names if name.isdigit()), key=int)
+
+    def current(self):
+        "The live generation, or None"
+        try:
+            return os.path.basename(os.readlink(self.current_link))
+        except OSError:
+            return None
+
+    def generation(self, name):
+        return os.path.join(self.generations, name)
+
+    def prepare(self):
+        "Create the next generation from the live one. Returns its name."
+        names = self.names()
+        name = str(int(names[-1]) + 1 if names else 1)
+        current = self.current()
+        fileutils.mkdir(self.generations)
+        if current is not None and os.path.isdir(self.generation(current)):
+            logging.info("Cloning generation {} as {}".format(current, name))
+            clone_tree(self.generation(current), self.generation(name))
+        else:
+            os.mkdir(self.generation(name))
+        return name
+
+    def switch(self, name):
+        "Make generation name the live one, atomically"
+        tmp = self.current_link + ".tmp"
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        os.symlink(os.path.join("generations", name), tmp)
+        os.rename(tmp, self.current_link)
+        logging.info("{} is now generation {}".format(self.current_link, name))
+
+    def collect(self):
+        """Remove the generations beyond the keep most recent ones, and
+        those left behind by failed builds, but never the live one"""
+        current = self.current()
+        if current is None:
+            doomed = self.names()
+        else:
+            older = [name for name in self.names() if int(name) < int(current)]
+            # Generations newer than the live one are failed builds
+            newer = [name for name in self.names() if int(name) > int(current)]
+            doomed = older[:max(0, len(older) - (self.keep - 1))] + newer
+        for name in doomed:
+            logging.info("Removing generation {}".format(name))
+            shutil.rmtree(self.generation(name))
+
+    def build(self, config_files, config_options=None, build_options=None):
+        """Build config_files as a new generation, and make it the live one
+        if the build succeeds. Returns the result of the build."""
+        fileutils.mkdir(self.path)
+        with open(os.path.join(self.path, "lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            name = self.prepare()
+            self.config = Config(config_files, root=self.generation(name),
+                                 **(config_options or {}))
+            try:
+                ok = self.config.build(**(build_options or {}))
+                if ok:
+                    self.switch(name)
+                else:
+                    logging.error("Build failed, keeping generation {}".format(
+                        self.current()))
+                return ok
+            finally:
+                self.collect()
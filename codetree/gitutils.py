@@ -0,0 +1,145 @@
+"""Inspection of git repositories, and the persistent cache of bare mirrors
+that git working trees borrow their objects from."""
+from subprocess import CalledProcessError, STDOUT
+from contextlib import contextmanager
+import os
+import re
+import fcntl
+import hashlib
+import threading
+
+from executor import check_output
+
+SHA1 = re.compile(r"^[0-9a-f]{40}$")
+
+
+def is_sha(rev):
+    return bool(SHA1.match(rev or ""))
+
+
+def git(*args):
+    return check_output(("git",) + args, stderr=STDOUT)
+
+
+def git_dir(path):
+    "The .git directory of the working tree at path, or None"
+    control = os.path.join(path, ".git")
+    if os.path.isfile(os.path.join(control, "HEAD")):
+        return control
+    return None
+
+
+def remote_url(path, remote="origin"):
+    try:
+        return git("-C", path, "config", "--get",
+                   "remote.{}.url".format(remote)).strip() or None
+    except CalledProcessError:
+        return None
+
+
+def read_ref(control, ref):
+    "The commit that ref points to in the repository control, or None"
+    try:
+        with open(os.path.join(control, ref)) as f:
+            return f.read().strip()
+    except IOError:
+        pass
+    try:
+        with open(os.path.join(control, "packed-refs")) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2 and parts[1] == ref:
+                    return parts[0]
+    except IOError:
+        pass
+    return None
+
+
+def read_head(path):
+    """The commit checked out in the working tree at path, read from its
+    control files without running git. None if it has none."""
+    control = git_dir(path)
+    if control is None:
+        return None
+    with open(os.path.join(control, "HEAD")) as f:
+        head = f.read().strip()
+    if head.startswith("ref: "):
+        return read_ref(control, head[len("ref: "):])
+    return head if is_sha(head) else None
+
+
+def ls_remote(url, ref):
+    "The commit that ref points to at url, or None if there is no such ref"
+    for line in git("ls-remote", url, ref).splitlines():
+        sha, name = line.split()
+        if name == ref or ref == "HEAD":
+            return sha
+    return None
+
+
+class GitCache(object):
+    """Persistent bare mirrors of git repositories. Working trees are
+    created with the mirror of their source as an alternate object store,
+    so each object is fetched over the network once, and only new objects
+    are fetched by later builds. Mirrors are never garbage-collected, since
+    a tree may have checked out a commit that the source no longer has.
+
+    Layout:
+        <hash>.git       the mirror of one source URL
+        <hash>.lock      held while the mirror is updated
+    """
+
+    # HEAD of the source is kept as this ref of the mirror
+    HEAD = "refs/codetree/HEAD"
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.thread_locks = {}
+        # Mirrors already brought up to date during this build
+        self.refreshed = set()
+
+    def mirror(self, url):
+        return os.path.join(self.path, hashlib.sha1(url).hexdigest()[:16] + ".git")
+
+    @contextmanager
+    def locked(self, url):
+        "Serialize work on the mirror of url between threads and processes"
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        mirror = self.mirror(url)
+        with self.lock:
+            thread_lock = self.thread_locks.setdefault(mirror, threading.Lock())
+        with thread_lock:
+            with open(mirror[:-len(".git")] + ".lock", "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                yield
+
+    def update(self, url):
+        """Fetch the branches and tags of url that are new into its mirror.
+        Returns the mirror. Raises CalledProcessError if git fails."""
+        mirror = self.mirror(url)
+        with self.locked(url):
+            if mirror in self.refreshed:
+                return mirror
+            if not os.path.exists(mirror):
+                git("init", "-q", "--bare", mirror)
+                # Trees borrow objects from the mirror, so nothing may be
+                # pruned from it, even after a force-push upstream
+                git("-C", mirror, "config", "gc.auto", "0")
+                git("-C", mirror, "config", "gc.pruneExpire", "never")
+            git("-C", mirror, "fetch", "-q", "--prune", "--force", url,
+                "refs/heads/*:refs/heads/*", "refs/tags/*:refs/tags/*",
+                "HEAD:" + self.HEAD)
+            self.refreshed.add(mirror)
+        return mirror
+
+    def resolve(self, url, ref):
+        "The commit of ref in the mirror of url, or None"
+        if ref == "HEAD":
+            ref = self.HEAD
+        try:
+            return git("-C", self.mirror(url), "rev-parse", "--verify", "-q",
+                       ref + "^{commit}").strip()
+        except CalledProcessError:
+            return None
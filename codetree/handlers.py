@@ -1,19 +1,28 @@
 from __future__ import print_function
 from urlparse import urlparse
+from contextlib import contextmanager
 import shutil
+import tarfile
+import tempfile
 from subprocess import (
-    Popen,
-    PIPE,
     STDOUT,
-    check_output,
     CalledProcessError,
-    check_call,
 )
 import os
+import time
 import logging
+import socket
 import urllib2
 
+import archive
+import bzrutils
+import checksum
 import fileutils
+import gitutils
+from buildprofile import phase, transferred
+from executor import check_output
+from download import DownloadInterrupted, PartialDownload
+from pathfilter import OPTIONS as FILTER_OPTIONS, FilterError, PathFilter
 
 
 class CommandFailure(Exception):
@@ -55,12 +64,37 @@ def strip_trailing_slash(value):
 class SourceHandler(object):
     schemes = tuple()
 
+    # The BuildContext of the Config this handler belongs to, if any
+    context = None
+
+    # The Scheduler lane that runs this handler's directives; None for the
+    # main pool of workers
+    lane = None
+
     def __init__(self, source):
         self.source = source
 
+    def source_fingerprint(self, options):
+        """A cheap identifier of the source's current content, for
+        incremental builds; None if it can't be known without fetching"""
+        return None
+
+    def dest_fingerprint(self, dest, options, exclude=()):
+        """An identifier of the current state of dest, or None. Paths in
+        exclude, relative to dest, belong to other directives."""
+        return fileutils.tree_summary(dest, exclude)
+
+    def watch_path(self):
+        """The local path that holds the source, if changes to it can be
+        watched for; None for sources that must be polled"""
+        return None
+
 
 class BzrSourceHandler(SourceHandler):
-    """Check out a bazaar working tree"""
+    """Check out a bazaar working tree. The mode option selects what is
+    made of the source: a full branch (the default), a lightweight checkout
+    of it, or an export of its files without any bzr metadata. Only exports
+    can be partial, so they are the default with path, include or exclude."""
 
     schemes = (
         "bzr",
@@ -68,6 +102,7 @@ class BzrSourceHandler(SourceHandler):
         "lp",
         "bzr+http",
         "bzr+https",
+        "bzr+file",
         "nosmart+bzr",
         "nosmart+bzr+ssh",
         "nosmart+lp",
@@ -76,89 +111,613 @@ class BzrSourceHandler(SourceHandler):
     def __init__(self, source):
         super(BzrSourceHandler, self).__init__(source)
         scheme = urlparse(source).scheme
-        if scheme in ("bzr+http", "bzr+https"):
+        if scheme in ("bzr+http", "bzr+https", "bzr+file"):
             self.source = source[4:]
         else:
             self.source = source
+        # The parent of an existing dest, once is_same_branch has probed it
+        self.dest_source = None
+
+    modes = ("branch", "lightweight", "export")
 
-    def checkout_branch(self, dest):
+    @staticmethod
+    def mode(options):
+        if any(options.get(name) for name in FILTER_OPTIONS):
+            return options.get("mode", "export")
+        return options.get("mode", "branch")
+
+    def checkout_branch(self, dest, revno=None):
+        with phase("fetch"):
+            return self._checkout_branch(dest, revno)
+
+    def _checkout_branch(self, dest, revno=None):
         parent_dir = os.path.dirname(dest)
         if parent_dir and not os.path.exists(parent_dir):
             os.makedirs(parent_dir)
-        cmd = ('bzr', 'branch', self.source, dest)
-        return log_failure(cmd, "Branching {} to {}".format(self.source, dest))
+        with self.fetch_location() as location:
+            if location is None:
+                return False
+            if revno is None:
+                cmd = ('bzr', 'branch', location, dest)
+            else:
+                # Only the history up to revno is fetched
+                cmd = ('bzr', 'branch', '-r', revno, location, dest)
+            if not log_failure(cmd, "Branching {} to {}".format(self.source, dest)):
+                return False
+        if location != self.source:
+            # Branched from the shared repository cache; the parent must
+            # still be the real source
+            parent = self.normalize_lp_branch(strip_trailing_slash(self.source))
+            cmd = ('bzr', 'config', '-d', dest, 'parent_location=' + parent)
+            return log_failure(cmd, "Setting parent of {} to {}".format(dest, parent))
+        return True
 
-    def update_branch(self, dest):
-        cmd = ("bzr", "pull", "-d", dest)
-        return log_failure(cmd, "Updating {} from parent ({})".format(dest, self.source))
+    def checkout_lightweight(self, dest, revno=None):
+        """A lightweight checkout refers to its branch for every operation,
+        so it is made from the source itself, never from the shared
+        repository cache."""
+        parent_dir = os.path.dirname(dest)
+        if parent_dir and not os.path.exists(parent_dir):
+            os.makedirs(parent_dir)
+        cmd = ("bzr", "checkout", "--lightweight")
+        if revno is not None:
+            cmd += ("-r", revno)
+        cmd += (self.source, dest)
+        with phase("fetch"):
+            return log_failure(cmd, "Checking out {} to {}".format(self.source, dest))
+
+    def update_checkout(self, dest, revno=None):
+        "Bring the lightweight checkout dest to revno (default: the tip)"
+        if revno is not None and revno.isdigit():
+            with phase("probe"):
+                at_target = bzrutils.tree_revno(dest) == int(revno)
+            if at_target:
+                logging.info("{} is already at revision {}".format(dest, revno))
+                return True
+        cmd = ("bzr", "update", dest)
+        if revno is not None:
+            cmd += ("-r", revno)
+        with phase("fetch"):
+            return log_failure(cmd, "Updating {} from {}".format(dest, self.source))
+
+    def export(self, dest, revno=None, paths=None):
+        """Write the files of the source at revno (default: its tip) to dest,
+        without history, or only those selected by the PathFilter paths.
+        Each file keeps the time of the revision that last changed it, so
+        updating an existing export only rewrites the files that changed
+        since, and removes those the branch no longer has. What was exported
+        is recorded in the marker bzrutils.EXPORT_MARKER."""
+        with self.fetch_location() as location:
+            if location is None:
+                return False
+            return self._export(dest, location, revno, paths)
+
+    def _export(self, dest, location, revno=None, paths=None):
+        source = self.export_source()
+        revid = None
+        if revno is None:
+            # Export exactly the revision that was probed, even if the
+            # branch moves on meanwhile
+            try:
+                revision = self.probes.remote_revision(
+                    self.normalize_lp_branch(strip_trailing_slash(location)))
+            except CalledProcessError as e:
+                logging.error(e.output)
+                return False
+            if revision is None:
+                logging.error("{} is not a bzr branch".format(self.source))
+                return False
+            revno, revid = str(revision[0]), revision[1]
+        selection = paths.spec() if paths is not None else None
+        exported = bzrutils.read_export(dest)
+        if (exported and exported["source"] == source and
+                exported.get("selection") == selection and
+                (exported["revid"] == revid if revid else exported["revno"] == revno)):
+            logging.info("{} is already an export of revision {}".format(dest, revno))
+            return True
+
+        parent_dir = os.path.dirname(dest) or os.curdir
+        fileutils.mkdir(parent_dir)
+        staging = tempfile.mkdtemp(dir=parent_dir,
+                                   prefix=".{}.".format(os.path.basename(dest)))
+        try:
+            tree = os.path.join(staging, "tree")
+            revision = "revid:" + revid if revid else revno
+            message = "Exporting revision {} of {} to {}".format(revno, self.source, dest)
+            with phase("fetch"):
+                if paths is not None:
+                    exported_ok = self.export_partial(tree, revision, location, paths,
+                                                      message)
+                else:
+                    cmd = ("bzr", "export", "--per-file-timestamps", "-r", revision,
+                           tree, location)
+                    exported_ok = log_failure(cmd, message)
+            if not exported_ok:
+                return False
+            bzrutils.write_export(tree, source, revno, revid, selection)
+            if not os.path.exists(dest):
+                os.rename(tree, dest)
+                return True
+            with phase("update"):
+                try:
+                    transferred(fileutils.sync(tree, dest, delete=False, times=True).bytes)
+                except fileutils.FileManipulationError as e:
+                    logging.error("Failed to update {}: {}".format(dest, e))
+                    return False
+                self.remove_unexported(dest, exported, bzrutils.read_export(dest))
+            return True
+        finally:
+            shutil.rmtree(staging)
+
+    def export_partial(self, tree, revision, location, paths, message):
+        """Export the files of revision of location that paths selects to
+        tree. bzr streams a tarball of the whole revision, and the others
+        are left out of tree."""
+        cmd = ("bzr", "export", "--per-file-timestamps", "--format=tar",
+               "--root=tree", "-r", revision, "-", location)
+        extractor = archive.Extractor(tree, strip_components=1, paths=paths)
+        fileutils.mkdir(tree)
+        logging.info(message)
+        try:
+            check_output(cmd, consume=lambda stream: extractor.extract(stream, "tar"))
+        except CalledProcessError as e:
+            logging.error("{} failed: {}".format(" ".join(cmd), e))
+            return False
+        except (archive.ArchiveError, tarfile.TarError, EOFError, IOError) as e:
+            logging.error("Exporting {} failed: {}".format(self.source, e))
+            return False
+        transferred(extractor.bytes)
+        return True
+
+    @staticmethod
+    def remove_unexported(dest, old, new):
+        "Remove from dest what the old export had and the new one doesn't"
+        if old is None:
+            return
+        # Deepest first, so that directories are empty by the time they go
+        for name in sorted(set(old.get("files", [])) - set(new["files"]), reverse=True):
+            path = os.path.join(dest, name)
+            try:
+                if name.endswith("/"):
+                    os.rmdir(path)
+                else:
+                    os.unlink(path)
+            except OSError:
+                # Gone already, or a directory holding other files
+                pass
+
+    def export_source(self):
+        "The source as recorded in the marker of an export"
+        return bzrutils.normalize_location(
+            self.normalize_lp_branch(strip_trailing_slash(self.source).strip()))
+
+    def update_branch(self, dest, revno=None):
+        with self.fetch_location() as location:
+            if location is None:
+                return False
+            cmd = ("bzr", "pull", "-d", dest)
+            if location != self.source:
+                cmd += (location,)
+            if revno is not None:
+                cmd += ("-r", revno)
+            with phase("fetch"):
+                return log_failure(cmd, "Updating {} from parent ({})".format(
+                    dest, self.source))
+
+    @contextmanager
+    def fetch_location(self):
+        """Where revisions are fetched from within the block: the source
+        itself, or its mirror in the shared repository cache, which is not
+        pruned until the block exits. None if the mirror can't be updated."""
+        repos = getattr(self.context, "bzr_repos", None)
+        if repos is None:
+            yield self.source
+            return
+        with repos.in_use(self.source):
+            yield self.refresh_mirror(repos)
+
+    def refresh_mirror(self, repos):
+        "Bring the mirror of the source up to date, once per build"
+        mirror = repos.mirror(self.source)
+        with phase("fetch"), repos.locked(self.source):
+            if mirror in repos.refreshed:
+                return mirror
+            repository = repos.repository(self.source)
+            if not os.path.exists(repository):
+                cmd = ("bzr", "init-repo", "--no-trees", repository)
+                if not log_failure(cmd, "Creating shared repository {}".format(repository)):
+                    return None
+            if os.path.exists(mirror):
+                cmd = ("bzr", "pull", "--overwrite", "-d", mirror, self.source)
+            else:
+                cmd = ("bzr", "branch", "--no-tree", self.source, mirror)
+            if not log_failure(cmd, "Fetching new revisions of {} into {}".format(
+                    self.source, repository)):
+                return None
+            repos.refreshed.add(mirror)
+            repos.touch(self.source)
+        return mirror
 
     def revno_branch(self, dest, revno):
         cmd = ('bzr', 'update', dest, '-r', revno)
-        return log_failure(cmd, "Checking out revision {} of {}".format(revno, self.source))
+        with phase("update"):
+            return log_failure(cmd, "Checking out revision {} of {}".format(revno, self.source))
 
     def normalize_lp_branch(self, branch):
-        if branch.startswith(('lp:','nosmart+lp:')):
-            if not '~' in branch:
-                branch = branch.replace('lp:', 'lp:+branch/')
-            branch = branch.replace('lp:', 'bzr+ssh://bazaar.launchpad.net/')
-        return branch
+        return bzrutils.normalize_lp_branch(branch)
+
+    @property
+    def probes(self):
+        "The build's shared BzrProbes, or one of our own outside a build"
+        if self.context is not None:
+            return self.context.bzr_probes
+        if getattr(self, "_probes", None) is None:
+            self._probes = bzrutils.BzrProbes()
+        return self._probes
+
+    def update_pinned_branch(self, dest, revno):
+        """Bring an existing branch to revno, fetching only what is missing.
+        A tree that is already at revno is left alone."""
+        try:
+            target = int(revno)
+        except ValueError:
+            # A revision spec such as tag:foo; it can only be resolved by
+            # fetching from the source
+            target = None
+        if target is not None:
+            with phase("probe"):
+                state = self.probes.local(dest)
+                at_target = state.has_tree and bzrutils.tree_revno(dest) == target
+            if at_target:
+                logging.info("{} is already at revision {}".format(dest, revno))
+                return True
+            if state.revno is not None and state.revno >= target:
+                return self.revno_branch(dest, revno)
+        if not self.update_branch(dest, revno):
+            return False
+        return self.revno_branch(dest, revno)
 
     def is_same_branch(self, dest):
         self.source = strip_trailing_slash(self.source).strip()
         self.source = self.normalize_lp_branch(self.source)
-        bzr_cmd = ("bzr", "info", dest)
-        grep_cmd = ("grep", "parent branch")
-        bzr_call = Popen(bzr_cmd, stdout=PIPE)
-        grep_call = Popen(grep_cmd, stdin=bzr_call.stdout, stdout=PIPE)
-        bzr_call.stdout.close()
-        output = grep_call.communicate()[0].strip()
-        if output:
-            title, upstream = output.split(":", 1)
-            self.dest_source = strip_trailing_slash(upstream).strip()
-            return self.dest_source == self.source
-        return False
+        with phase("probe"):
+            self.dest_source = self.probes.local(dest).parent
+        if self.dest_source is None:
+            return False
+        return self.dest_source == bzrutils.normalize_location(self.source)
 
     def is_bzr_branch(self, branch):
-        branch = self.normalize_lp_branch(branch)
-        bzr_cmd = ("bzr", "revno", branch)
-        devnull = open('/dev/null', 'w')
+        with phase("probe"):
+            if os.path.exists(branch):
+                return self.probes.local(branch).is_branch
+            branch = self.normalize_lp_branch(branch)
+            return self.probes.remote_revno(branch) is not None
+
+    def check_source(self):
+        if not self.is_bzr_branch(self.source):
+            raise NotABranch("{} is not a bzr branch. Is it a private branch? Check permissions on the branch.".format(self.source))
+
+    def source_fingerprint(self, options):
+        revno = options.get("revno", "")
+        if revno.isdigit():
+            return "revno:" + revno
         try:
-           check_call(bzr_cmd, stdout=devnull)
-           return True
-        except CalledProcessError as e:
-            if e.returncode == 3:
-                return False
-            else:
-                raise e
+            revision = self.probes.remote_revision(
+                self.normalize_lp_branch(strip_trailing_slash(self.source)))
+        except CalledProcessError:
+            return None
+        if revision is None:
+            return None
+        return "{} {}".format(*revision)
+
+    def dest_fingerprint(self, dest, options, exclude=()):
+        if self.mode(options) == "export":
+            exported = bzrutils.read_export(dest)
+            if exported is None:
+                return None
+            return "export {source} {revno} {revid}".format(**exported)
+        state = self.probes.local(dest)
+        if not state.is_branch or (state.revid is None and state.checkout_of is None):
+            return None
+        try:
+            dirstate = os.stat(os.path.join(dest, ".bzr", "checkout", "dirstate"))
+        except OSError:
+            return None
+        return "{} {} {} {!r}".format(state.parent, state.revid,
+                                      dirstate.st_size, dirstate.st_mtime)
 
     def get(self, dest, options=None):
         if not options:
             options = {}
-        if not self.is_bzr_branch(self.source):
-            raise NotABranch("{} is not a bzr branch. Is it a private branch? Check permissions on the branch.".format(self.source))
+        revno = options.get("revno")
+        mode = self.mode(options)
+        if mode not in self.modes:
+            logging.error("Unknown mode {} for {}, expected one of {}".format(
+                mode, dest, ", ".join(self.modes)))
+            return False
+        try:
+            paths = PathFilter.from_options(options)
+        except FilterError as e:
+            logging.error(str(e))
+            return False
+        if paths is not None and mode != "export":
+            logging.error("Only exports of {} can be partial, not a {} in {}".format(
+                self.source, mode, dest))
+            return False
+        if mode == "export":
+            return self.get_export(dest, revno, options.get("overwrite"), paths)
+        lightweight = mode == "lightweight"
+        checkout = self.checkout_lightweight if lightweight else self.checkout_branch
         if os.path.exists(dest):
             if not self.is_bzr_branch(dest):
                 raise NotABranch("{} is not a bzr branch, it may be an empty directory".format(dest))
-                return False
-            # if the parent is the same, update the branch
-            if self.is_same_branch(dest):
+            # if the parent is the same, update the branch. The parent
+            # proves that the source was a branch, so it is not probed; the
+            # pull reports it if that is no longer true.
+            same_branch = self.is_same_branch(dest)
+            if same_branch and self.is_lightweight(dest) == lightweight:
+                if lightweight:
+                    return self.update_checkout(dest, revno)
+                if revno is not None:
+                    return self.update_pinned_branch(dest, revno)
                 if not self.update_branch(dest):
                     return False
             elif options.get("overwrite"):
+                self.check_source()
                 logging.info("Overwriting {}".format(dest))
                 shutil.rmtree(dest)
-                if not self.checkout_branch(dest):
+                if not checkout(dest, revno):
                     return False
+            elif same_branch:
+                raise NotSameBranch("{} failed: it is not a {} of {}".format(
+                    dest, "lightweight checkout" if lightweight else "branch", self.source))
             else:
                 raise NotSameBranch("{} failed: {} and {} do not match".format(dest, self.dest_source, self.source))
         else:
-            if not self.checkout_branch(dest):
+            self.check_source()
+            if not checkout(dest, revno):
                 return False
-        if "revno" in options:
-            self.revno_branch(dest, options["revno"])
 
         return True
 
+    def is_lightweight(self, dest):
+        with phase("probe"):
+            return self.probes.local(dest).checkout_of is not None
+
+    def get_export(self, dest, revno, overwrite, paths=None):
+        if os.path.exists(dest):
+            exported = bzrutils.read_export(dest)
+            if exported is None:
+                if not overwrite:
+                    raise NotABranch("{} is not a bzr export".format(dest))
+            elif exported["source"] != self.export_source():
+                if not overwrite:
+                    raise NotSameBranch("{} failed: {} and {} do not match".format(
+                        dest, exported["source"], self.source))
+            else:
+                return self.export(dest, revno, paths)
+            self.check_source()
+            logging.info("Overwriting {}".format(dest))
+            fileutils.remove(dest)
+        else:
+            self.check_source()
+        return self.export(dest, revno, paths)
+
+
+class GitSourceHandler(SourceHandler):
+    """Check out a git working tree. The branch, tag or rev option selects
+    what is checked out; by default it is the source's HEAD.
+
+    Without a GitCache only the selected commit is fetched, as a shallow
+    clone. With one, the source is mirrored in the cache and the working
+    tree borrows its objects from the mirror.
+
+    include and exclude make a sparse checkout, whose working tree only
+    has the selected files. path is not supported, as files can't be moved
+    out of their place in a working tree."""
+
+    schemes = (
+        "git",
+        "git+ssh",
+        "git+http",
+        "git+https",
+        "git+file",
+    )
+
+    def __init__(self, source):
+        super(GitSourceHandler, self).__init__(source)
+        if source.startswith("git+"):
+            self.source = source[len("git+"):]
+
+    @staticmethod
+    def target(options):
+        "(ref to check out, local branch to check it out on)"
+        if options.get("rev"):
+            return options["rev"], None
+        if options.get("tag"):
+            return "refs/tags/" + options["tag"], None
+        if options.get("branch"):
+            return "refs/heads/" + options["branch"], options["branch"]
+        return "HEAD", None
+
+    def init_tree(self, dest):
+        parent_dir = os.path.dirname(dest)
+        if parent_dir and not os.path.exists(parent_dir):
+            os.makedirs(parent_dir)
+        with phase("fetch"):
+            return self._init_tree(dest)
+
+    def _init_tree(self, dest):
+        if not log_failure(("git", "init", "-q", dest),
+                           "Cloning {} to {}".format(self.source, dest)):
+            return False
+        return log_failure(("git", "-C", dest, "remote", "add", "origin", self.source),
+                           "Setting origin of {} to {}".format(dest, self.source))
+
+    def add_alternate(self, dest, mirror):
+        "Let dest use the objects of mirror"
+        alternates = os.path.join(dest, ".git", "objects", "info", "alternates")
+        objects = os.path.join(os.path.abspath(mirror), "objects")
+        try:
+            with open(alternates) as f:
+                if objects in f.read().splitlines():
+                    return
+        except IOError:
+            fileutils.mkdir(os.path.dirname(alternates))
+        with open(alternates, "a") as f:
+            f.write(objects + "\n")
+
+    def fetch(self, dest, ref):
+        """Make the commit of ref available in dest. Returns a name for it
+        that dest can check out, or None on failure."""
+        with phase("fetch"):
+            return self._fetch(dest, ref)
+
+    def _fetch(self, dest, ref):
+        cache = getattr(self.context, "git_cache", None)
+        if cache is not None:
+            logging.info("Fetching new objects of {} into {}".format(
+                self.source, cache.mirror(self.source)))
+            try:
+                mirror = cache.update(self.source)
+            except CalledProcessError as e:
+                logging.error(e.output)
+                return None
+            self.add_alternate(dest, mirror)
+            commit = cache.resolve(self.source, ref)
+            if commit is None:
+                logging.error("{} has no {}".format(self.source, ref))
+            return commit
+
+        cmd = ("git", "-C", dest, "fetch", "-q", "--depth", "1", "origin", ref)
+        logging.info("Fetching {} of {} into {}".format(ref, self.source, dest))
+        try:
+            check_output(cmd, stderr=STDOUT)
+            return "FETCH_HEAD"
+        except CalledProcessError as e:
+            if not gitutils.is_sha(ref) and ref.startswith(("refs/", "HEAD")):
+                logging.error(e.output)
+                return None
+        # Servers may refuse to send a single commit by its id, and an
+        # abbreviated id can only be resolved locally: fetch all history
+        cmd = ("git", "-C", dest, "fetch", "-q", "origin")
+        if os.path.exists(os.path.join(dest, ".git", "shallow")):
+            cmd += ("--unshallow",)
+        if not log_failure(cmd, "Fetching the history of {}".format(self.source)):
+            return None
+        return ref
+
+    @staticmethod
+    def sparse_patterns(paths):
+        "The sparse-checkout file selecting what the PathFilter paths does"
+        def anchored(pattern):
+            return "/" + pattern if "/" in pattern else pattern
+        patterns = [anchored(p) for p in paths.include] if paths else []
+        patterns = patterns or ["/*"]
+        if paths:
+            patterns += ["!" + anchored(p) for p in paths.exclude]
+        return "".join(p + "\n" for p in patterns)
+
+    def set_sparse(self, dest, paths):
+        """Limit the working tree of dest to what paths selects (everything
+        if it is None). Returns True if the working tree must be updated."""
+        sparse = os.path.join(dest, ".git", "info", "sparse-checkout")
+        try:
+            with open(sparse) as f:
+                current = f.read()
+        except IOError:
+            current = None
+        wanted = self.sparse_patterns(paths)
+        if (paths is None and current is None) or current == wanted:
+            return False
+        fileutils.mkdir(os.path.dirname(sparse))
+        with fileutils.atomic_write(sparse, "w") as f:
+            f.write(wanted)
+        return log_failure(("git", "-C", dest, "config", "core.sparseCheckout", "true"),
+                           "Selecting the files of {} to check out".format(dest))
+
+    def checkout(self, dest, options, paths=None):
+        ref, branch = self.target(options)
+        sparse_changed = self.set_sparse(dest, paths)
+        if gitutils.is_sha(ref) and gitutils.read_head(dest) == ref:
+            logging.info("{} is already at {}".format(dest, ref))
+            return not sparse_changed or self.update_sparse(dest)
+        commit = self.fetch(dest, ref)
+        if commit is None:
+            return False
+        cmd = ("git", "-C", dest, "checkout", "-q")
+        if branch is not None:
+            cmd += ("-B", branch, commit)
+        else:
+            cmd += ("--detach", commit)
+        with phase("update"):
+            if not log_failure(cmd, "Checking out {} in {}".format(ref, dest)):
+                return False
+        return not sparse_changed or self.update_sparse(dest)
+
+    def update_sparse(self, dest):
+        "Add and remove files of dest to match its sparse-checkout patterns"
+        with phase("update"):
+            return log_failure(("git", "-C", dest, "read-tree", "-mu", "HEAD"),
+                               "Updating the checked out files of {}".format(dest))
+
+    def source_fingerprint(self, options):
+        ref, branch = self.target(options)
+        if gitutils.is_sha(ref):
+            return "rev:" + ref
+        if ref == options.get("rev"):
+            return None
+        try:
+            commit = gitutils.ls_remote(self.source, ref)
+        except CalledProcessError:
+            return None
+        return commit and "{} {}".format(ref, commit)
+
+    def dest_fingerprint(self, dest, options, exclude=()):
+        head = gitutils.read_head(dest)
+        if head is None:
+            return None
+        try:
+            index = os.stat(os.path.join(dest, ".git", "index"))
+        except OSError:
+            return None
+        return "{} {} {} {!r}".format(gitutils.remote_url(dest), head,
+                                      index.st_size, index.st_mtime)
+
+    def get(self, dest, options=None):
+        if not options:
+            options = {}
+        try:
+            paths = PathFilter.from_options(options)
+        except FilterError as e:
+            logging.error(str(e))
+            return False
+        if paths is not None and paths.path:
+            logging.error("path is not supported for git sources, use include "
+                          "to check out part of {} in {}".format(self.source, dest))
+            return False
+        if os.path.exists(dest):
+            if gitutils.git_dir(dest) is None:
+                raise NotABranch("{} is not a git working tree, it may be an empty directory".format(dest))
+            with phase("probe"):
+                origin = gitutils.remote_url(dest)
+            if origin != self.source:
+                if not options.get("overwrite"):
+                    raise NotSameBranch("{} failed: {} and {} do not match".format(dest, origin, self.source))
+                logging.info("Overwriting {}".format(dest))
+                shutil.rmtree(dest)
+                if not self.init_tree(dest):
+                    return False
+        elif not self.init_tree(dest):
+            return False
+        return self.checkout(dest, options, paths)
+
+
+# Returned by HttpFileHandler.open when a conditional request matched
+NOT_MODIFIED = object()
+# Returned by HttpFileHandler.open when a Range request was refused
+RANGE_NOT_SATISFIABLE = object()
+
 
 class HttpFileHandler(SourceHandler):
     """Download plain files via http(s)"""
@@ -168,36 +727,335 @@ class HttpFileHandler(SourceHandler):
         "https",
     )
 
+    lane = "http"
+
+    # Bytes held in memory at once while streaming a download to disk.
+    # Override per directive with the buffer-size option.
+    buffer_size = 64 * 1024
+
+    # Times an interrupted download is resumed (or restarted, if the server
+    # can't resume it) before giving up. Override with the retries option.
+    retries = 3
+    # Seconds to wait before the first retry; doubled for each further one
+    retry_delay = 1
+
     def get(self, dest, options=None):
+        with phase("fetch"):
+            return self._get(dest, options)
+
+    def _get(self, dest, options=None):
         if not options:
             options = {}
-        if os.path.exists(dest):
-            if options.get("overwrite"):
-                os.unlink(dest)
+        try:
+            pinned = checksum.pins(options)
+            paths = PathFilter.from_options(options)
+        except (checksum.ChecksumError, FilterError) as e:
+            logging.error(str(e))
+            return False
+        if paths is not None and not options.get("extract"):
+            logging.error("Only archives can be partially extracted, {} is a file".format(
+                self.source))
+            return False
+        exists = os.path.exists(dest)
+        if exists and pinned and not options.get("extract"):
+            with phase("probe"):
+                matches = checksum.matches(dest, pinned, self.hash_cache)
+            if matches:
+                logging.info("{} matches its checksum, skipping download".format(dest))
+                return True
+            logging.warning("{} does not match its checksum".format(dest))
+        if exists and not options.get("overwrite"):
+            logging.info("Skipping existing dest {}".format(dest))
+            return False
+        bufsize = fileutils.parse_size(options.get("buffer-size", self.buffer_size))
+        if options.get("extract"):
+            return self.extract(dest, options, bufsize, pinned, paths)
+        store = getattr(self.context, "store", None)
+        if store is not None:
+            return self.get_via_store(store, dest, bufsize, pinned,
+                                      int(options.get("retries", self.retries)))
+
+        # A dest that failed its checksum must not be revalidated
+        validators = self.validators(dest) if exists and not pinned else {}
+        return self.download(dest, bufsize, validators,
+                             int(options.get("retries", self.retries)), pinned)
+
+    @property
+    def hash_cache(self):
+        return getattr(self.context, "hash_cache", None)
+
+    def record_checksums(self, dest, hashers):
+        if hashers is not None and self.hash_cache is not None:
+            for algorithm, digest in hashers.digests().items():
+                self.hash_cache.record(dest, algorithm, digest)
+
+    def download(self, dest, bufsize, validators, retries, pinned=None):
+        """Download the source to dest. An interrupted download is kept
+        beside dest and resumed by the next attempt, if the server supports
+        ranges; dest is only replaced once the download is complete, and
+        has every checksum in pinned."""
+        part = PartialDownload(dest, self.source)
+        failures = 0
+        while True:
+            headers = dict(validators, **part.range_headers())
+            if part.resumable:
+                logging.info("Resuming download of {} to {} at byte {}".format(
+                    self.source, dest, part.size))
             else:
-                logging.info("Skipping existing dest {}".format(dest))
+                logging.info("Downloading {} to {}".format(self.source, dest))
+            response = self.open(headers or None)
+            if response is None:
                 return False
-        logging.info("Downloading {} to {}".format(self.source, dest))
+            if response is NOT_MODIFIED:
+                part.discard()
+                logging.info("{} is unchanged, keeping {}".format(self.source, dest))
+                return True
+            if response is RANGE_NOT_SATISFIABLE:
+                part.discard()
+                continue
+            try:
+                transferred(part.write(response, bufsize, pinned))
+            except DownloadInterrupted as e:
+                if not part.resumable:
+                    part.discard()
+                failures += 1
+                if failures > retries:
+                    logging.error("Failed to download {}: {}".format(self.source, e))
+                    return False
+                logging.warning("Download of {} interrupted, retrying: {}".format(
+                    self.source, e))
+                time.sleep(self.retry_delay * 2 ** (failures - 1))
+                continue
+            except (IOError, OSError) as e:
+                # Writing the download failed: a missing directory, no
+                # permission or no space won't be fixed by trying again
+                logging.error("Failed to download {}: {}".format(self.source, e))
+                return False
+            finally:
+                response.close()
+            if part.hashers is not None:
+                try:
+                    part.hashers.check(self.source)
+                except checksum.ChecksumError as e:
+                    part.discard()
+                    logging.error(str(e))
+                    return False
+            part.finish()
+            self.record_validators(dest, response)
+            self.record_checksums(dest, part.hashers)
+            return True
+
+    def extract(self, dest, options, bufsize, pinned=None, paths=None):
+        """Stream the archive at the source URL into the directory dest, or
+        the members of it that the PathFilter paths selects. An archive that
+        doesn't have the checksums in pinned is not extracted."""
+        logging.info("Extracting {} to {}".format(self.source, dest))
+        response = self.open()
+        if response is None:
+            return False
+        stream, verify = response, None
+        if pinned:
+            stream = checksum.HashingReader(response, checksum.Hashers(pinned))
+
+            def verify():
+                stream.drain(bufsize)
+                stream.hashers.check(self.source)
         try:
-            response = urllib2.urlopen(self.source)
+            transferred(archive.extract(stream, dest, options.get("format"),
+                                        int(options.get("strip-components", 0)),
+                                        bufsize, verify, paths))
+        except (archive.ArchiveError, checksum.ChecksumError, IOError, socket.error) as e:
+            logging.error("Failed to extract {}: {}".format(self.source, e))
+            return False
+        finally:
+            response.close()
+        return True
+
+    def source_fingerprint(self, options):
+        try:
+            pinned = checksum.pins(options)
+        except checksum.ChecksumError:
+            return None
+        if pinned:
+            # Pinned content can't change
+            return " ".join("{}:{}".format(*pin) for pin in sorted(pinned.items()))
+        with phase("probe"):
+            response = self.open(method="HEAD")
+        if response is None:
+            return None
+        response.read()
+        response.close()
+        headers = response.info()
+        if not (headers.get("ETag") or headers.get("Last-Modified")):
+            return None
+        return "{} {} {}".format(headers.get("ETag"), headers.get("Last-Modified"),
+                                 headers.get("Content-Length"))
+
+    def open(self, headers=None, method="GET"):
+        """Request the source URL. Returns the response, NOT_MODIFIED for a
+        conditional request that matched, or None on failure."""
+        pool = getattr(self.context, "http_pool", None)
+        try:
+            if pool is not None and pool.can_open(self.source):
+                return pool.urlopen(self.source, headers, method)
+            if headers or method != "GET":
+                request = urllib2.Request(self.source, headers=headers or {})
+                request.get_method = lambda: method
+                return urllib2.urlopen(request)
+            return urllib2.urlopen(self.source)
+        except urllib2.HTTPError as e:
+            if e.code == 304 and headers:
+                return NOT_MODIFIED
+            if e.code == 416 and headers and "Range" in headers:
+                return RANGE_NOT_SATISFIABLE
+            logging.error("Failed to download {}: {}".format(self.source, e.reason))
         except urllib2.URLError as e:
             logging.error("Failed to download {}: {}".format(self.source, e.reason))
+        return None
+
+    def get_via_store(self, store, dest, bufsize, pinned=None, retries=retries):
+        """Materialize dest from the shared download store. A pinned source
+        is only downloaded if the store doesn't hold its content already."""
+        if pinned and "sha256" in pinned and self.stored_matches(store, pinned):
+            if store.materialize(pinned["sha256"], dest):
+                if self.hash_cache is not None:
+                    self.hash_cache.record(dest, "sha256", pinned["sha256"])
+                logging.info("Using stored copy of {} for {}".format(self.source, dest))
+                return True
+        entry = None if pinned else store.lookup(self.source)
+        headers = {}
+        if entry:
+            if store.is_fresh(entry) and store.materialize(entry["digest"], dest):
+                logging.info("Using stored copy of {} for {}".format(self.source, dest))
+                return True
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        logging.info("Downloading {} to {}".format(self.source, dest))
+        response = self.open(headers)
+        if response is NOT_MODIFIED:
+            if store.materialize(entry["digest"], dest):
+                store.record(self.source, entry["digest"], {
+                    "ETag": entry["etag"], "Last-Modified": entry["last_modified"]})
+                logging.info("{} is unchanged, using stored copy for {}".format(
+                    self.source, dest))
+                return True
+            # Evicted by another build since it was looked up
+            response = self.open()
+        if response is None:
+            return False
+        hashers = checksum.Hashers(pinned) if pinned else None
+        try:
+            stream = checksum.HashingReader(response, hashers) if pinned else response
+            digest, size = store.add_stream(stream, bufsize)
+            transferred(size)
+            if hashers is not None:
+                hashers.check(self.source)
+        except (IOError, socket.error, checksum.ChecksumError) as e:
+            logging.error("Failed to download {}: {}".format(self.source, e))
             return False
-        with open(dest, "w") as f:
-            f.write(response.read())
+        finally:
+            response.close()
+        store.record(self.source, digest, response.info())
+        if not store.materialize(digest, dest):
+            # Evicted by another build before it could be copied
+            logging.warning("{} was evicted from the store, downloading it to {}".format(
+                self.source, dest))
+            return self.download(dest, bufsize, {}, retries, pinned)
+        self.record_checksums(dest, hashers)
         return True
 
+    def stored_matches(self, store, pinned):
+        """True if the store holds the blob named by the sha256 in pinned,
+        and it has the other pinned checksums too. Blobs are named by their
+        sha256, so only the other pins need checking, before dest is touched."""
+        others = dict((algorithm, digest) for algorithm, digest in pinned.items()
+                      if algorithm != "sha256")
+        blob = store.blob_path(pinned["sha256"])
+        try:
+            return os.path.exists(blob) and checksum.matches(blob, others, self.hash_cache)
+        except (IOError, OSError):
+            # Evicted meanwhile
+            return False
+
+    def validators(self, dest):
+        "Conditional request headers for refreshing an existing dest"
+        if self.context is None:
+            return {}
+        return self.context.http_metadata.validators(self.source, dest)
+
+    def record_validators(self, dest, response):
+        if self.context is None:
+            return
+        self.context.http_metadata.update(self.source, response.info(), dest)
+
+
+class ArchiveHandler(SourceHandler):
+    """Download a tar or zip archive via http(s) and extract it. The same
+    as an http(s) source with extract=true."""
+
+    schemes = (
+        "archive+http",
+        "archive+https",
+    )
+
+    lane = "http"
+
+    def __init__(self, source):
+        super(ArchiveHandler, self).__init__(source)
+        self.source = source[len("archive+"):]
+
+    @property
+    def http(self):
+        handler = HttpFileHandler(self.source)
+        handler.context = self.context
+        return handler
+
+    def source_fingerprint(self, options):
+        return self.http.source_fingerprint(options)
+
+    def get(self, dest, options=None):
+        options = dict(options or {}, extract=True)
+        return self.http.get(dest, options)
+
 
 class LocalHandler(SourceHandler):
     """Copy local files. The special source '@' indicates that the destination
-    is a directory."""
+    is a directory.
+
+    The default copy method runs in-process and skips files that are
+    unchanged; method=rsync runs rsync instead. method=dedupe links files
+    to copies in the content store, shared by every identical file.
+
+    path, include and exclude select part of a source directory; only the
+    directories that may hold selected files are visited. Links can only
+    be made to a whole path."""
 
     schemes = (
         '',
         'file',
     )
 
+    def source_fingerprint(self, options):
+        if self.source == "@":
+            return "@"
+        if options.get("path"):
+            return fileutils.tree_summary(os.path.join(self.source, options["path"]))
+        return fileutils.tree_summary(self.source)
+
+    def watch_path(self):
+        if self.source == "@":
+            return None
+        parsed = urlparse(self.source)
+        return parsed.path if parsed.scheme == "file" else self.source
+
     def get(self, dest, options=None):
+        with phase("copy"):
+            return self._get(dest, options)
+
+    def _get(self, dest, options=None):
         if not options:
             options = {}
 
@@ -206,20 +1064,45 @@ class LocalHandler(SourceHandler):
             fileutils.mkdir(dest, overwrite=options.get("overwrite", False))
             return True
 
+        try:
+            paths = PathFilter.from_options(options)
+        except FilterError as e:
+            logging.error(str(e))
+            return False
+        source = self.source
+        selected = {}
+        if paths is not None:
+            source = paths.root(self.source)
+            if not os.path.isdir(self.source) or not os.path.exists(source):
+                logging.error("{} has no {} to copy to {}".format(
+                    self.source, paths.path or "directory", dest))
+                return False
+            if paths.filtering:
+                selected["paths"] = paths
+
         method = options.get("method", "copy")
+        if selected and method in ("link", "hardlink"):
+            logging.error("Only whole paths can be linked, not part of {} to {}".format(
+                source, dest))
+            return False
         if method == "copy":
-            logging.info("Copying {} to {}".format(self.source, dest))
-            fileutils.copy(self.source, dest)
+            logging.info("Copying {} to {}".format(source, dest))
+            transferred(fileutils.copy(source, dest, **selected).bytes)
         elif method == "rsync":
-            logging.info("Rsyncing {} to {}".format(self.source, dest))
-            fileutils.rsync(self.source, dest)
+            logging.info("Rsyncing {} to {}".format(source, dest))
+            fileutils.rsync(source, dest, **selected)
+        elif method == "dedupe":
+            logging.info("Linking {} to {} through the store".format(source, dest))
+            dedupe = getattr(self.context, "dedupe", None)
+            transferred(fileutils.sync(source, dest, delete=False, dedupe=dedupe,
+                                       **selected).bytes)
         elif method == "link":
-            logging.info("Creating symbolic link {} to {}".format(dest, self.source))
-            fileutils.link(self.source, dest, overwrite=options.get(
+            logging.info("Creating symbolic link {} to {}".format(dest, source))
+            fileutils.link(source, dest, overwrite=options.get(
                 "overwrite", True))
         elif method == "hardlink":
-            logging.info("Creating hard link {} to {}".format(dest, self.source))
-            fileutils.link(self.source, dest, symbolic=False)
+            logging.info("Creating hard link {} to {}".format(dest, source))
+            fileutils.link(source, dest, symbolic=False)
 
         return True
 
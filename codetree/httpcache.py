@@ -0,0 +1,98 @@
+import os
+import json
+import fcntl
+import logging
+import threading
+
+import fileutils
+
+
+class HttpMetadataCache(object):
+    """Persistent record of the validators (ETag, Last-Modified) and size of
+    each downloaded URL, and of the files that were written from it.
+
+    The cache is shared by every codetree process that uses the same cache
+    directory. Entries are merged into the file on disk when saved, so
+    concurrent builds only lose each other's updates to the same URL."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.dirty = set()
+        self.entries = self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except IOError:
+            return {}
+        except ValueError:
+            logging.warning("Ignoring corrupt HTTP metadata cache {}".format(self.path))
+            return {}
+
+    def validators(self, url, dest):
+        """Return request headers that make a fetch of url conditional, if
+        dest is still the file that was downloaded from it"""
+        with self.lock:
+            entry = self.entries.get(url)
+            if not entry:
+                return {}
+            try:
+                stat = os.stat(dest)
+            except OSError:
+                return {}
+            recorded = entry["dests"].get(os.path.abspath(dest))
+            if stat.st_size != entry["size"] or recorded != stat.st_mtime:
+                return {}
+            headers = {}
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+            return headers
+
+    def update(self, url, headers, dest):
+        "Record the response headers of a completed download of url to dest"
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        stat = os.stat(dest)
+        with self.lock:
+            entry = self.entries.get(url)
+            if (not entry or entry["etag"] != etag or
+                    entry["last_modified"] != last_modified or
+                    entry["size"] != stat.st_size):
+                if not (etag or last_modified):
+                    # Nothing to revalidate with next time
+                    if self.entries.pop(url, None) is not None:
+                        self.dirty.add(url)
+                    return
+                entry = self.entries[url] = {
+                    "etag": etag,
+                    "last_modified": last_modified,
+                    "size": stat.st_size,
+                    "dests": {},
+                }
+            # Files that are gone (e.g. with their build generation) are forgotten
+            entry["dests"] = dict((path, mtime) for path, mtime in entry["dests"].items()
+                                  if os.path.exists(path))
+            entry["dests"][os.path.abspath(dest)] = stat.st_mtime
+            self.dirty.add(url)
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            fileutils.mkdir(os.path.dirname(self.path))
+            with open(self.path + ".lock", "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                entries = self.load()
+                for url in self.dirty:
+                    if url in self.entries:
+                        entries[url] = self.entries[url]
+                    else:
+                        entries.pop(url, None)
+                with fileutils.atomic_write(self.path, "w") as f:
+                    json.dump(entries, f, indent=1, sort_keys=True)
+            self.entries = entries
+            self.dirty = set()
@@ -0,0 +1,145 @@
+from urlparse import urlparse, urljoin
+import httplib
+import socket
+import threading
+import urllib
+import urllib2
+import logging
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 10
+
+
+class PooledResponse(object):
+    """A response whose connection goes back to its pool once the body has
+    been read and the response is closed"""
+
+    def __init__(self, pool, key, connection, response, url):
+        self.pool = pool
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.url = url
+        self.code = response.status
+
+    def read(self, amt=None):
+        return self.response.read(amt)
+
+    def info(self):
+        return self.response.msg
+
+    def getcode(self):
+        return self.code
+
+    def geturl(self):
+        return self.url
+
+    def close(self):
+        if self.connection is None:
+            return
+        # Only a fully read response leaves the connection ready for reuse
+        reusable = self.response.isclosed() and not self.response.will_close
+        self.pool.release(self.key, self.connection, reusable)
+        self.connection = None
+
+
+class ConnectionPool(object):
+    """Persistent HTTP(S) connections, shared by every HTTP directive of a
+    Config. At most max_per_host connections to each host are open at once;
+    further requests for that host wait for one to be released."""
+
+    def __init__(self, max_per_host=4, timeout=60):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.slots = {}
+        self.opened = 0
+        self.reused = 0
+
+    def can_open(self, url):
+        "Requests through a proxy are left to urllib2"
+        parsed = urlparse(url)
+        if parsed.scheme not in ("http", "https"):
+            return False
+        return not (parsed.scheme in urllib.getproxies() and
+                    not urllib.proxy_bypass(parsed.hostname))
+
+    def acquire(self, key):
+        with self.lock:
+            slot = self.slots.setdefault(key, threading.Semaphore(self.max_per_host))
+        slot.acquire()
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle:
+                self.reused += 1
+                return idle.pop(), True
+            self.opened += 1
+        scheme, host, port = key
+        if scheme == "https":
+            return httplib.HTTPSConnection(host, port, timeout=self.timeout), False
+        return httplib.HTTPConnection(host, port, timeout=self.timeout), False
+
+    def release(self, key, connection, reusable):
+        if reusable:
+            with self.lock:
+                self.idle.setdefault(key, []).append(connection)
+        else:
+            connection.close()
+        self.slots[key].release()
+
+    def request(self, url, headers, method="GET"):
+        parsed = urlparse(url)
+        key = (parsed.scheme, parsed.hostname, parsed.port)
+        path = parsed.path or "/"
+        if parsed.query:
+            path += "?" + parsed.query
+        connection, reused = self.acquire(key)
+        try:
+            try:
+                connection.request(method, path, headers=headers)
+                response = connection.getresponse()
+            except (httplib.HTTPException, socket.error):
+                if not reused:
+                    raise
+                # The server closed the idle connection; start a fresh one
+                with self.lock:
+                    self.reused -= 1
+                    self.opened += 1
+                connection.close()
+                connection.request(method, path, headers=headers)
+                response = connection.getresponse()
+        except (httplib.HTTPException, socket.error) as e:
+            self.release(key, connection, False)
+            raise urllib2.URLError(e)
+        return PooledResponse(self, key, connection, response, url)
+
+    def urlopen(self, url, headers=None, method="GET"):
+        """Fetch url, following redirects. Behaves like urllib2.urlopen:
+        non-2xx responses are raised as urllib2.HTTPError."""
+        headers = dict(headers or {})
+        for i in range(MAX_REDIRECTS + 1):
+            response = self.request(url, headers, method)
+            if 200 <= response.code < 300:
+                return response
+            # Drain the body so that the connection can be reused
+            response.read()
+            response.close()
+            location = response.info().get("Location")
+            if response.code in REDIRECT_CODES and location:
+                url = urljoin(url, location)
+                continue
+            raise urllib2.HTTPError(url, response.code, response.response.reason,
+                                    response.info(), None)
+        raise urllib2.HTTPError(url, response.code, "Too many redirects",
+                                response.info(), None)
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle = {}
+        if self.opened or self.reused:
+            logging.info("HTTP connections: {} opened, {} reused".format(
+                self.opened, self.reused))
@@ -0,0 +1,122 @@
+"""Partial materialization of sources.
+
+Three source options select part of a source tree:
+
+    path=conf                   only the subtree conf, which becomes dest
+    include=*.cfg:templates     only paths matching one of these globs
+    exclude=*.pyc:tests/*       no paths matching any of these globs
+
+Patterns are separated by colons and matched against paths relative to the
+subtree. A pattern without a slash matches a name at any depth, one with a
+slash matches from the top; either way, a directory that matches selects
+(or excludes) everything in it."""
+from fnmatch import fnmatch
+import os
+
+OPTIONS = ("path", "include", "exclude")
+
+
+class FilterError(Exception):
+    pass
+
+
+def split_patterns(value):
+    return [p.strip().strip("/") for p in (value or "").split(":") if p.strip().strip("/")]
+
+
+def matches_any(patterns, relpath):
+    "True if relpath, or a directory it is in, matches one of patterns"
+    parts = relpath.split(os.sep)
+    for i in range(len(parts)):
+        prefix = "/".join(parts[:i + 1])
+        for pattern in patterns:
+            if fnmatch(prefix if "/" in pattern else parts[i], pattern):
+                return True
+    return False
+
+
+class PathFilter(object):
+    "The part of a source selected by the path, include and exclude options"
+
+    def __init__(self, path="", include=(), exclude=()):
+        path = os.path.normpath(path.strip() or os.curdir)
+        if os.path.isabs(path) or path.split(os.sep)[0] == os.pardir:
+            raise FilterError("path must be within the source: {}".format(path))
+        self.path = "" if path == os.curdir else path
+        self.include = list(include)
+        self.exclude = list(exclude)
+
+    @classmethod
+    def from_options(cls, options):
+        "The PathFilter of a directive's options, or None if it has none"
+        if not any(options.get(name) for name in OPTIONS):
+            return None
+        return cls(options.get("path", ""), split_patterns(options.get("include")),
+                   split_patterns(options.get("exclude")))
+
+    @property
+    def filtering(self):
+        "True if files are selected by include or exclude"
+        return bool(self.include or self.exclude)
+
+    def spec(self):
+        "A description of the filter, for comparing with an earlier one"
+        return {"path": self.path, "include": self.include, "exclude": self.exclude}
+
+    def root(self, source):
+        "The selected subtree of the local tree source"
+        return os.path.join(source, self.path) if self.path else source
+
+    def selects(self, relpath):
+        "True if the file relpath, relative to the subtree, is materialized"
+        if matches_any(self.exclude, relpath):
+            return False
+        return not self.include or matches_any(self.include, relpath)
+
+    def may_contain(self, relpath):
+        "True if the directory relpath may hold files that are selected"
+        if matches_any(self.exclude, relpath):
+            return False
+        if not self.include or matches_any(self.include, relpath):
+            return True
+        parts = relpath.split(os.sep)
+        for pattern in self.include:
+            pattern_parts = pattern.split("/")
+            if len(pattern_parts) == 1:
+                # Matches names at any depth
+                return True
+            if len(pattern_parts) > len(parts) and all(
+                    fnmatch(part, pattern_part)
+                    for part, pattern_part in zip(parts, pattern_parts)):
+                return True
+        return False
+
+    def member(self, relpath, directory=False):
+        """Where the path relpath of the whole source goes, relative to
+        dest, or None if it is not materialized"""
+        relpath = os.path.normpath(relpath)
+        if self.path:
+            if not relpath.startswith(self.path + os.sep):
+                return None
+            relpath = relpath[len(self.path) + 1:]
+        if directory:
+            return relpath if self.may_contain(relpath) else None
+        return relpath if self.selects(relpath) else None
+
+    def walk(self, root):
+        """The relative paths of the files and links below the directory
+        root that are selected, visiting only directories that may hold some"""
+        for dirpath, dirnames, filenames in os.walk(root):
+            relpath = os.path.relpath(dirpath, root)
+            for name in list(dirnames):
+                path = os.path.normpath(os.path.join(relpath, name))
+                if os.path.islink(os.path.join(dirpath, name)):
+                    dirnames.remove(name)
+                    if self.selects(path):
+                        yield path
+                elif not self.may_contain(path):
+                    dirnames.remove(name)
+            for name in filenames:
+                path = os.path.normpath(os.path.join(relpath, name))
+                if self.selects(path):
+                    yield path
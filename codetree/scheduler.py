@@ -0,0 +1,181 @@
+import os
+import sys
+import threading
+import Queue
+import logging
+
+# Reported for a directive that was cancelled before it started
+CANCELLED = object()
+
+def is_path_prefix(parent, child):
+    "True if the path parent contains (or is) the path child"
+    parent = os.path.normpath(parent)
+    child = os.path.normpath(child)
+    if parent == os.curdir:
+        return True
+    return child == parent or child.startswith(parent + os.sep)
+
+
+def destinations(directive):
+    """The locations directive writes to: those of its members for a batch
+    of directives, otherwise its own"""
+    return getattr(directive, "locations", None) or (directive.location,)
+
+
+def dependency_graph(directives):
+    """Map each directive to the set of directives that must finish before it
+    may start. A directive depends on every earlier directive whose destination
+    is a prefix of its own (app must be built before app/plugins/woohoo)."""
+    prerequisites = {}
+    for i, directive in enumerate(directives):
+        own = destinations(directive)
+        prerequisites[directive] = set(
+            other for other in directives[:i]
+            if any(is_path_prefix(parent, child)
+                   for parent in destinations(other) for child in own))
+    return prerequisites
+
+
+class Scheduler(object):
+    """Run directives concurrently on a bounded pool of worker threads,
+    honoring the destination-prefix dependencies between them.
+
+    Directives must be supplied in build order (shortest destination first),
+    which is also the order in which ready directives are started. Each is
+    run by calling run(directive), which defaults to directive.run().
+
+    Directives that spend their time waiting on the network can be given
+    pools of workers of their own, so that they overlap with each other
+    and with the other directives: lanes maps the name of each such pool
+    to its number of workers, and lane(directive) names the pool of a
+    directive (None for the main pool of jobs workers).
+
+    On KeyboardInterrupt, interrupted() is called before the directives
+    already running are waited for, so that it can stop them."""
+
+    # Seconds between checks for KeyboardInterrupt while waiting for results
+    poll_interval = 0.5
+
+    def __init__(self, directives, jobs=1, fatality=False, run=None, lanes=None,
+                 lane=None, interrupted=None):
+        self.directives = list(directives)
+        self.jobs = max(1, jobs)
+        self.fatality = fatality
+        self.run_directive = run or (lambda directive: directive.run())
+        self.lanes = dict((name, size) for name, size in (lanes or {}).items()
+                          if size > 0)
+        self.lane = lane or (lambda directive: None)
+        self.interrupted = interrupted or (lambda: None)
+        self.cancelled = threading.Event()
+
+    def run(self):
+        if self.jobs == 1 and not any(self.lane(d) in self.lanes
+                                      for d in self.directives):
+            return self.run_serial()
+        return self.run_parallel()
+
+    def run_serial(self):
+        error_free = True
+        for directive in self.directives:
+            if not self.run_directive(directive):
+                error_free = False
+                if self.fatality:
+                    return False
+        return error_free
+
+    def run_parallel(self):
+        prerequisites = dependency_graph(self.directives)
+        dependents = dict((d, []) for d in self.directives)
+        for directive, needs in prerequisites.items():
+            for need in needs:
+                dependents[need].append(directive)
+        order = dict((d, i) for i, d in enumerate(self.directives))
+
+        pools = dict(self.lanes)
+        pools[None] = self.jobs
+        lanes = {}
+        for directive in self.directives:
+            lane = self.lane(directive)
+            lanes[directive] = lane if lane in pools else None
+        queues = dict((name, Queue.Queue()) for name in pools)
+        results = Queue.Queue()
+        error_free = True
+        failure = None
+        in_flight = 0
+        for directive in self.directives:
+            if not prerequisites[directive]:
+                queues[lanes[directive]].put(directive)
+                in_flight += 1
+
+        workers = []
+        try:
+            for name, size in pools.items():
+                needed = sum(1 for lane in lanes.values() if lane == name)
+                for i in range(min(size, needed)):
+                    worker = threading.Thread(
+                        target=self.worker, args=(queues[name], results),
+                        name="codetree-{}-{}".format(name or "worker", i))
+                    worker.daemon = True
+                    worker.start()
+                    workers.append((worker, queues[name]))
+            while in_flight:
+                try:
+                    # Waiting without a timeout can't be interrupted
+                    directive, result, exc_info = results.get(True, self.poll_interval)
+                except Queue.Empty:
+                    continue
+                in_flight -= 1
+                if exc_info is not None:
+                    error_free = False
+                    if failure is None:
+                        failure = exc_info
+                    self.cancel()
+                elif result is CANCELLED:
+                    continue
+                elif not result:
+                    error_free = False
+                    if self.fatality:
+                        self.cancel()
+                if self.cancelled.is_set():
+                    continue
+                ready = []
+                for dependent in dependents[directive]:
+                    prerequisites[dependent].discard(directive)
+                    if not prerequisites[dependent]:
+                        ready.append(dependent)
+                for dependent in sorted(ready, key=order.get):
+                    queues[lanes[dependent]].put(dependent)
+                    in_flight += 1
+        except KeyboardInterrupt:
+            self.cancel()
+            self.interrupted()
+            raise
+        finally:
+            for worker, tasks in workers:
+                tasks.put(None)
+        for worker, tasks in workers:
+            worker.join()
+
+        if failure is not None:
+            raise failure[0], failure[1], failure[2]
+        return error_free
+
+    def cancel(self):
+        if not self.cancelled.is_set():
+            logging.debug("Cancelling directives that have not started")
+        self.cancelled.set()
+
+    def worker(self, tasks, results):
+        while True:
+            directive = tasks.get()
+            if directive is None:
+                return
+            if self.cancelled.is_set():
+                # Still reported, so that the count of outstanding work
+                # stays balanced
+                results.put((directive, CANCELLED, None))
+                continue
+            try:
+                results.put((directive, self.run_directive(directive), None))
+            except Exception:
+                results.put((directive, None, sys.exc_info()))
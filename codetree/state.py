@@ -0,0 +1,77 @@
+import os
+import json
+import logging
+import threading
+
+import fileutils
+
+
+class BuildState(object):
+    """Per-tree record of what each directive produced last time: the
+    fingerprints of its source and destination, and the options it used.
+    A directive whose source and destination still match can be skipped."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except IOError:
+            return {}
+        except ValueError:
+            logging.warning("Ignoring corrupt build state {}".format(self.path))
+            return {}
+
+    def key(self, directive):
+        return os.path.normpath(directive.location)
+
+    def may_be_unchanged(self, directive):
+        """False if directive can't be skipped whatever its source is:
+        it has not been built, or not from the same url and options"""
+        with self.lock:
+            entry = self.entries.get(self.key(directive))
+        return (entry is not None and entry["url"] == directive.url and
+                entry["options"] == directive.source_options)
+
+    def dest_fingerprint(self, directive):
+        # The destinations of nested directives change when they are built
+        return directive.source.dest_fingerprint(directive.dest,
+                                                 directive.source_options,
+                                                 directive.nested)
+
+    def is_unchanged(self, directive, source_fingerprint):
+        if source_fingerprint is None or not self.may_be_unchanged(directive):
+            return False
+        with self.lock:
+            entry = self.entries.get(self.key(directive))
+        if entry is None or entry["source"] != source_fingerprint:
+            return False
+        dest = self.dest_fingerprint(directive)
+        return dest is not None and entry["dest"] == dest
+
+    def record(self, directive, source_fingerprint):
+        "Remember what a successful run of directive produced"
+        dest = self.dest_fingerprint(directive)
+        with self.lock:
+            if source_fingerprint is None or dest is None:
+                self.entries.pop(self.key(directive), None)
+                return
+            self.entries[self.key(directive)] = {
+                "url": directive.url,
+                "options": directive.source_options,
+                "source": source_fingerprint,
+                "dest": dest,
+            }
+
+    def forget(self, directive):
+        with self.lock:
+            self.entries.pop(self.key(directive), None)
+
+    def save(self):
+        with self.lock:
+            with fileutils.atomic_write(self.path, "w") as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
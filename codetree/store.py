@@ -0,0 +1,280 @@
+import os
+import time
+import json
+import stat
+import errno
+import fcntl
+import hashlib
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import fileutils
+from buildprofile import phase
+
+
+class ContentStore(object):
+    """A content-addressed file store shared by every codetree process on a
+    host. Blobs are named by the sha256 of their content, which is computed
+    while they are written, and are materialized into build trees as hard
+    links (or reflinks, or copies across filesystems).
+
+    Layout:
+        objects/ab/abcdef...    read-only blobs
+        access/abcdef...        touched when a blob is used, for LRU eviction
+        urls/<sha1 of url>      JSON: the digest and validators of a URL
+        tmp/                    blobs being written
+        lock                    shared while linking, exclusive while evicting
+    """
+
+    def __init__(self, path, max_size=None, max_age=0):
+        self.path = path
+        self.max_size = max_size
+        # Seconds for which a URL's entry is trusted without revalidation
+        self.max_age = max_age
+        for subdir in ("objects", "access", "urls", "tmp"):
+            fileutils.mkdir(os.path.join(path, subdir))
+
+    @contextmanager
+    def locked(self, exclusive=False):
+        with open(os.path.join(self.path, "lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+
+    def blob_path(self, digest):
+        return os.path.join(self.path, "objects", digest[:2], digest)
+
+    @staticmethod
+    def blob_name(digest, mode=0o444):
+        """The name of the blob of content digest with permissions mode.
+        Blobs are read-only, but keep the execute bits of the files they
+        were made from; plain read-only blobs are named by their digest."""
+        return digest if mode == 0o444 else "{}.{:o}".format(digest, mode)
+
+    def url_path(self, url):
+        return os.path.join(self.path, "urls", hashlib.sha1(url).hexdigest())
+
+    def lookup(self, url):
+        "The recorded entry for url, if its blob is still in the store"
+        try:
+            with open(self.url_path(url)) as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+        try:
+            size = os.path.getsize(self.blob_path(entry["digest"]))
+        except OSError:
+            return None
+        if entry["url"] != url or size != entry["size"]:
+            return None
+        return entry
+
+    def is_fresh(self, entry):
+        return time.time() - entry["checked"] < self.max_age
+
+    def record(self, url, digest, headers=None, **extra):
+        "Point url at the blob digest"
+        headers = headers or {}
+        entry = {
+            "url": url,
+            "digest": digest,
+            "size": os.path.getsize(self.blob_path(digest)),
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "checked": time.time(),
+        }
+        entry.update(extra)
+        with fileutils.atomic_write(self.url_path(url), "w") as f:
+            json.dump(entry, f)
+        return entry
+
+    def add_stream(self, stream, bufsize=64 * 1024, mode=0o444):
+        """Store the contents of file object stream, hashing it as it is
+        written. Returns (blob name, bytes read)."""
+        digest, size, new = self.store_stream(stream, bufsize, mode)
+        return self.blob_name(digest, mode), size
+
+    def add_file(self, path, mode=0o444):
+        """Store the file at path, which is read once. Returns (its sha256,
+        bytes newly written to the store)."""
+        with open(path, "rb") as f:
+            digest, size, new = self.store_stream(f, mode=mode)
+        return digest, size if new else 0
+
+    def store_stream(self, stream, bufsize=64 * 1024, mode=0o444):
+        """Write stream to a blob with permissions mode. Returns (the sha256
+        of its content, bytes read, whether the blob is new)."""
+        sha = hashlib.sha256()
+        size = 0
+        fd, tmp = tempfile.mkstemp(dir=os.path.join(self.path, "tmp"))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                while True:
+                    chunk = stream.read(bufsize)
+                    if not chunk:
+                        break
+                    sha.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            name = self.blob_name(sha.hexdigest(), mode)
+            blob = self.blob_path(name)
+            new = not os.path.exists(blob)
+            if new:
+                os.chmod(tmp, mode)
+                fileutils.mkdir(os.path.dirname(blob))
+                # Identical content may have been stored by another process
+                # meanwhile; either copy is as good as the other
+                os.rename(tmp, blob)
+            else:
+                # The blob stays the one that trees are linked to
+                os.unlink(tmp)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        self.touch(name)
+        return sha.hexdigest(), size, new
+
+    def touch(self, digest):
+        stamp = os.path.join(self.path, "access", digest)
+        with open(stamp, "a"):
+            os.utime(stamp, None)
+
+    def materialize(self, digest, dest):
+        """Make dest a copy of blob digest. Returns the method used, or None
+        if the blob has been evicted."""
+        with phase("copy"), self.locked():
+            blob = self.blob_path(digest)
+            if not os.path.exists(blob):
+                return None
+            try:
+                if os.path.samefile(blob, dest):
+                    self.touch(digest)
+                    return "hardlink"
+            except OSError:
+                pass
+            method = fileutils.materialize(blob, dest)
+            self.touch(digest)
+        return method
+
+    def evict(self):
+        "Remove the least recently used blobs until the store fits max_size"
+        if not self.max_size:
+            return
+        with self.locked(exclusive=True):
+            blobs = []
+            total = 0
+            for dirpath, dirnames, filenames in os.walk(os.path.join(self.path, "objects")):
+                for digest in filenames:
+                    size = os.path.getsize(os.path.join(dirpath, digest))
+                    try:
+                        used = os.path.getmtime(os.path.join(self.path, "access", digest))
+                    except OSError:
+                        used = 0
+                    blobs.append((used, digest, size))
+                    total += size
+            for used, digest, size in sorted(blobs):
+                if total <= self.max_size:
+                    break
+                logging.debug("Evicting {} from the download store".format(digest))
+                for path in (self.blob_path(digest),
+                             os.path.join(self.path, "access", digest)):
+                    try:
+                        os.unlink(path)
+                    except OSError as e:
+                        if e.errno != errno.ENOENT:
+                            raise
+                total -= size
+
+
+class Deduplicator(object):
+    """Materializes local files as hard links to copies of them in a
+    ContentStore, so that identical files of different directives (and
+    of different trees) take the space of one. Files are hashed through
+    the HashCache, so unchanged files are never read again.
+
+    store is a ContentStore, or the path of one to create when it is first
+    needed. The files created are read-only, as the store's copy is shared.
+    Where the store is on another filesystem than dest, files can only be
+    copied from it, which saves no space; log_summary warns about those."""
+
+    def __init__(self, store, hash_cache):
+        self._store = store
+        self.hash_cache = hash_cache
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        "Start counting the files of a new build"
+        self.files = 0
+        self.bytes = 0
+        # Bytes newly written to the store, or copied across filesystems
+        self.written = 0
+        self.copies = 0
+
+    @property
+    def store(self):
+        with self.lock:
+            if not isinstance(self._store, ContentStore):
+                self._store = ContentStore(self._store)
+            return self._store
+
+    def place(self, source, dest, source_stat):
+        """Make dest a link to the stored copy of file source, storing it
+        first if it isn't there. Returns True if dest was changed."""
+        store = self.store
+        mode = stat.S_IMODE(source_stat.st_mode) & 0o555 | 0o444
+        written = 0
+        digest = self.hash_cache.cached(source, "sha256")
+        if digest is None:
+            # A file that wasn't hashed before is hashed as it is stored,
+            # so it is only read once
+            digest, written = store.add_file(source, mode)
+            self.hash_cache.record(source, "sha256", digest)
+        name = store.blob_name(digest, mode)
+        unchanged = self.is_placed(store, name, dest, source, mode)
+        method = None if unchanged else store.materialize(name, dest)
+        if method is None and not unchanged:
+            # Evicted since it was hashed or stored
+            digest, added = store.add_file(source, mode)
+            written += added
+            method = store.materialize(store.blob_name(digest, mode), dest)
+        if method == "copy":
+            written += source_stat.st_size
+        with self.lock:
+            self.files += 1
+            self.bytes += source_stat.st_size
+            self.written += written
+            self.copies += method == "copy"
+        return not unchanged
+
+    def is_placed(self, store, name, dest, source, mode):
+        """True if dest is already the stored copy name of source: a link to
+        it, or, across filesystems, a copy with its mode and contents"""
+        try:
+            if os.path.samefile(store.blob_path(name), dest):
+                return True
+            if fileutils.same_filesystem(store.path, dest):
+                # Could be a link, so it will be
+                return False
+            dest_stat = os.lstat(dest)
+            source_size = os.path.getsize(source)
+        except OSError:
+            return False
+        return (stat.S_ISREG(dest_stat.st_mode) and
+                stat.S_IMODE(dest_stat.st_mode) == mode and
+                dest_stat.st_size == source_size and
+                self.hash_cache.digest(dest, "sha256") ==
+                self.hash_cache.digest(source, "sha256"))
+
+    def log_summary(self):
+        if self.files:
+            logging.info("Deduplicated {} files of {} bytes, saving {} bytes".format(
+                self.files, self.bytes, max(0, self.bytes - self.written)))
+        if self.copies:
+            logging.warning("{} files were copied from the store {}, which is on "
+                            "another filesystem, so they take space of their own".format(
+                                self.copies, self.store.path))
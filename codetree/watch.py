@@ -0,0 +1,194 @@
+"""Watch mode: keep a built Config in memory and rebuild what changes.
+
+After a full build, the watcher waits for changes. A change to a config
+file reloads the config and rebuilds it. A change to a local source
+rebuilds the directives that copy it, and those nested in their
+destinations. Every other source is polled by rebuilding its directives
+each poll interval. Rebuilds go through the incremental build state like
+any other build, so they only do work for directives that changed, and
+the parsed config and the caches of its context stay warm in between.
+
+Local changes are noticed through inotify when pyinotify is installed, and
+otherwise by comparing summaries of the watched trees every second."""
+import os
+import time
+import logging
+import threading
+
+import fileutils
+from config import Config
+from scheduler import is_path_prefix
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+
+class PollingMonitor(object):
+    "Notices changes to paths by comparing summaries of their trees"
+
+    def __init__(self, paths, interval=1):
+        self.interval = interval
+        self.summaries = dict((path, fileutils.tree_summary(path)) for path in paths)
+
+    def wait(self, timeout):
+        "The paths that changed within timeout seconds, if any"
+        deadline = time.time() + timeout
+        while True:
+            changed = set()
+            for path, summary in self.summaries.items():
+                current = fileutils.tree_summary(path)
+                if current != summary:
+                    self.summaries[path] = current
+                    changed.add(path)
+            remaining = deadline - time.time()
+            if changed or remaining <= 0:
+                return changed
+            time.sleep(min(self.interval, remaining))
+
+    def close(self):
+        pass
+
+
+class InotifyMonitor(object):
+    "Notices changes to paths through inotify"
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.changed = set()
+        mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | pyinotify.IN_DELETE |
+                pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO | pyinotify.IN_ATTRIB)
+        self.manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.manager, self.event)
+        for path in paths:
+            if os.path.isdir(path):
+                self.manager.add_watch(path, mask, rec=True, auto_add=True)
+            elif os.path.isdir(os.path.dirname(path)):
+                # Files are often replaced rather than rewritten, and missing
+                # ones may appear, so it is their directory that is watched
+                self.manager.add_watch(os.path.dirname(path), mask)
+            else:
+                logging.warning("Not watching {}: it does not exist".format(path))
+
+    def event(self, event):
+        for path in self.paths:
+            if is_path_prefix(path, event.pathname):
+                self.changed.add(path)
+
+    def wait(self, timeout):
+        "The paths that changed within timeout seconds, if any"
+        deadline = time.time() + timeout
+        while not self.changed:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            if self.notifier.check_events(int(remaining * 1000)):
+                self.notifier.read_events()
+                self.notifier.process_events()
+        changed, self.changed = self.changed, set()
+        return changed
+
+    def close(self):
+        self.notifier.stop()
+
+
+def monitor(paths):
+    if pyinotify is not None:
+        return InotifyMonitor(paths)
+    return PollingMonitor(paths)
+
+
+class Watcher(object):
+    """Builds config_files, then rebuilds them as they and their sources
+    change, until stopped. config_options are passed to each Config, and
+    build_options to each of its builds."""
+
+    # Seconds without further changes before a burst of them is acted on
+    settle = 0.5
+
+    def __init__(self, config_files, config_options=None, build_options=None,
+                 poll_interval=300):
+        self.config_files = config_files
+        self.config_options = config_options or {}
+        self.build_options = build_options or {}
+        self.poll_interval = poll_interval
+        self.config = None
+        self.context = None
+        self.monitor = None
+        self.watched = {}
+        self.stopped = threading.Event()
+
+    def directives(self):
+        return [entry[-1] for entry in self.config.directives]
+
+    def load(self):
+        "Parse the config files, keeping the build context of the last config"
+        config = Config(self.config_files, context=self.context, **self.config_options)
+        self.config, self.context = config, config.context
+        self.watched = {}
+        for directive in self.directives():
+            path = directive.source.watch_path()
+            if path is not None:
+                self.watched.setdefault(os.path.abspath(path), []).append(directive)
+        if self.monitor is not None:
+            self.monitor.close()
+        self.config_paths = set(os.path.abspath(f) for f in self.config_files)
+        self.monitor = monitor(sorted(self.config_paths | set(self.watched)))
+
+    def affected(self, paths):
+        "The directives to rebuild for changes to the watched paths"
+        changed = [d for path in paths for d in self.watched.get(path, [])]
+        return set(d for d in self.directives()
+                   if any(is_path_prefix(c.location, d.location) for c in changed))
+
+    def polled(self):
+        return set(d for d in self.directives() if d.source.watch_path() is None)
+
+    def build(self, only=None):
+        if only is not None:
+            if not only:
+                return
+            logging.info("Rebuilding {}".format(
+                ", ".join(sorted(d.location for d in only))))
+        try:
+            self.config.build(only=only, **self.build_options)
+        except Exception:
+            logging.exception("Build failed")
+
+    def wait(self, timeout):
+        "The watched paths that changed within timeout, once they settle"
+        changed = self.monitor.wait(timeout)
+        while changed:
+            more = self.monitor.wait(self.settle)
+            if not more:
+                break
+            changed |= more
+        return changed
+
+    def run(self):
+        self.load()
+        self.build()
+        next_poll = time.time() + self.poll_interval
+        while not self.stopped.is_set():
+            # Wake up at least every second to notice stop()
+            changed = self.wait(min(1, max(0, next_poll - time.time())))
+            if changed & self.config_paths:
+                logging.info("Configuration changed, reloading")
+                try:
+                    self.load()
+                except Exception:
+                    logging.exception("Keeping the previous configuration")
+                    continue
+                self.build()
+                next_poll = time.time() + self.poll_interval
+                continue
+            if changed:
+                self.build(self.affected(changed))
+            if time.time() >= next_poll:
+                self.build(self.polled())
+                next_poll = time.time() + self.poll_interval
+        self.monitor.close()
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,105 @@
+"A local stand-in for the HTTP servers codetree downloads from"
+import threading
+import hashlib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+
+class StandInRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self):
+        self.do_GET(send_body=False)
+
+    def do_GET(self, send_body=True):
+        self.server.requests.append((self.path, dict(self.headers)))
+        if self.path in self.server.redirects:
+            self.send_response(302)
+            self.send_header("Location", self.server.redirects[self.path])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = self.server.files.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        if self.server.validators and self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        start = self.range_start(etag, len(body))
+        if start is None:
+            self.send_response(200)
+            start = 0
+        else:
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(
+                start, len(body) - 1, len(body)))
+        self.send_header("Content-Length", str(len(body) - start))
+        if self.server.validators:
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", "Sat, 17 Oct 2026 12:00:00 GMT")
+        self.end_headers()
+        if not send_body:
+            return
+        body = body[start:]
+        with self.server.lock:
+            drop = self.server.drops.pop(self.path, None)
+        if drop is not None:
+            # A connection that breaks partway through the body
+            body = body[:drop]
+            self.close_connection = True
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.sent += len(body)
+
+    def range_start(self, etag, size):
+        "The first byte of a Range request that can be honored, or None"
+        requested = self.headers.get("Range", "")
+        if not (self.server.ranges and requested.startswith("bytes=")):
+            return None
+        if self.headers.get("If-Range") not in (None, etag):
+            return None
+        start = requested[len("bytes="):].split("-")[0]
+        if not start.isdigit() or int(start) >= size:
+            return None
+        return int(start)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, files=None, validators=True, ranges=True):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), StandInRequestHandler)
+        self.files = files if files is not None else {}
+        self.validators = validators
+        self.ranges = ranges
+        self.redirects = {}
+        # Paths whose next response breaks off after this many body bytes
+        self.drops = {}
+        self.requests = []
+        # Bytes of response bodies sent
+        self.sent = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+
+    def handle_error(self, request, client_address):
+        # Clients closing pooled connections are expected
+        pass
+
+    def url(self, path):
+        return "http://127.0.0.1:{}{}".format(self.server_address[1], path)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,155 @@
+import os
+import io
+import shutil
+import tarfile
+import zipfile
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from codetree.archive import (
+    extract,
+    member_path,
+    ArchiveError,
+)
+from codetree.pathfilter import PathFilter
+
+
+def make_tar(members, mode="w"):
+    "A tarball of (name, content) members; content None is a directory"
+    data = io.BytesIO()
+    tar = tarfile.open(fileobj=data, mode=mode)
+    for name, content in members:
+        info = tarfile.TarInfo(name)
+        if content is None:
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            tar.addfile(info)
+        else:
+            info.size = len(content)
+            info.mode = 0o644
+            info.mtime = 1000000000
+            tar.addfile(info, io.BytesIO(content))
+    tar.close()
+    return data.getvalue()
+
+
+class Unseekable(object):
+    "A file object that can only be read forwards, like an HTTP response"
+
+    def __init__(self, data):
+        self.data = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self.data.read(size)
+
+
+class TestArchive(TestCase):
+    def setUp(self):
+        super(TestArchive, self).setUp()
+        self.tmpdir = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.dest = os.path.join(self.tmpdir, "dest")
+
+    def read(self, *path):
+        with open(os.path.join(self.dest, *path)) as f:
+            return f.read()
+
+    def test_member_path(self):
+        self.assertEqual(member_path("a/b/c"), "a/b/c")
+        self.assertEqual(member_path("./a//b"), "a/b")
+        self.assertEqual(member_path("a/b/c", 1), "b/c")
+        self.assertIsNone(member_path("a/", 1))
+        for name in ("/etc/passwd", "a/../../b", ".."):
+            with self.assertRaises(ArchiveError):
+                member_path(name)
+
+    def test_extracts_compressed_tarballs(self):
+        members = [("pkg", None), ("pkg/README", "read me"), ("pkg/src/x.py", "x = 1")]
+        for mode in ("w", "w:gz", "w:bz2"):
+            extract(Unseekable(make_tar(members, mode)), self.dest)
+            self.assertEqual(self.read("pkg", "README"), "read me")
+            self.assertEqual(self.read("pkg", "src", "x.py"), "x = 1")
+            self.assertEqual(os.path.getmtime(os.path.join(self.dest, "pkg", "README")),
+                             1000000000)
+
+    def test_strip_components(self):
+        members = [("pkg-1.0/README", "read me"), ("pkg-1.0/src/x.py", "x = 1")]
+        extract(Unseekable(make_tar(members, "w:gz")), self.dest, strip_components=1)
+        self.assertEqual(sorted(os.listdir(self.dest)), ["README", "src"])
+
+    def test_filters(self):
+        members = [("pkg-1.0/conf/a.cfg", "a"), ("pkg-1.0/conf/b.pyc", "b"),
+                   ("pkg-1.0/src/x.py", "x = 1")]
+        extract(Unseekable(make_tar(members, "w:gz")), self.dest, strip_components=1,
+                paths=PathFilter("conf", exclude=["*.pyc"]))
+        self.assertEqual(os.listdir(self.dest), ["a.cfg"])
+
+    def test_extracts_zips(self):
+        data = io.BytesIO()
+        archive = zipfile.ZipFile(data, "w")
+        archive.writestr("pkg-1.0/", "")
+        archive.writestr("pkg-1.0/README", "read me")
+        archive.close()
+        extract(Unseekable(data.getvalue()), self.dest, strip_components=1)
+        self.assertEqual(self.read("README"), "read me")
+
+    def test_replaces_dest_only_on_success(self):
+        os.mkdir(self.dest)
+        with open(os.path.join(self.dest, "old"), "w") as f:
+            f.write("old")
+        truncated = make_tar([("new", os.urandom(10000))], "w:gz")[:2000]
+        with self.assertRaises(ArchiveError):
+            extract(Unseekable(truncated), self.dest)
+        self.assertEqual(os.listdir(self.dest), ["old"])
+        self.assertEqual(os.listdir(self.tmpdir), ["dest"])
+
+        extract(Unseekable(make_tar([("new", "new")])), self.dest)
+        self.assertEqual(os.listdir(self.dest), ["new"])
+
+    def test_rejects_unsafe_members(self):
+        with self.assertRaises(ArchiveError):
+            extract(Unseekable(make_tar([("../evil", "evil")])), self.dest)
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, "evil")))
+
+        data = io.BytesIO()
+        tar = tarfile.open(fileobj=data, mode="w")
+        link = tarfile.TarInfo("escape")
+        link.type = tarfile.SYMTYPE
+        link.linkname = self.tmpdir
+        tar.addfile(link)
+        info = tarfile.TarInfo("escape/evil")
+        tar.addfile(info, io.BytesIO(""))
+        tar.close()
+        with self.assertRaises(ArchiveError):
+            extract(Unseekable(data.getvalue()), self.dest)
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, "evil")))
+
+    def test_hard_links_to_left_out_members(self):
+        data = io.BytesIO()
+        tar = tarfile.open(fileobj=data, mode="w")
+        info = tarfile.TarInfo("pkg-1.0/src/x.py")
+        info.size = 5
+        info.mode = 0o755
+        tar.addfile(info, io.BytesIO("x = 1"))
+        for name in ("pkg-1.0/conf/x.py", "pkg-1.0/conf/y.py"):
+            link = tarfile.TarInfo(name)
+            link.type = tarfile.LNKTYPE
+            link.linkname = "pkg-1.0/src/x.py"
+            tar.addfile(link)
+        tar.close()
+        extract(Unseekable(data.getvalue()), self.dest, strip_components=1,
+                paths=PathFilter("conf"))
+        self.assertEqual(sorted(os.listdir(self.dest)), ["x.py", "y.py"])
+        self.assertEqual(self.read("x.py"), "x = 1")
+        x = os.stat(os.path.join(self.dest, "x.py"))
+        self.assertEqual(x.st_mode & 0o777, 0o755)
+        self.assertEqual(x.st_nlink, 2)
+        # Nothing was left beside the destination
+        self.assertEqual(os.listdir(self.tmpdir), ["dest"])
+
+        # Nor when the first link to it is left out too
+        extract(Unseekable(data.getvalue()), self.dest, strip_components=1,
+                paths=PathFilter("conf", exclude=["x.py"]))
+        self.assertEqual(os.listdir(self.dest), ["y.py"])
+        self.assertEqual(self.read("y.py"), "x = 1")
+        self.assertEqual(os.listdir(self.tmpdir), ["dest"])
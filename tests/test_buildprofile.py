@@ -0,0 +1,79 @@
+import os
+import json
+import time
+from unittest import TestCase
+
+from mock import MagicMock
+
+from codetree import buildprofile, executor
+from codetree.buildprofile import BuildProfile, phase
+
+from .test_config import ConfigTestCase, write
+
+
+def directive(location):
+    return MagicMock(location=location, url="/src/" + location)
+
+
+class TestBuildProfile(TestCase):
+    def test_phases_are_exclusive(self):
+        profile = BuildProfile()
+        with profile.directive(directive("a")) as record:
+            with phase("fetch"):
+                time.sleep(0.02)
+                with phase("copy"):
+                    time.sleep(0.05)
+        self.assertGreaterEqual(record.phases["copy"], 0.05)
+        self.assertLess(record.phases["fetch"], 0.05)
+        self.assertGreaterEqual(record.wall, 0.07)
+        self.assertIsNone(buildprofile.current())
+
+    def test_counts_subprocesses(self):
+        profile = BuildProfile()
+        executor.check_output(("true",))
+        with profile.directive(directive("a")) as record:
+            executor.check_output(("true",))
+            buildprofile.transferred(100)
+        self.assertEqual(record.subprocesses, 1)
+        self.assertEqual(record.commands[0]["cmd"], "true")
+        self.assertEqual(record.bytes, 100)
+
+    def test_report(self):
+        profile = BuildProfile()
+        with profile.build(jobs=2):
+            for location, seconds in (("fast", 0), ("slow", 0.03), ("medium", 0.01)):
+                with profile.directive(directive(location)) as record:
+                    with phase("probe"):
+                        time.sleep(seconds)
+                    record.status = "ok"
+        report = profile.report(top=2)
+        self.assertEqual([r["location"] for r in report["slowest"]], ["slow", "medium"])
+        self.assertEqual(len(report["directives"]), 3)
+        self.assertEqual(report["build"]["jobs"], 2)
+        self.assertEqual(report["build"]["statuses"], {"ok": 3})
+        self.assertGreaterEqual(report["build"]["phases"]["probe"], 0.04)
+
+
+class TestProfiledBuild(ConfigTestCase):
+    def test_build_records_directives(self):
+        source = os.path.join(self.sources, "content")
+        os.mkdir(source)
+        write(os.path.join(source, "a"), "aaa")
+        lines = ("content  {}".format(source), "dir  @")
+        config = self.config(*lines)
+        self.assertTrue(config.build())
+        report = config.context.profile.report()
+        records = dict((r["location"], r) for r in report["directives"])
+        self.assertEqual(records["content"]["status"], "ok")
+        self.assertEqual(records["content"]["handler"], "LocalHandler")
+        self.assertEqual(records["content"]["bytes"], 3)
+        self.assertIn("copy", records["content"]["phases"])
+        self.assertIn("probe", records["content"]["phases"])
+
+        config = self.config(*lines)
+        self.assertTrue(config.build())
+        profile_file = os.path.join(self.tmpdir, "profile.json")
+        config.context.profile.write(profile_file)
+        with open(profile_file) as f:
+            report = json.load(f)
+        self.assertEqual(report["build"]["statuses"], {"skipped": 2})
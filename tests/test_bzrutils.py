@@ -0,0 +1,195 @@
+import os
+import shutil
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from mock import patch
+
+from codetree import handlers
+
+from codetree.bzrutils import (
+    normalize_location,
+    read_branch_state,
+    repo_key,
+    tree_revno,
+    BzrProbes,
+)
+from codetree.config import BuildContext
+from codetree.handlers import BzrSourceHandler
+
+from .test_handlers import shellcmd
+
+
+class TestNormalizeLocation(TestCase):
+    def test_urls(self):
+        self.assertEqual(normalize_location("bzr+ssh://host/%2Bbranch/foo/"),
+                         "bzr+ssh://host/+branch/foo")
+
+    def test_paths(self):
+        self.assertEqual(normalize_location("../p/", base="/tmp/c"), "/tmp/p")
+        self.assertEqual(normalize_location("file:///tmp/a%20b/"), "/tmp/a b")
+        self.assertEqual(normalize_location("/tmp/p/"), "/tmp/p")
+
+
+class TestBranchProbes(TestCase):
+    def setUp(self):
+        super(TestBranchProbes, self).setUp()
+        self.tmpdir = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.parent = os.path.join(self.tmpdir, "parent")
+        shellcmd("bzr init -q {0} && cd {0} && touch a && bzr add -q a && "
+                 "bzr commit -q -m one && bzr commit -q --unchanged -m two".format(
+                     self.parent))
+
+    def test_read_branch_state(self):
+        child = os.path.join(self.tmpdir, "child")
+        shellcmd("bzr branch -q {} {}".format(self.parent, child))
+        state = read_branch_state(child)
+        self.assertTrue(state.is_branch)
+        self.assertTrue(state.has_tree)
+        self.assertEqual(state.parent, self.parent)
+        self.assertEqual(state.revno, 2)
+
+        state = read_branch_state(self.parent)
+        self.assertIsNone(state.parent)
+        self.assertFalse(read_branch_state(self.tmpdir).is_branch)
+
+    def test_lightweight_checkout(self):
+        checkout = os.path.join(self.tmpdir, "checkout")
+        shellcmd("bzr checkout -q --lightweight {} {}".format(self.parent, checkout))
+        state = read_branch_state(checkout)
+        self.assertTrue(state.is_branch)
+        self.assertEqual(state.checkout_of, self.parent)
+
+    def test_remote_probes_are_cached(self):
+        probes = BzrProbes()
+        url = "file://" + self.parent
+        self.assertEqual(probes.remote_revno(url), 2)
+        self.assertEqual(probes.remote_revno(url), 2)
+        self.assertEqual(probes.probed, 1)
+        self.assertIsNone(probes.remote_revno("file://" + self.tmpdir))
+
+    @patch("codetree.bzrutils.check_output")
+    def test_existing_branch_skips_source_probe(self, _bzr):
+        child = os.path.join(self.tmpdir, "child")
+        shellcmd("bzr branch -q {} {}".format(self.parent, child))
+        bh = BzrSourceHandler(self.parent)
+        self.assertTrue(bh.get(child))
+        self.assertFalse(_bzr.called)
+
+
+class TestPinnedBranches(TestCase):
+    def setUp(self):
+        super(TestPinnedBranches, self).setUp()
+        self.tmpdir = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.parent = os.path.join(self.tmpdir, "parent")
+        self.child = os.path.join(self.tmpdir, "child")
+        shellcmd("bzr init -q {0} && cd {0} && touch a && bzr add -q a && "
+                 "bzr commit -q -m one && bzr commit -q --unchanged -m two".format(
+                     self.parent))
+        shellcmd("bzr branch -q -r 1 {} {}".format(self.parent, self.child))
+        patcher = patch("codetree.handlers.log_failure", wraps=handlers.log_failure)
+        self.log_failure = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def commands(self):
+        return [call[0][0][:2] for call in self.log_failure.call_args_list]
+
+    def test_already_at_revno(self):
+        bh = BzrSourceHandler(self.parent)
+        self.assertTrue(bh.get(self.child, {"revno": "1"}))
+        self.assertEqual(self.commands(), [])
+
+    def test_fetches_up_to_revno(self):
+        bh = BzrSourceHandler(self.parent)
+        self.assertTrue(bh.get(self.child, {"revno": "2"}))
+        self.assertEqual(self.commands(), [("bzr", "pull"), ("bzr", "update")])
+        self.assertEqual(read_branch_state(self.child).revno, 2)
+
+    def test_earlier_revno_is_local(self):
+        shellcmd("bzr pull -q -d {}".format(self.child))
+        bh = BzrSourceHandler(self.parent)
+        self.assertTrue(bh.get(self.child, {"revno": "1"}))
+        self.assertEqual(self.commands(), [("bzr", "update")])
+        self.assertEqual(tree_revno(self.child), 1)
+
+    def test_new_branch_fetches_up_to_revno(self):
+        dest = os.path.join(self.tmpdir, "new")
+        bh = BzrSourceHandler(self.parent)
+        self.assertTrue(bh.get(dest, {"revno": "1"}))
+        self.assertEqual(read_branch_state(dest).revno, 1)
+
+
+class TestSharedRepoCache(TestCase):
+    def setUp(self):
+        super(TestSharedRepoCache, self).setUp()
+        self.tmpdir = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.trunk = os.path.join(self.tmpdir, "project", "trunk")
+        self.series = os.path.join(self.tmpdir, "project", "series")
+        shellcmd("bzr init -q --create-prefix {0} && cd {0} && touch a && "
+                 "bzr add -q a && bzr commit -q -m one && bzr branch -q . {1} && "
+                 "bzr commit -q --unchanged -m two".format(self.trunk, self.series))
+        self.context = BuildContext(os.path.join(self.tmpdir, "cache"),
+                                    bzr_shared_repos=True)
+        self.repos = self.context.bzr_repos
+
+    def get(self, source, dest, options=None):
+        bh = BzrSourceHandler(source)
+        bh.context = self.context
+        return bh.get(os.path.join(self.tmpdir, dest), options)
+
+    def test_repo_key(self):
+        self.assertEqual(repo_key("bzr+ssh://bazaar.launchpad.net/~team/myapp/trunk"),
+                         "bazaar.launchpad.net_myapp")
+        self.assertEqual(repo_key("bzr+ssh://bazaar.launchpad.net/+branch/myapp"),
+                         "bazaar.launchpad.net_myapp")
+        self.assertEqual(repo_key("bzr://example.com/foo/bar"), "example.com_foo")
+        self.assertEqual(repo_key("/srv/bzr/myapp"), "local_srv_bzr")
+        # lp: shorthands share the repositories of the URLs they stand for
+        branch = "bzr+ssh://bazaar.launchpad.net/+branch/myapp"
+        for url in ("lp:myapp", "lp:myapp/", "nosmart+lp:myapp"):
+            self.assertEqual(os.path.basename(self.repos.repository(url)),
+                             "bazaar.launchpad.net_myapp")
+        self.assertEqual(self.repos.mirror("lp:myapp"), self.repos.mirror(branch))
+        self.assertEqual(self.repos.repository("lp:~team/myapp/trunk"),
+                         self.repos.repository(branch))
+
+    def test_branches_through_shared_repo(self):
+        self.assertTrue(self.get(self.trunk, "trunk"))
+        self.assertTrue(self.get(self.series, "series"))
+        repository = self.repos.repository(self.trunk)
+        self.assertEqual(repository, self.repos.repository(self.series))
+        self.assertTrue(os.path.isdir(self.repos.mirror(self.trunk)))
+        self.assertTrue(os.path.isdir(self.repos.mirror(self.series)))
+
+        # The parent is still the real source, so updates work as usual
+        state = read_branch_state(os.path.join(self.tmpdir, "trunk"))
+        self.assertEqual(state.parent, self.trunk)
+        self.assertEqual(state.revno, 2)
+        shellcmd("cd {} && bzr commit -q --unchanged -m three".format(self.trunk))
+        self.repos.refreshed.clear()
+        self.assertTrue(self.get(self.trunk, "trunk"))
+        self.assertEqual(read_branch_state(os.path.join(self.tmpdir, "trunk")).revno, 3)
+
+    def test_report_and_prune(self):
+        self.assertTrue(self.get(self.trunk, "trunk"))
+        report = self.repos.report()
+        self.assertEqual(len(report), 1)
+        name, size, used = report[0]
+        self.assertGreater(size, 0)
+
+        self.assertEqual(self.repos.prune(60), [])
+        self.assertEqual(self.repos.prune(-1), [(name, size)])
+        self.assertEqual(self.repos.report(), [])
+
+    def test_not_pruned_while_in_use(self):
+        self.assertTrue(self.get(self.trunk, "trunk"))
+        bh = BzrSourceHandler(self.trunk)
+        bh.context = self.context
+        with bh.fetch_location() as location:
+            self.assertEqual(location, self.repos.mirror(self.trunk))
+            self.assertEqual(self.repos.prune(-1), [])
+            self.assertTrue(os.path.isdir(location))
+        self.assertEqual(len(self.repos.prune(-1)), 1)
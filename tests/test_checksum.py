@@ -0,0 +1,89 @@
+import os
+import json
+import shutil
+import hashlib
+from tempfile import mkdtemp
+from unittest import TestCase
+from StringIO import StringIO
+
+from mock import patch
+
+from codetree import checksum
+from codetree.checksum import ChecksumError, HashCache, Hashers, HashingReader
+
+SHA256 = hashlib.sha256("words").hexdigest()
+SHA512 = hashlib.sha512("words").hexdigest()
+
+
+class TestPins(TestCase):
+    def test_pins(self):
+        self.assertEqual(checksum.pins({}), {})
+        self.assertEqual(checksum.pins({"sha256": SHA256.upper(), "overwrite": "true"}),
+                         {"sha256": SHA256})
+        with self.assertRaises(ChecksumError):
+            checksum.pins({"sha256": SHA512})
+        with self.assertRaises(ChecksumError):
+            checksum.pins({"sha512": "nope"})
+
+    def test_hashing_reader(self):
+        hashers = Hashers({"sha256": SHA256, "sha512": SHA512})
+        reader = HashingReader(StringIO("words"), hashers)
+        self.assertEqual(reader.read(2), "wo")
+        reader.drain()
+        hashers.check("words")
+
+        hashers = Hashers({"sha256": SHA256})
+        hashers.update("word")
+        with self.assertRaises(ChecksumError):
+            hashers.check("word")
+
+
+class TestHashCache(TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, "words")
+        with open(self.path, "w") as f:
+            f.write("words")
+        self.cache_file = os.path.join(self.tmpdir, "cache", "checksums.json")
+
+    def test_matches(self):
+        self.assertTrue(checksum.matches(self.path, {"sha256": SHA256}))
+        self.assertFalse(checksum.matches(self.path, {"sha256": SHA256, "sha512": "0" * 128}))
+
+    def test_unchanged_file_is_not_read_again(self):
+        cache = HashCache(self.cache_file)
+        self.assertTrue(checksum.matches(self.path, {"sha256": SHA256}, cache))
+        cache.save()
+
+        cache = HashCache(self.cache_file)
+        with patch("codetree.checksum.file_digest") as _digest:
+            self.assertTrue(checksum.matches(self.path, {"sha256": SHA256}, cache))
+            self.assertFalse(_digest.called)
+            # A modified file is hashed again
+            with open(self.path, "w") as f:
+                f.write("other words")
+            _digest.return_value = "0" * 64
+            self.assertFalse(checksum.matches(self.path, {"sha256": SHA256}, cache))
+            self.assertTrue(_digest.called)
+
+    def test_save_merges_and_expires(self):
+        other = os.path.join(self.tmpdir, "other")
+        with open(other, "w") as f:
+            f.write("other")
+        first, second = HashCache(self.cache_file), HashCache(self.cache_file)
+        first.digest(self.path, "sha256")
+        second.digest(other, "sha256")
+        first.save()
+        second.save()
+        with open(self.cache_file) as f:
+            self.assertEqual(len(json.load(f)), 2)
+
+        with patch("codetree.checksum.time.time", return_value=0):
+            stale = HashCache(self.cache_file)
+            stale.digest(self.path, "sha512")
+            stale.save()
+        cache = HashCache(self.cache_file, max_age=60)
+        cache.digest(other, "sha512")
+        cache.save()
+        self.assertEqual(len(cache.entries), 1)
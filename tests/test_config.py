@@ -0,0 +1,235 @@
+import os
+import shutil
+from subprocess import CalledProcessError
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from mock import patch
+
+from codetree.batch import RsyncBatch, batch_directives
+from codetree.config import Config, Directive
+from codetree.fileutils import FileManipulationError
+from codetree.scheduler import Scheduler, dependency_graph
+
+from .httpserver import StandInServer
+
+
+def write(path, content="words"):
+    with open(path, "w") as f:
+        f.write(content)
+
+
+class ConfigTestCase(TestCase):
+    def setUp(self):
+        super(ConfigTestCase, self).setUp()
+        self.tmpdir = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.tree = os.path.join(self.tmpdir, "tree")
+        self.sources = os.path.join(self.tmpdir, "sources")
+        os.mkdir(self.tree)
+        os.mkdir(self.sources)
+        here = os.getcwd()
+        os.chdir(self.tree)
+        self.addCleanup(os.chdir, here)
+        self.cache_dir = os.path.join(self.tmpdir, "cache")
+
+    def config(self, *lines):
+        cfgfile = os.path.join(self.tmpdir, "codetree.cfg")
+        with open(cfgfile, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        return Config([cfgfile], cache_dir=self.cache_dir)
+
+
+class TestConfig(ConfigTestCase):
+    def test_build_order(self):
+        config = self.config("app/plugins/woohoo  @", "# comment", "", "app  @",
+                             "other  @")
+        directives = [d[-1].location for d in sorted(config.directives)]
+        self.assertEqual(directives, ["app", "other", "app/plugins/woohoo"])
+        self.assertTrue(config.build())
+        self.assertTrue(os.path.isdir("app/plugins/woohoo"))
+
+    def test_parse_source(self):
+        url, options = Directive.parse_source("lp:foo;revno=44,overwrite=true")
+        self.assertEqual(url, "lp:foo")
+        self.assertEqual(options, {"revno": "44", "overwrite": "true"})
+
+
+class TestHttpLane(ConfigTestCase):
+    def lines(self, server, count=40):
+        target = os.path.join(self.sources, "target")
+        write(target)
+        lines = ["http  @", "links  @"]
+        for i in range(count):
+            lines.append("http/h{}  {}".format(i, server.url("/h{}".format(i))))
+            lines.append("links/l{}  {};method=link".format(i, target))
+        return lines
+
+    def test_serial_by_default(self):
+        with StandInServer({"/h0": "h"}) as server:
+            config = self.config(*self.lines(server, count=1))
+            with patch.object(Scheduler, "run_parallel") as _run_parallel:
+                self.assertTrue(config.build())
+            self.assertFalse(_run_parallel.called)
+
+    def test_downloads_beside_links(self):
+        files = dict(("/h{}".format(i), "h{}".format(i)) for i in range(40))
+        with StandInServer(files) as server:
+            self.assertTrue(self.config(*self.lines(server)).build(http_jobs=8))
+        for i in range(40):
+            with open(os.path.join("http", "h{}".format(i))) as f:
+                self.assertEqual(f.read(), "h{}".format(i))
+            self.assertTrue(os.path.islink(os.path.join("links", "l{}".format(i))))
+
+
+class TestIncrementalBuild(ConfigTestCase):
+    def setUp(self):
+        super(TestIncrementalBuild, self).setUp()
+        self.source = os.path.join(self.sources, "content")
+        os.mkdir(self.source)
+        write(os.path.join(self.source, "a"), "aaa")
+        self.lines = ("content  {}".format(self.source), "dir  @")
+        patcher = patch("codetree.config.Directive.run", autospec=True,
+                        side_effect=lambda d: d.source.get(d.location, d.source_options))
+        self.run = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def built(self, **build_options):
+        self.run.reset_mock()
+        self.assertTrue(self.config(*self.lines).build(**build_options))
+        return sorted(call[0][0].location for call in self.run.call_args_list)
+
+    def test_skips_unchanged(self):
+        self.assertEqual(self.built(), ["content", "dir"])
+        self.assertTrue(os.path.exists(".codetree-state"))
+        self.assertEqual(self.built(), [])
+
+    def test_force(self):
+        self.built()
+        self.assertEqual(self.built(force=True), ["content", "dir"])
+
+    def test_changed_source(self):
+        self.built()
+        write(os.path.join(self.source, "b"), "bbb")
+        self.assertEqual(self.built(), ["content"])
+        self.assertTrue(os.path.exists("content/b"))
+
+    def test_changed_dest(self):
+        self.built()
+        os.unlink("content/a")
+        self.assertEqual(self.built(), ["content"])
+        self.assertTrue(os.path.exists("content/a"))
+
+    def test_changed_options(self):
+        self.built()
+        self.lines = ("content  {};method=rsync".format(self.source), "dir  @")
+        with patch("codetree.handlers.fileutils.rsync"):
+            self.assertEqual(self.built(), ["content"])
+
+    def test_probed_only_when_it_can_skip(self):
+        events = []
+        get = self.run.side_effect
+        self.run.side_effect = lambda d: events.append("run") or get(d)
+        with patch("codetree.handlers.LocalHandler.source_fingerprint", autospec=True,
+                   side_effect=lambda *args: events.append("probe") or "fingerprint"):
+            self.built()
+            # Not built before: fingerprinted afterwards, to be recorded
+            self.assertEqual(events, ["run", "probe"] * 2)
+            del events[:]
+            self.assertEqual(self.built(force=True), ["content", "dir"])
+            self.assertEqual(events, ["run", "probe"] * 2)
+            del events[:]
+            self.assertEqual(self.built(), [])
+            self.assertEqual(events, ["probe"] * 2)
+
+    def test_nested_destinations(self):
+        plugins = os.path.join(self.sources, "plugins")
+        os.mkdir(plugins)
+        write(os.path.join(plugins, "p"), "ppp")
+        self.built()
+        self.lines += ("content/plugins  {}".format(plugins),)
+        # Building the plugins doesn't change content itself
+        self.assertEqual(self.built(), ["content/plugins"])
+        self.assertEqual(self.built(), [])
+
+
+class TestRsyncBatch(ConfigTestCase):
+    def setUp(self):
+        super(TestRsyncBatch, self).setUp()
+        for name in ("a.cfg", "b.cfg", "c.cfg"):
+            write(os.path.join(self.sources, name))
+        self.lines = ["conf  @"] + [
+            "conf/{}  {};method=rsync".format(name, os.path.join(self.sources, name))
+            for name in ("a.cfg", "b.cfg", "c.cfg")]
+        patcher = patch("codetree.fileutils.executor.check_output")
+        self.check_output = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def commands(self):
+        return [call[0][0] for call in self.check_output.call_args_list]
+
+    def test_batches_compatible_directives(self):
+        lines = self.lines + ["other/a.cfg  {};method=rsync".format(
+            os.path.join(self.sources, "a.cfg")), "plain  {}".format(self.sources)]
+        directives = batch_directives(
+            [entry[-1] for entry in sorted(self.config(*lines).directives)])
+        self.assertEqual([d.location for d in directives],
+                         ["conf", "plain", "conf", "other/a.cfg"])
+        batch = directives[2]
+        self.assertIsInstance(batch, RsyncBatch)
+        self.assertEqual(batch.source_dir, self.sources)
+        self.assertEqual([d.location for d in batch.directives],
+                         ["conf/a.cfg", "conf/b.cfg", "conf/c.cfg"])
+
+    def test_top_level_batch_depends_on_its_members(self):
+        lines = ["{}  {};method=rsync".format(name, os.path.join(self.sources, name))
+                 for name in ("a.cfg", "b.cfg")] + [
+            "plain  {}".format(self.sources), "a.cfg/nested  @"]
+        directives = batch_directives(
+            [entry[-1] for entry in sorted(self.config(*lines).directives)])
+        batch, plain, nested = directives
+        self.assertEqual(batch.location, ".")
+        graph = dependency_graph(directives)
+        # Not everything is inside ".": only what is inside its members
+        self.assertEqual(graph[plain], set())
+        self.assertEqual(graph[nested], set([batch]))
+
+    def test_one_rsync(self):
+        self.assertTrue(self.config(*self.lines).build())
+        commands = self.commands()
+        self.assertEqual(len(commands), 1)
+        self.assertEqual(commands[0][0], "rsync")
+        self.assertIn("--files-from", commands[0])
+        self.assertEqual(commands[0][-2:], (self.sources + "/", "conf/"))
+
+    def test_skips_unchanged(self):
+        copied = []
+
+        def check_output(cmd, **kw):
+            # Copy the listed files, as rsync would have
+            with open(cmd[cmd.index("--files-from") + 1]) as files_from:
+                names = files_from.read().split()
+            for name in names:
+                shutil.copy2(os.path.join(self.sources, name), "conf")
+            copied.append(names)
+        self.check_output.side_effect = check_output
+        self.assertTrue(self.config(*self.lines).build())
+        self.assertTrue(self.config(*self.lines).build())
+        write(os.path.join(self.sources, "b.cfg"), "changed")
+        self.assertTrue(self.config(*self.lines).build())
+        self.assertEqual(copied, [["a.cfg", "b.cfg", "c.cfg"], ["b.cfg"]])
+
+    def test_failures_are_attributed(self):
+        def check_output(cmd, **kw):
+            if "--files-from" in cmd or cmd[-2].endswith("b.cfg"):
+                raise CalledProcessError(23, cmd)
+        self.check_output.side_effect = check_output
+        config = self.config(*self.lines)
+        # Each directive is retried on its own, and the one that fails
+        # raises its own error, as it would have without batching
+        with self.assertRaises(FileManipulationError):
+            config.build()
+        statuses = [(record.location, record.status)
+                    for record in config.context.profile.records]
+        self.assertEqual(statuses, [("conf", "ok"), ("conf", "failed"),
+                                    ("conf/a.cfg", "ok"), ("conf/b.cfg", "error")])
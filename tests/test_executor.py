@@ -0,0 +1,97 @@
+import time
+import threading
+from subprocess import CalledProcessError
+from unittest import TestCase
+
+from mock import MagicMock
+
+from codetree import executor
+from codetree.buildprofile import BuildProfile
+from codetree.executor import CommandTimeout, Executor, parse_limits
+
+
+class TestExecutor(TestCase):
+    def test_parse_limits(self):
+        self.assertEqual(parse_limits(["bzr=4,rsync=8", "git=2"]),
+                         {"bzr": 4, "rsync": 8, "git": 2})
+        with self.assertRaises(ValueError):
+            parse_limits(["bzr"])
+        with self.assertRaises(ValueError):
+            parse_limits(["bzr=many"])
+
+    def test_check_output(self):
+        ex = Executor()
+        self.assertEqual(ex.check_output(("echo", "words")), "words\n")
+        with self.assertRaises(CalledProcessError) as cm:
+            ex.check_output(("sh", "-c", "echo failed; exit 3"))
+        self.assertEqual(cm.exception.returncode, 3)
+        self.assertEqual(cm.exception.output, "failed\n")
+        self.assertEqual(ex.stats["sh"].commands, 1)
+
+    def test_consume(self):
+        ex = Executor()
+        lines = []
+        # Output left unread by consume doesn't block the command
+        self.assertIsNone(ex.check_output(("seq", "100000"),
+                                          consume=lambda stream: lines.append(stream.readline())))
+        self.assertEqual(lines, ["1\n"])
+        with self.assertRaises(CalledProcessError):
+            ex.check_output(("sh", "-c", "echo partial; exit 2"), consume=lambda s: s.read())
+
+    def test_limits_concurrency(self):
+        ex = Executor(limits={"sleep": 1})
+        profile = BuildProfile()
+        records = []
+
+        def run():
+            with profile.directive(MagicMock(location="x")) as record:
+                ex.check_output(("sleep", "0.2"))
+                ex.check_output(("true",))
+            records.append(record)
+        threads = [threading.Thread(target=run) for i in range(2)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertGreaterEqual(time.time() - start, 0.4)
+        # One of the sleeps waited for the other
+        self.assertGreaterEqual(max(r.queue_time for r in records), 0.15)
+        self.assertEqual(ex.stats["sleep"].commands, 2)
+        self.assertEqual([c["kind"] for c in records[0].commands], ["sleep", "true"])
+
+    def test_timeout_kills_children(self):
+        ex = Executor(timeout=0.3)
+        start = time.time()
+        with self.assertRaises(CommandTimeout):
+            # The grandchild holds stdout open, so only killing the group ends it
+            ex.check_output(("sh", "-c", "sleep 30 & echo $!; wait"))
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(ex.stats["sh"].timeouts, 1)
+
+    def test_terminate(self):
+        ex = Executor()
+        errors = []
+
+        def run():
+            try:
+                ex.check_output(("sh", "-c", "sleep 30 & echo $!; wait"))
+            except CalledProcessError as e:
+                errors.append(e)
+        thread = threading.Thread(target=run)
+        thread.start()
+        while not ex.processes:
+            time.sleep(0.01)
+        start = time.time()
+        ex.terminate()
+        thread.join()
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(ex.processes, set())
+
+    def test_active(self):
+        ex = Executor()
+        with ex.active():
+            executor.check_output(("true",))
+        executor.check_output(("true",))
+        self.assertEqual(ex.stats["true"].commands, 1)
@@ -0,0 +1,93 @@
+import os
+
+from codetree.fanout import FANOUT_FILE, FanOut, parse_root
+
+from .test_config import ConfigTestCase, write
+
+
+class TestFanOut(ConfigTestCase):
+    def setUp(self):
+        super(TestFanOut, self).setUp()
+        self.source = os.path.join(self.sources, "content")
+        os.mkdir(self.source)
+        write(os.path.join(self.source, "a"), "a")
+        self.cfgfile = os.path.join(self.tmpdir, "codetree.cfg")
+        write(self.cfgfile, "app  @\napp/content  {}\nfile  {}\n".format(
+            self.source, os.path.join(self.source, "a")))
+        self.staging = os.path.join(self.tmpdir, "staging")
+        self.roots = [os.path.join(self.tmpdir, name) for name in ("r1", "r2")]
+
+    def fan_out(self, roots, method="link"):
+        fanout = FanOut([self.cfgfile], [parse_root(root) for root in roots],
+                        staging=self.staging, method=method,
+                        config_options={"cache_dir": self.cache_dir})
+        return fanout.build()
+
+    def test_parse_root(self):
+        self.assertEqual(parse_root("/srv/a"), ("/srv/a", {}))
+        self.assertEqual(parse_root("/srv/b;overwrite=true"),
+                         ("/srv/b", {"overwrite": "true"}))
+
+    def test_fans_out(self):
+        self.assertTrue(self.fan_out(self.roots))
+        staged = os.stat(os.path.join(self.staging, "app", "content", "a"))
+        for root in self.roots:
+            placed = os.stat(os.path.join(root, "app", "content", "a"))
+            self.assertEqual(placed.st_ino, staged.st_ino)
+            self.assertTrue(os.path.isfile(os.path.join(root, "file")))
+            self.assertTrue(os.path.exists(os.path.join(root, FANOUT_FILE)))
+        # Nothing is built outside the staging tree and the roots
+        self.assertEqual(os.listdir(self.tree), [])
+
+        write(os.path.join(self.source, "b"), "b")
+        self.assertTrue(self.fan_out(self.roots, method="copy"))
+        for root in self.roots:
+            with open(os.path.join(root, "app", "content", "b")) as f:
+                self.assertEqual(f.read(), "b")
+
+    def test_control_directories_are_copied(self):
+        os.mkdir(os.path.join(self.source, ".git"))
+        write(os.path.join(self.source, ".git", "index"), "index")
+        self.assertTrue(self.fan_out(self.roots))
+        staged = os.stat(os.path.join(self.staging, "app", "content", ".git", "index"))
+        for root in self.roots:
+            placed = os.stat(os.path.join(root, "app", "content", ".git", "index"))
+            self.assertNotEqual(placed.st_ino, staged.st_ino)
+            self.assertEqual(placed.st_nlink, 1)
+
+    def test_links_stay_links(self):
+        write(self.cfgfile, "app  @\napp/lib  {};method=link\n".format(self.source))
+        self.assertTrue(self.fan_out(self.roots))
+        self.assertTrue(os.path.islink(os.path.join(self.staging, "app", "lib")))
+        for root in self.roots:
+            lib = os.path.join(root, "app", "lib")
+            self.assertTrue(os.path.islink(lib))
+            self.assertEqual(os.readlink(lib), self.source)
+        self.assertTrue(self.fan_out(self.roots))
+
+    def test_removed_files(self):
+        write(os.path.join(self.source, "b"), "b")
+        self.assertTrue(self.fan_out(self.roots))
+        # As an update of a branch or archive would
+        os.unlink(os.path.join(self.source, "b"))
+        os.unlink(os.path.join(self.staging, "app", "content", "b"))
+        self.assertTrue(self.fan_out(self.roots))
+        for root in self.roots:
+            self.assertEqual(os.listdir(os.path.join(root, "app", "content")), ["a"])
+            # The root's other destinations are kept
+            self.assertEqual(sorted(os.listdir(root)), [FANOUT_FILE, "app", "file"])
+
+    def test_overwrite_per_root(self):
+        existing = os.path.join(self.roots[1], "app", "content")
+        os.makedirs(existing)
+        write(os.path.join(existing, "mine"))
+        self.assertFalse(self.fan_out(self.roots))
+        self.assertTrue(os.path.exists(os.path.join(self.roots[0], "app", "content", "a")))
+        self.assertEqual(os.listdir(existing), ["mine"])
+        # Other directives are still placed
+        self.assertTrue(os.path.isfile(os.path.join(self.roots[1], "file")))
+
+        self.assertTrue(self.fan_out([self.roots[0], self.roots[1] + ";overwrite=true"]))
+        self.assertEqual(os.listdir(existing), ["a"])
+        # Once placed, a destination is codetree's to update
+        self.assertTrue(self.fan_out(self.roots))
@@ -0,0 +1,218 @@
+import os
+import stat
+import shutil
+import threading
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from mock import patch
+
+from codetree.fileutils import (
+    link,
+    materialize,
+    sync,
+    parse_size,
+    FileManipulationError,
+)
+
+
+def write(path, content="words"):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+class TestParseSize(TestCase):
+    def test_parse_size(self):
+        self.assertEqual(parse_size(100), 100)
+        self.assertEqual(parse_size("64k"), 65536)
+        self.assertEqual(parse_size("10M"), 10 * 1024 * 1024)
+        self.assertEqual(parse_size("2GB"), 2 * 1024 ** 3)
+        with self.assertRaises(ValueError):
+            parse_size("lots")
+
+
+class TestLink(TestCase):
+    def setUp(self):
+        super(TestLink, self).setUp()
+        self.tmpdir = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        here = os.getcwd()
+        os.chdir(self.tmpdir)
+        self.addCleanup(os.chdir, here)
+        write(os.path.join("dir", "file"))
+
+    def test_relative_to_dest(self):
+        link("file", os.path.join("dir", "symbolic"))
+        self.assertEqual(os.readlink(os.path.join("dir", "symbolic")), "file")
+        link("file", os.path.join("dir", "hard"), symbolic=False)
+        self.assertTrue(os.path.samefile(os.path.join("dir", "hard"),
+                                         os.path.join("dir", "file")))
+
+    def test_working_directory_is_left_alone(self):
+        # Other threads of a build resolve relative paths meanwhile
+        cwds = set()
+
+        def links(n):
+            for i in range(50):
+                link("file", os.path.join("dir", "{}-{}".format(n, i)))
+                cwds.add(os.getcwd())
+        threads = [threading.Thread(target=links, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(cwds, set([os.getcwd()]))
+        self.assertEqual(len(os.listdir("dir")), 201)
+
+
+class TestMaterialize(TestCase):
+    def setUp(self):
+        super(TestMaterialize, self).setUp()
+        self.tmpdir = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.source = os.path.join(self.tmpdir, "source")
+        write(self.source, "source")
+        self.dest = os.path.join(self.tmpdir, "dest")
+        write(self.dest, "dest")
+
+    def test_methods(self):
+        for method in ("hardlink", "copy"):
+            self.assertEqual(materialize(self.source, self.dest, (method,)), method)
+            self.assertEqual(read(self.dest), "source")
+            self.assertEqual(os.path.samefile(self.source, self.dest), method == "hardlink")
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ["dest", "source"])
+
+    def test_temporary_name_taken(self):
+        # Another process created the first name tried meanwhile
+        taken = os.path.join(self.tmpdir, ".dest.taken.tmp")
+        write(taken, "theirs")
+        names = iter([taken, os.path.join(self.tmpdir, ".dest.free.tmp")])
+        with patch("codetree.fileutils.tempfile.mktemp", lambda **kw: next(names)):
+            self.assertEqual(materialize(self.source, self.dest), "hardlink")
+        self.assertTrue(os.path.samefile(self.source, self.dest))
+        self.assertEqual(read(taken), "theirs")
+
+
+class TestSync(TestCase):
+    def setUp(self):
+        super(TestSync, self).setUp()
+        self.tmpdir = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.source = os.path.join(self.tmpdir, "source")
+        self.dest = os.path.join(self.tmpdir, "dest")
+        write(os.path.join(self.source, "a"), "aaa")
+        write(os.path.join(self.source, "sub", "b"), "bbb")
+        os.symlink("a", os.path.join(self.source, "link"))
+
+    def test_copies_directory_contents(self):
+        stats = sync(self.source, self.dest)
+        self.assertEqual(read(os.path.join(self.dest, "a")), "aaa")
+        self.assertEqual(read(os.path.join(self.dest, "sub", "b")), "bbb")
+        self.assertEqual(os.readlink(os.path.join(self.dest, "link")), "a")
+        self.assertEqual(stats.copied, 3)
+        self.assertEqual(stats.bytes, 6)
+
+    def test_skips_unchanged_files(self):
+        sync(self.source, self.dest)
+        stats = sync(self.source, self.dest)
+        self.assertEqual(stats.copied, 0)
+        self.assertEqual(stats.skipped, 3)
+
+        write(os.path.join(self.source, "a"), "changed")
+        stats = sync(self.source, self.dest)
+        self.assertEqual(stats.copied, 1)
+        self.assertEqual(read(os.path.join(self.dest, "a")), "changed")
+
+    def test_older_replacement(self):
+        sync(self.source, self.dest)
+        # Same size, restored from an older backup
+        write(os.path.join(self.source, "a"), "old")
+        os.utime(os.path.join(self.source, "a"), (1000000000, 1000000000))
+        self.assertEqual(sync(self.source, self.dest).copied, 1)
+        self.assertEqual(read(os.path.join(self.dest, "a")), "old")
+
+    def test_read_only_directory(self):
+        os.chmod(os.path.join(self.source, "sub"), 0o555)
+        self.addCleanup(os.chmod, os.path.join(self.source, "sub"), 0o755)
+        sync(self.source, self.dest)
+        self.addCleanup(os.chmod, os.path.join(self.dest, "sub"), 0o755)
+        self.assertEqual(read(os.path.join(self.dest, "sub", "b")), "bbb")
+        mode = stat.S_IMODE(os.stat(os.path.join(self.dest, "sub")).st_mode)
+        self.assertEqual(mode, 0o555)
+
+        write(os.path.join(self.source, "c"), "ccc")
+        os.chmod(os.path.join(self.source, "sub"), 0o755)
+        write(os.path.join(self.source, "sub", "b"), "changed")
+        os.chmod(os.path.join(self.source, "sub"), 0o555)
+        sync(self.source, self.dest)
+        self.assertEqual(read(os.path.join(self.dest, "sub", "b")), "changed")
+
+    def test_times(self):
+        os.utime(os.path.join(self.source, "a"), (1000000000, 1000000000))
+        sync(self.source, self.dest, times=True)
+        self.assertEqual(os.path.getmtime(os.path.join(self.dest, "a")), 1000000000)
+        self.assertEqual(sync(self.source, self.dest, times=True).copied, 0)
+
+        # Same size, different mtime
+        write(os.path.join(self.source, "a"), "AAA")
+        self.assertEqual(sync(self.source, self.dest, times=True).copied, 1)
+        self.assertEqual(read(os.path.join(self.dest, "a")), "AAA")
+
+    def test_delete(self):
+        write(os.path.join(self.dest, "extra", "c"))
+        sync(self.source, self.dest, delete=False)
+        self.assertTrue(os.path.exists(os.path.join(self.dest, "extra", "c")))
+        stats = sync(self.source, self.dest, delete=True)
+        self.assertFalse(os.path.exists(os.path.join(self.dest, "extra")))
+        self.assertEqual(stats.deleted, 1)
+
+    def test_perms(self):
+        os.chmod(os.path.join(self.source, "a"), 0o750)
+        sync(self.source, self.dest)
+        mode = stat.S_IMODE(os.stat(os.path.join(self.dest, "a")).st_mode)
+        self.assertEqual(mode, 0o750)
+
+        os.chmod(os.path.join(self.dest, "a"), 0o600)
+        sync(self.source, self.dest, perms=False)
+        mode = stat.S_IMODE(os.stat(os.path.join(self.dest, "a")).st_mode)
+        self.assertEqual(mode, 0o600)
+
+    def test_without_links(self):
+        sync(self.source, self.dest, links=False)
+        self.assertFalse(os.path.lexists(os.path.join(self.dest, "link")))
+
+    def test_file_into_directory(self):
+        os.mkdir(self.dest)
+        sync(os.path.join(self.source, "a"), self.dest)
+        self.assertEqual(read(os.path.join(self.dest, "a")), "aaa")
+        sync(os.path.join(self.source, "a"), os.path.join(self.dest, "renamed"))
+        self.assertEqual(read(os.path.join(self.dest, "renamed")), "aaa")
+
+    def test_replaces_rather_than_rewrites(self):
+        sync(self.source, self.dest)
+        other = os.path.join(self.tmpdir, "other")
+        os.link(os.path.join(self.dest, "a"), other)
+        write(os.path.join(self.source, "a"), "changed")
+        sync(self.source, self.dest)
+        self.assertEqual(read(other), "aaa")
+
+    def test_mode_of_linked_file(self):
+        sync(self.source, self.dest)
+        other = os.path.join(self.tmpdir, "other")
+        os.link(os.path.join(self.dest, "a"), other)
+        os.chmod(other, 0o644)
+        os.chmod(os.path.join(self.source, "a"), 0o600)
+        sync(self.source, self.dest)
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(self.dest, "a")).st_mode), 0o600)
+        self.assertEqual(stat.S_IMODE(os.stat(other).st_mode), 0o644)
+
+    def test_missing_source(self):
+        with self.assertRaises(FileManipulationError):
+            sync(os.path.join(self.tmpdir, "missing"), self.dest)
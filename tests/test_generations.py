@@ -0,0 +1,73 @@
+import os
+
+from codetree.fileutils import FileManipulationError
+from codetree.generations import Generations, clone_tree
+
+from .test_config import ConfigTestCase, write
+
+
+class TestGenerations(ConfigTestCase):
+    def setUp(self):
+        super(TestGenerations, self).setUp()
+        self.source = os.path.join(self.sources, "content")
+        os.mkdir(self.source)
+        write(os.path.join(self.source, "a"), "a")
+        self.cfgfile = os.path.join(self.tmpdir, "codetree.cfg")
+        write(self.cfgfile, "content  {}\n".format(self.source))
+        self.path = os.path.join(self.tmpdir, "gens")
+
+    def build(self, keep=3):
+        generations = Generations(self.path, keep=keep)
+        ok = generations.build([self.cfgfile], {"cache_dir": self.cache_dir})
+        return generations, ok
+
+    def live(self, *parts):
+        return os.path.join(self.path, "current", *parts)
+
+    def test_clone_tree(self):
+        tree = os.path.join(self.tmpdir, "clone")
+        os.makedirs(os.path.join(self.source, ".bzr", "checkout"))
+        write(os.path.join(self.source, ".bzr", "checkout", "dirstate"))
+        os.symlink("a", os.path.join(self.source, "link"))
+        clone_tree(self.source, tree)
+        self.assertEqual(os.stat(os.path.join(tree, "a")).st_ino,
+                         os.stat(os.path.join(self.source, "a")).st_ino)
+        self.assertEqual(os.readlink(os.path.join(tree, "link")), "a")
+        dirstate = os.path.join(".bzr", "checkout", "dirstate")
+        self.assertNotEqual(os.stat(os.path.join(tree, dirstate)).st_ino,
+                            os.stat(os.path.join(self.source, dirstate)).st_ino)
+        self.assertEqual(os.stat(os.path.join(tree, dirstate)).st_mtime,
+                         os.stat(os.path.join(self.source, dirstate)).st_mtime)
+
+    def test_generations(self):
+        generations, ok = self.build()
+        self.assertTrue(ok)
+        self.assertEqual(generations.current(), "1")
+        with open(self.live("content", "a")) as f:
+            self.assertEqual(f.read(), "a")
+
+        # An unchanged file is shared with the previous generation
+        generations, ok = self.build()
+        self.assertEqual(generations.current(), "2")
+        old = os.path.join(self.path, "generations", "1", "content", "a")
+        self.assertEqual(os.stat(self.live("content", "a")).st_ino, os.stat(old).st_ino)
+
+        # A changed one is not, and the old generation keeps its copy
+        write(os.path.join(self.source, "a"), "changed")
+        generations, ok = self.build(keep=2)
+        self.assertEqual(generations.current(), "3")
+        with open(self.live("content", "a")) as f:
+            self.assertEqual(f.read(), "changed")
+        with open(os.path.join(self.path, "generations", "2", "content", "a")) as f:
+            self.assertEqual(f.read(), "a")
+        self.assertEqual(generations.names(), ["2", "3"])
+
+    def test_failed_build_keeps_current(self):
+        self.build()
+        write(self.cfgfile, "content  {}\n".format(os.path.join(self.sources, "missing")))
+        with self.assertRaises(FileManipulationError):
+            self.build()
+        generations = Generations(self.path)
+        self.assertEqual(generations.current(), "1")
+        self.assertEqual(generations.names(), ["1"])
+        self.assertTrue(os.path.exists(self.live("content", "a")))
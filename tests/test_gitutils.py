@@ -0,0 +1,148 @@
+import os
+import shutil
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from codetree.config import BuildContext
+from codetree.gitutils import git, read_head, remote_url
+from codetree.handlers import (
+    GitSourceHandler,
+    NotSameBranch,
+    handler_for_url,
+)
+
+from .test_handlers import shellcmd
+
+GIT = "git -c user.name=codetree -c user.email=codetree@example.com"
+
+
+class GitTestCase(TestCase):
+    def setUp(self):
+        super(GitTestCase, self).setUp()
+        self.tmpdir = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.work = os.path.join(self.tmpdir, "work")
+        self.bare = os.path.join(self.tmpdir, "repo.git")
+        self.url = "git+file://" + self.bare
+        shellcmd("git init -q -b main {0} && cd {0} && echo one > a && git add a && "
+                 "{1} commit -q -m one && {1} tag v1 && "
+                 "echo two > a && {1} commit -q -am two && "
+                 "git checkout -q -b stable HEAD~1 && echo fix > b && git add b && "
+                 "{1} commit -q -m fix && git checkout -q main && "
+                 "git clone -q --bare {0} {2}".format(self.work, GIT, self.bare))
+        self.dest = os.path.join(self.tmpdir, "tree", "dest")
+
+    def commit(self, message):
+        shellcmd("cd {0} && echo {1} > a && {2} commit -q -am {1} && "
+                 "git push -q {3} main".format(self.work, message, GIT, self.bare))
+
+    def rev(self, ref):
+        return git("-C", self.bare, "rev-parse", ref).strip()
+
+    def read(self, name):
+        with open(os.path.join(self.dest, name)) as f:
+            return f.read().strip()
+
+
+class TestGitSourceHandler(GitTestCase):
+    def test_url_handling(self):
+        for url in ("git://example.com/a.git", "git+ssh://example.com/a.git",
+                    "git+https://example.com/a.git"):
+            self.assertIsInstance(handler_for_url(url), GitSourceHandler)
+        self.assertEqual(handler_for_url("git+https://example.com/a.git").source,
+                         "https://example.com/a.git")
+
+    def test_shallow_clone(self):
+        gh = GitSourceHandler(self.url)
+        self.assertTrue(gh.get(self.dest))
+        self.assertEqual(self.read("a"), "two")
+        self.assertEqual(read_head(self.dest), self.rev("main"))
+        self.assertEqual(remote_url(self.dest), "file://" + self.bare)
+        self.assertTrue(os.path.exists(os.path.join(self.dest, ".git", "shallow")))
+
+        self.commit("three")
+        self.assertTrue(gh.get(self.dest))
+        self.assertEqual(self.read("a"), "three")
+
+    def test_sparse_checkout(self):
+        gh = GitSourceHandler(self.url)
+        self.assertTrue(gh.get(self.dest, {"branch": "stable", "exclude": "a"}))
+        self.assertEqual(sorted(os.listdir(self.dest)), [".git", "b"])
+        # The same commit with another selection
+        self.assertTrue(gh.get(self.dest, {"branch": "stable", "include": "a"}))
+        self.assertEqual(sorted(os.listdir(self.dest)), [".git", "a"])
+        self.assertTrue(gh.get(self.dest, {"branch": "stable"}))
+        self.assertEqual(sorted(os.listdir(self.dest)), [".git", "a", "b"])
+        self.assertFalse(gh.get(self.dest, {"path": "sub"}))
+
+    def test_branch_tag_rev(self):
+        gh = GitSourceHandler(self.url)
+        self.assertTrue(gh.get(self.dest, {"branch": "stable"}))
+        self.assertEqual(self.read("b"), "fix")
+        self.assertEqual(git("-C", self.dest, "symbolic-ref", "HEAD").strip(),
+                         "refs/heads/stable")
+
+        self.assertTrue(gh.get(self.dest, {"tag": "v1"}))
+        self.assertEqual(self.read("a"), "one")
+        self.assertFalse(os.path.exists(os.path.join(self.dest, "b")))
+
+        self.assertTrue(gh.get(self.dest, {"rev": self.rev("main")}))
+        self.assertEqual(self.read("a"), "two")
+        # Abbreviated revs need the full history
+        self.assertTrue(gh.get(self.dest, {"rev": self.rev("v1")[:10]}))
+        self.assertEqual(self.read("a"), "one")
+
+    def test_other_source(self):
+        other = os.path.join(self.tmpdir, "other.git")
+        shellcmd("git clone -q --bare {} {}".format(self.bare, other))
+        self.assertTrue(GitSourceHandler(self.url).get(self.dest))
+        gh = GitSourceHandler("git+file://" + other)
+        with self.assertRaises(NotSameBranch):
+            gh.get(self.dest)
+        self.assertTrue(gh.get(self.dest, {"overwrite": "true"}))
+        self.assertEqual(remote_url(self.dest), "file://" + other)
+
+    def test_fingerprints(self):
+        gh = GitSourceHandler(self.url)
+        self.assertEqual(gh.source_fingerprint({}), "HEAD " + self.rev("main"))
+        self.assertEqual(gh.source_fingerprint({"tag": "v1"}),
+                         "refs/tags/v1 " + self.rev("v1"))
+        self.assertIsNone(gh.dest_fingerprint(self.dest, {}))
+        gh.get(self.dest)
+        before = gh.dest_fingerprint(self.dest, {})
+        self.assertIn(self.rev("main"), before)
+        self.commit("three")
+        gh.get(self.dest)
+        self.assertNotEqual(gh.dest_fingerprint(self.dest, {}), before)
+
+
+class TestGitCache(GitTestCase):
+    def test_trees_share_the_mirror(self):
+        context = BuildContext(os.path.join(self.tmpdir, "cache"), git_cache=True)
+        gh = GitSourceHandler(self.url)
+        gh.context = context
+        self.assertTrue(gh.get(self.dest, {"branch": "stable"}))
+        self.assertEqual(self.read("b"), "fix")
+        mirror = context.git_cache.mirror(gh.source)
+        with open(os.path.join(self.dest, ".git", "objects", "info", "alternates")) as f:
+            self.assertEqual(f.read().strip(), os.path.join(mirror, "objects"))
+
+        # The mirror is fetched once per build
+        self.commit("three")
+        self.assertTrue(gh.get(self.dest))
+        self.assertEqual(self.read("a"), "two")
+
+        context = BuildContext(os.path.join(self.tmpdir, "cache"), git_cache=True)
+        gh.context = context
+        self.assertTrue(gh.get(self.dest))
+        self.assertEqual(self.read("a"), "three")
+        self.assertTrue(gh.get(self.dest, {"tag": "v1"}))
+        self.assertEqual(self.read("a"), "one")
+
+    def test_mirror_is_never_pruned(self):
+        context = BuildContext(os.path.join(self.tmpdir, "cache"), git_cache=True)
+        gh = GitSourceHandler(self.url)
+        gh.context = context
+        mirror = context.git_cache.update(gh.source)
+        self.assertEqual(git("-C", mirror, "config", "gc.auto").strip(), "0")
+        self.assertEqual(git("-C", mirror, "config", "gc.pruneExpire").strip(), "never")
@@ -1,10 +1,13 @@
 import os
+import hashlib
 from unittest import TestCase
 from urlparse import urlparse
 from tempfile import mkdtemp
 from urllib2 import URLError
 import subprocess
 import shutil
+import urllib
+import mimetools
 try:
     from cStringIO import StringIO
 except:
@@ -22,9 +25,16 @@ from codetree.handlers import (
     CommandFailure,
     SourceHandler,
     BzrSourceHandler,
+    NotABranch,
+    NotSameBranch,
     LocalHandler,
     HttpFileHandler,
+    ArchiveHandler,
+    handler_for_url,
 )
+from codetree import archive, bzrutils, fileutils
+from tests.httpserver import StandInServer
+from tests.test_archive import make_tar
 
 BzrURLs = (
     "bzr://example.com/foo/",
@@ -50,6 +60,12 @@ LocalURLs = (
 )
 
 
+def fake_response(body, headers="", code=200):
+    "A urllib2 response with the given body and header lines"
+    return urllib.addinfourl(StringIO(body), mimetools.Message(StringIO(headers)),
+                             HttpURLs[0], code)
+
+
 def was_called_with_cmd(mock, cmd):
     for call_args in mock.call_args_list:
         if call_args[0][0] == cmd:
@@ -124,6 +140,9 @@ class BzrSourceHandlerTest(TestCase):
         bh = BzrSourceHandler(https_url)
         self.assertTrue(bh.source.startswith("https"))
 
+        bh = BzrSourceHandler("bzr+file:///srv/repo")
+        self.assertEqual(bh.source, "file:///srv/repo")
+
     @patch("codetree.handlers.check_output")
     @patch("codetree.handlers.logging")
     @patch("codetree.handlers.os.path.exists", return_value=True)
@@ -132,6 +151,7 @@ class BzrSourceHandlerTest(TestCase):
         source = BzrURLs[0]
         dest = "foo"
         bh = BzrSourceHandler(source)
+        bh.is_bzr_branch = MagicMock(return_value=True)
         bh.is_same_branch = MagicMock(return_value=False)
 
         # overwrite (delete) existing when asked
@@ -143,8 +163,10 @@ class BzrSourceHandlerTest(TestCase):
         self.assertFalse(bh.get(dest, options))
 
         # don't overwrite if not asked
+        _rmtree.reset_mock()
         options = {"overwrite": False}
-        self.assertFalse(bh.get(dest, options))
+        with self.assertRaises(NotSameBranch):
+            bh.get(dest, options)
         _rmtree.assert_not_called()
 
         # don't overwrite if source = parent
@@ -159,6 +181,7 @@ class BzrSourceHandlerTest(TestCase):
         source = BzrURLs[0]
         dest = "foo"
         bh = BzrSourceHandler(source)
+        bh.is_bzr_branch = MagicMock(return_value=True)
         self.assertTrue(bh.get(dest))
         self.assertTrue(was_called_with_cmd(_call, ('bzr', 'branch', source, dest)))
 
@@ -171,6 +194,7 @@ class BzrSourceHandlerTest(TestCase):
         source = BzrURLs[0]
         dest = "foo/bar/baz"
         bh = BzrSourceHandler(source)
+        bh.is_bzr_branch = MagicMock(return_value=True)
         self.assertTrue(bh.get(dest))
         _makedirs.assert_called_with(os.path.dirname(dest))
 
@@ -180,6 +204,7 @@ class BzrSourceHandlerTest(TestCase):
         source = BzrURLs[0]
         dest = "foo"
         bh = BzrSourceHandler(source)
+        bh.is_bzr_branch = MagicMock(return_value=True)
         bh.is_same_branch = MagicMock(return_value=True)
         self.assertTrue(bh.get(dest))
         assert(was_called_with_cmd(_call, ('bzr', 'pull', '-d', dest)))
@@ -192,12 +217,13 @@ class BzrSourceHandlerTest(TestCase):
         source = BzrURLs[0]
         dest = "foo"
         bh = BzrSourceHandler(source)
+        bh.is_bzr_branch = MagicMock(return_value=True)
         bh.is_same_branch = MagicMock()
 
         revno = "1"
         options = {"revno": "1"}
         self.assertTrue(bh.get(dest, options))
-        assert(was_called_with_cmd(_call, ('bzr', 'update', dest, '-r', revno)))
+        assert(was_called_with_cmd(_call, ('bzr', 'branch', '-r', revno, source, dest)))
 
     def test_same_branch(self):
         parent = mkdtemp()
@@ -224,6 +250,110 @@ class BzrSourceHandlerTest(TestCase):
         self.assertFalse(bh.is_same_branch(stdalone), "test: is standalone")
 
 
+class TestBzrModes(TestCase):
+    def setUp(self):
+        super(TestBzrModes, self).setUp()
+        self.tmpdir = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.branch = os.path.join(self.tmpdir, "branch")
+        self.dest = os.path.join(self.tmpdir, "dest")
+        shellcmd("bzr init -q {0} && cd {0} && mkdir lib && echo one > lib/one "
+                 "&& echo two > two && bzr add -q && bzr commit -q -m 1".format(self.branch))
+
+    def commit(self, script):
+        shellcmd("cd {} && {} && bzr add -q && bzr commit -q -m next".format(
+            self.branch, script))
+
+    def test_export(self):
+        bh = BzrSourceHandler(self.branch)
+        options = {"mode": "export"}
+        self.assertTrue(bh.get(self.dest, options))
+        self.assertFalse(os.path.exists(os.path.join(self.dest, ".bzr")))
+        with open(os.path.join(self.dest, "lib", "one")) as f:
+            self.assertEqual(f.read(), "one\n")
+        exported = bzrutils.read_export(self.dest)
+        self.assertEqual(exported["revno"], "1")
+        fingerprint = bh.dest_fingerprint(self.dest, options)
+
+        # Files put in by other means survive updates; removed ones don't
+        with open(os.path.join(self.dest, "local"), "w") as f:
+            f.write("local")
+        self.commit("bzr rm -q lib && echo three > three")
+        bh = BzrSourceHandler(self.branch)
+        two = os.stat(os.path.join(self.dest, "two"))
+        self.assertTrue(bh.get(self.dest, options))
+        self.assertEqual(sorted(os.listdir(self.dest)),
+                         [bzrutils.EXPORT_MARKER, "local", "three", "two"])
+        self.assertEqual(os.stat(os.path.join(self.dest, "two")).st_ino, two.st_ino)
+        self.assertNotEqual(bh.dest_fingerprint(self.dest, options), fingerprint)
+
+        # An export at the requested revision is left alone
+        with patch("codetree.handlers.check_output") as _call:
+            self.assertTrue(bh.get(self.dest, options))
+            self.assertTrue(bh.get(self.dest, {"mode": "export", "revno": "2"}))
+            self.assertFalse(_call.called)
+        self.assertTrue(bh.get(self.dest, {"mode": "export", "revno": "1"}))
+        self.assertTrue(os.path.exists(os.path.join(self.dest, "lib", "one")))
+        self.assertFalse(os.path.exists(os.path.join(self.dest, "three")))
+
+    def test_export_refuses_other_trees(self):
+        os.mkdir(self.dest)
+        bh = BzrSourceHandler(self.branch)
+        with self.assertRaises(NotABranch):
+            bh.get(self.dest, {"mode": "export"})
+        self.assertTrue(bh.get(self.dest, {"mode": "export", "overwrite": "true"}))
+        other = BzrSourceHandler(os.path.join(self.tmpdir, "other"))
+        with self.assertRaises(NotSameBranch):
+            other.get(self.dest, {"mode": "export"})
+
+    def test_lightweight(self):
+        bh = BzrSourceHandler(self.branch)
+        options = {"mode": "lightweight"}
+        self.assertTrue(bh.get(self.dest, options))
+        self.assertFalse(os.path.exists(os.path.join(self.dest, ".bzr", "repository")))
+        self.assertIsNotNone(bh.dest_fingerprint(self.dest, options))
+        self.commit("echo three > three")
+        self.assertTrue(bh.get(self.dest, options))
+        self.assertTrue(os.path.exists(os.path.join(self.dest, "three")))
+        self.assertTrue(bh.get(self.dest, {"mode": "lightweight", "revno": "1"}))
+        self.assertFalse(os.path.exists(os.path.join(self.dest, "three")))
+
+        # A lightweight checkout is not a branch, nor the other way round
+        with self.assertRaises(NotSameBranch):
+            bh.get(self.dest, {})
+        self.assertTrue(bh.get(self.dest, {"overwrite": "true"}))
+        self.assertTrue(os.path.exists(os.path.join(self.dest, ".bzr", "repository")))
+        with self.assertRaises(NotSameBranch):
+            bh.get(self.dest, options)
+
+    def test_unknown_mode(self):
+        bh = BzrSourceHandler(self.branch)
+        self.assertFalse(bh.get(self.dest, {"mode": "bogus"}))
+
+    def test_partial_export(self):
+        self.commit("mkdir lib/old && echo old > lib/old/x && echo pyc > lib/one.pyc")
+        bh = BzrSourceHandler(self.branch)
+        # Filters make an export by default
+        options = {"path": "lib", "exclude": "*.pyc"}
+        with patch("codetree.handlers.archive.Extractor.file", autospec=True,
+                   side_effect=archive.Extractor.file) as _file:
+            self.assertTrue(bh.get(self.dest, options))
+        # Nothing outside the selection was written to the tree
+        self.assertEqual(sorted(os.path.basename(call[0][1]) for call in _file.call_args_list),
+                         ["one", "x"])
+        self.assertEqual(sorted(os.listdir(self.dest)),
+                         [bzrutils.EXPORT_MARKER, "old", "one"])
+        self.assertTrue(bh.dest_fingerprint(self.dest, options).startswith("export"))
+
+        # A different selection of the same revision is exported again
+        options = dict(options, exclude="*.pyc:old")
+        self.assertTrue(bh.get(self.dest, options))
+        self.assertEqual(sorted(os.listdir(self.dest)), [bzrutils.EXPORT_MARKER, "one"])
+
+        self.assertFalse(bh.get(os.path.join(self.tmpdir, "other"),
+                                {"mode": "branch", "path": "lib"}))
+
+
 class TestLocalHandler(TestCase):
     def test_url_handling(self):
         for local_url in LocalURLs:
@@ -268,28 +398,84 @@ class TestLocalHandler(TestCase):
         _copy.assert_called_with("/some/file", "foo")
 
 
+class TestPartialLocalCopies(TestCase):
+    def setUp(self):
+        super(TestPartialLocalCopies, self).setUp()
+        self.tmpdir = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.source = os.path.join(self.tmpdir, "source")
+        self.dest = os.path.join(self.tmpdir, "dest")
+        shellcmd("mkdir -p {0}/conf/old {0}/src && touch {0}/conf/a.cfg "
+                 "{0}/conf/old/b.cfg {0}/conf/c.txt {0}/src/x.py".format(self.source))
+
+    def files(self):
+        return sorted(os.path.relpath(os.path.join(dirpath, name), self.dest)
+                      for dirpath, dirnames, filenames in os.walk(self.dest)
+                      for name in filenames)
+
+    def test_path_include_exclude(self):
+        lh = LocalHandler(self.source)
+        options = {"path": "conf", "include": "*.cfg", "exclude": "old"}
+        self.assertTrue(lh.get(self.dest, options))
+        self.assertEqual(self.files(), ["a.cfg"])
+        self.assertEqual(lh.source_fingerprint(options),
+                         fileutils.tree_summary(os.path.join(self.source, "conf")))
+
+    def test_walks_only_matching_subtrees(self):
+        with patch("codetree.fileutils.sync_dir", wraps=fileutils.sync_dir) as _sync_dir:
+            self.assertTrue(LocalHandler(self.source).get(
+                self.dest, {"include": "conf/*.cfg", "exclude": "conf/old"}))
+        self.assertEqual([os.path.relpath(call[0][0], self.source)
+                          for call in _sync_dir.call_args_list], [".", "conf"])
+        self.assertEqual(self.files(), ["conf/a.cfg"])
+
+    def test_links_whole_paths_only(self):
+        lh = LocalHandler(self.source)
+        self.assertTrue(lh.get(self.dest, {"method": "link", "path": "conf"}))
+        self.assertEqual(os.readlink(self.dest), os.path.join(self.source, "conf"))
+        self.assertFalse(lh.get(os.path.join(self.tmpdir, "other"),
+                                {"method": "link", "include": "*.cfg"}))
+        self.assertFalse(lh.get(os.path.join(self.tmpdir, "other"), {"path": "missing"}))
+
+
 class TestHttpFileHandler(TestCase):
+    def setUp(self):
+        super(TestHttpFileHandler, self).setUp()
+        self.tmpdir = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.destfile = os.path.join(self.tmpdir, "foo")
+        patcher = patch.object(HttpFileHandler, "retry_delay", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     def test_url_handling(self):
         for http_url in HttpURLs:
             assert(urlparse(http_url).scheme in HttpFileHandler.schemes)
 
-    @patch('codetree.handlers.os.unlink')
-    @patch('codetree.handlers.os.path.exists')
     @patch('codetree.handlers.urllib2.urlopen')
-    def test_gets_file(self, _urlopen, _exists, _unlink):
-        destfile = "foo"
-
-        _urlopen.return_value = StringIO("words words")
+    def test_gets_file(self, _urlopen):
+        _urlopen.return_value = fake_response("words words")
         hh = HttpFileHandler(HttpURLs[0])
 
         # New file
-        _open = mock_open()
-        _exists.return_value = False
-        with patch('codetree.handlers.open', _open, create=True):
-            self.assertTrue(hh.get(destfile))
-        self.assertFalse(_unlink.called)
-        _open.assert_called_with(destfile, "w")
+        self.assertTrue(hh.get(self.destfile))
         _urlopen.assert_called_with(HttpURLs[0])
+        with open(self.destfile) as f:
+            self.assertEqual(f.read(), "words words")
+        # No temporary files are left behind
+        self.assertEqual(os.listdir(self.tmpdir), ["foo"])
+
+    @patch('codetree.handlers.urllib2.urlopen')
+    def test_gets_file_in_chunks(self, _urlopen):
+        body = StringIO("x" * 100)
+        read = MagicMock(side_effect=body.read)
+        _urlopen.return_value = fake_response("")
+        _urlopen.return_value.read = read
+        hh = HttpFileHandler(HttpURLs[0])
+
+        self.assertTrue(hh.get(self.destfile, options={"buffer-size": "16"}))
+        read.assert_called_with(16)
+        self.assertEqual(os.path.getsize(self.destfile), 100)
 
     @patch('codetree.handlers.os.unlink')
     @patch('codetree.handlers.os.path.exists')
@@ -309,23 +495,19 @@ class TestHttpFileHandler(TestCase):
         self.assertFalse(_open.called)
         self.assertFalse(_urlopen.called)
 
-    @patch('codetree.handlers.os.unlink')
-    @patch('codetree.handlers.os.path.exists')
     @patch('codetree.handlers.urllib2.urlopen')
-    def test_gets_file_with_overwite(self, _urlopen, _exists, _unlink):
-        destfile = "foo"
+    def test_gets_file_with_overwite(self, _urlopen):
+        with open(self.destfile, "w") as f:
+            f.write("old words")
 
-        _urlopen.return_value = StringIO("words words")
+        _urlopen.return_value = fake_response("words words")
         hh = HttpFileHandler(HttpURLs[0])
 
         # Overwrite existing file
-        _open = mock_open()
-        _exists.return_value = True
-        with patch('codetree.handlers.open', _open, create=True):
-            self.assertTrue(hh.get(destfile, options={"overwrite": True}))
-        _unlink.assert_called_with(destfile)
-        _open.assert_called_with(destfile, "w")
+        self.assertTrue(hh.get(self.destfile, options={"overwrite": True}))
         _urlopen.assert_called_with(HttpURLs[0])
+        with open(self.destfile) as f:
+            self.assertEqual(f.read(), "words words")
 
     @patch('codetree.handlers.os.unlink')
     @patch('codetree.handlers.os.path.exists')
@@ -342,3 +524,158 @@ class TestHttpFileHandler(TestCase):
         _urlopen.side_effect = URLError('failed')
         with patch('codetree.handlers.open', _open, create=True):
             self.assertFalse(hh.get(destfile))
+
+    @patch('codetree.handlers.urllib2.urlopen')
+    def test_interrupted_download_keeps_dest(self, _urlopen):
+        with open(self.destfile, "w") as f:
+            f.write("old words")
+
+        def interrupted(*args):
+            response = fake_response("")
+            response.read = MagicMock(side_effect=["words", IOError("reset")])
+            return response
+        _urlopen.side_effect = interrupted
+        hh = HttpFileHandler(HttpURLs[0])
+
+        self.assertFalse(hh.get(self.destfile, options={"overwrite": True}))
+        self.assertEqual(_urlopen.call_count, 1 + HttpFileHandler.retries)
+        with open(self.destfile) as f:
+            self.assertEqual(f.read(), "old words")
+        # Without a validator there is nothing to resume from
+        self.assertEqual(os.listdir(self.tmpdir), ["foo"])
+
+    @patch('codetree.handlers.urllib2.urlopen')
+    def test_local_errors_are_not_retried(self, _urlopen):
+        _urlopen.side_effect = lambda *args: fake_response("words")
+        hh = HttpFileHandler(HttpURLs[0])
+        self.assertFalse(hh.get(os.path.join(self.tmpdir, "missing", "foo")))
+        self.assertEqual(_urlopen.call_count, 1)
+
+    def test_resumes_interrupted_download(self):
+        body = os.urandom(100000)
+        with StandInServer({"/big": body}) as server:
+            server.drops["/big"] = 30000
+            hh = HttpFileHandler(server.url("/big"))
+            self.assertTrue(hh.get(self.destfile))
+            self.assertEqual(server.requests[1][1]["range"], "bytes=30000-")
+            self.assertEqual(server.sent, 100000)
+        with open(self.destfile, "rb") as f:
+            self.assertEqual(f.read(), body)
+        self.assertEqual(os.listdir(self.tmpdir), ["foo"])
+
+    def test_later_run_resumes(self):
+        body = os.urandom(100000)
+        with StandInServer({"/big": body}) as server:
+            server.drops["/big"] = 40000
+            hh = HttpFileHandler(server.url("/big"))
+            self.assertFalse(hh.get(self.destfile, {"retries": "0"}))
+            self.assertEqual(sorted(os.listdir(self.tmpdir)), [".foo.part", ".foo.part.json"])
+
+            self.assertTrue(hh.get(self.destfile))
+            self.assertEqual(server.sent, 100000)
+            # A changed file is fetched whole: If-Range no longer matches
+            server.drops["/big"] = 40000
+            self.assertFalse(hh.get(self.destfile, {"retries": "0", "overwrite": "true"}))
+            server.files["/big"] = body[::-1]
+            self.assertTrue(hh.get(self.destfile, {"overwrite": "true"}))
+        with open(self.destfile, "rb") as f:
+            self.assertEqual(f.read(), body[::-1])
+        self.assertEqual(os.listdir(self.tmpdir), ["foo"])
+
+    def test_server_without_ranges(self):
+        body = os.urandom(100000)
+        with StandInServer({"/big": body}, ranges=False) as server:
+            server.drops["/big"] = 40000
+            hh = HttpFileHandler(server.url("/big"))
+            self.assertTrue(hh.get(self.destfile))
+            self.assertEqual(server.sent, 140000)
+        with open(self.destfile, "rb") as f:
+            self.assertEqual(f.read(), body)
+
+    def test_pinned_download(self):
+        body = os.urandom(1000)
+        sha256 = hashlib.sha256(body).hexdigest()
+        with StandInServer({"/pinned": body}) as server:
+            hh = HttpFileHandler(server.url("/pinned"))
+            self.assertEqual(hh.source_fingerprint({"sha256": sha256}),
+                             "sha256:" + sha256)
+            self.assertFalse(hh.get(self.destfile, {"sha256": "0" * 64}))
+            self.assertEqual(os.listdir(self.tmpdir), [])
+            self.assertTrue(hh.get(self.destfile, {"sha256": sha256}))
+            self.assertEqual(len(server.requests), 2)
+            # A dest that matches already is not downloaded again
+            self.assertTrue(hh.get(self.destfile, {"sha256": sha256}))
+            self.assertEqual(len(server.requests), 2)
+            # Nor is one that doesn't replaced without overwrite
+            with open(self.destfile, "w") as f:
+                f.write("tampered")
+            self.assertFalse(hh.get(self.destfile, {"sha256": sha256}))
+            self.assertTrue(hh.get(self.destfile, {"sha256": sha256, "overwrite": "true"}))
+            self.assertEqual(len(server.requests), 3)
+        with open(self.destfile, "rb") as f:
+            self.assertEqual(f.read(), body)
+
+    def test_pinned_resume(self):
+        body = os.urandom(100000)
+        with StandInServer({"/big": body}) as server:
+            server.drops["/big"] = 30000
+            hh = HttpFileHandler(server.url("/big"))
+            self.assertTrue(hh.get(self.destfile, {"sha512": hashlib.sha512(body).hexdigest()}))
+            self.assertEqual(server.sent, 100000)
+
+
+
+class TestArchiveHandler(TestCase):
+    def setUp(self):
+        super(TestArchiveHandler, self).setUp()
+        self.tmpdir = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.dest = os.path.join(self.tmpdir, "pkg")
+        self.tarball = make_tar([("pkg-1.0/README", "read me")], "w:gz")
+
+    def test_url_handling(self):
+        ah = handler_for_url("archive+https://example.com/pkg.tar.gz")
+        self.assertIsInstance(ah, ArchiveHandler)
+        self.assertEqual(ah.source, "https://example.com/pkg.tar.gz")
+
+    def test_extracts_archive(self):
+        with StandInServer({"/pkg.tgz": self.tarball}) as server:
+            ah = ArchiveHandler("archive+" + server.url("/pkg.tgz"))
+            self.assertTrue(ah.get(self.dest, {"strip-components": "1"}))
+            with open(os.path.join(self.dest, "README")) as f:
+                self.assertEqual(f.read(), "read me")
+
+    def test_pinned_archive(self):
+        sha256 = hashlib.sha256(self.tarball).hexdigest()
+        with StandInServer({"/pkg.tgz": self.tarball}) as server:
+            ah = ArchiveHandler("archive+" + server.url("/pkg.tgz"))
+            self.assertFalse(ah.get(self.dest, {"sha256": "0" * 64}))
+            self.assertEqual(os.listdir(self.tmpdir), [])
+            self.assertTrue(ah.get(self.dest, {"sha256": sha256}))
+            self.assertEqual(ah.source_fingerprint({"sha256": sha256}), "sha256:" + sha256)
+            # An existing dest is only replaced with overwrite
+            self.assertFalse(ah.get(self.dest))
+            self.assertTrue(ah.get(self.dest, {"overwrite": "true"}))
+            self.assertEqual(os.listdir(self.dest), ["pkg-1.0"])
+
+    def test_http_extract_option(self):
+        with StandInServer({"/pkg.tgz": self.tarball}) as server:
+            hh = HttpFileHandler(server.url("/pkg.tgz"))
+            self.assertTrue(hh.get(self.dest, {"extract": "true"}))
+            self.assertTrue(os.path.isfile(os.path.join(self.dest, "pkg-1.0", "README")))
+
+    def test_partial_archive(self):
+        tarball = make_tar([("pkg-1.0/README", "read me"), ("pkg-1.0/doc/a", "a")], "w:gz")
+        with StandInServer({"/pkg.tgz": tarball}) as server:
+            ah = ArchiveHandler("archive+" + server.url("/pkg.tgz"))
+            self.assertTrue(ah.get(self.dest, {"path": "pkg-1.0", "include": "doc"}))
+            self.assertEqual(os.listdir(self.dest), ["doc"])
+            # Plain files can't be partial
+            hh = HttpFileHandler(server.url("/pkg.tgz"))
+            self.assertFalse(hh.get(os.path.join(self.tmpdir, "file"), {"path": "doc"}))
+
+    def test_bad_archive(self):
+        with StandInServer({"/pkg.tgz": "not an archive"}) as server:
+            hh = HttpFileHandler(server.url("/pkg.tgz"))
+            self.assertFalse(hh.get(self.dest, {"extract": "true"}))
+            self.assertFalse(os.path.exists(self.dest))
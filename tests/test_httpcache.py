@@ -0,0 +1,100 @@
+import os
+import shutil
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from codetree.config import BuildContext
+from codetree.handlers import HttpFileHandler
+from codetree.httpcache import HttpMetadataCache
+
+from .httpserver import StandInServer
+
+
+class TestConditionalFetch(TestCase):
+    def setUp(self):
+        super(TestConditionalFetch, self).setUp()
+        self.tmpdir = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.dest = os.path.join(self.tmpdir, "foo.txt")
+        self.cache_dir = os.path.join(self.tmpdir, "cache")
+
+    def handler(self, url):
+        handler = HttpFileHandler(url)
+        handler.context = BuildContext(self.cache_dir)
+        return handler
+
+    def fetch(self, url):
+        handler = self.handler(url)
+        result = handler.get(self.dest, {"overwrite": "true"})
+        handler.context.close()
+        return result
+
+    def test_not_modified_is_a_noop(self):
+        with StandInServer({"/foo.txt": "words words"}) as server:
+            url = server.url("/foo.txt")
+            self.assertTrue(self.fetch(url))
+            mtime = os.path.getmtime(self.dest)
+
+            # A second build, with a fresh context, revalidates
+            self.assertTrue(self.fetch(url))
+            self.assertEqual(len(server.requests), 2)
+            self.assertIn("if-none-match", server.requests[1][1])
+            self.assertIn("if-modified-since", server.requests[1][1])
+            self.assertEqual(os.path.getmtime(self.dest), mtime)
+
+            # A changed upstream file is downloaded again
+            server.files["/foo.txt"] = "new words"
+            self.assertTrue(self.fetch(url))
+            with open(self.dest) as f:
+                self.assertEqual(f.read(), "new words")
+
+    def test_modified_dest_is_not_revalidated(self):
+        with StandInServer({"/foo.txt": "words words"}) as server:
+            url = server.url("/foo.txt")
+            self.assertTrue(self.fetch(url))
+            with open(self.dest, "w") as f:
+                f.write("local edits")
+
+            self.assertTrue(self.fetch(url))
+            self.assertNotIn("if-none-match", server.requests[1][1])
+            with open(self.dest) as f:
+                self.assertEqual(f.read(), "words words")
+
+    def test_no_validators(self):
+        with StandInServer({"/foo.txt": "words words"}, validators=False) as server:
+            url = server.url("/foo.txt")
+            self.assertTrue(self.fetch(url))
+            self.assertTrue(self.fetch(url))
+            self.assertNotIn("if-modified-since", server.requests[1][1])
+
+
+class TestHttpMetadataCache(TestCase):
+    def setUp(self):
+        super(TestHttpMetadataCache, self).setUp()
+        self.tmpdir = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, "cache", "http-metadata.json")
+        self.dest = os.path.join(self.tmpdir, "dest")
+        with open(self.dest, "w") as f:
+            f.write("words")
+
+    def test_concurrent_caches_merge(self):
+        first = HttpMetadataCache(self.path)
+        second = HttpMetadataCache(self.path)
+        first.update("http://a/", {"ETag": '"a"'}, self.dest)
+        second.update("http://b/", {"ETag": '"b"'}, self.dest)
+        first.save()
+        second.save()
+
+        merged = HttpMetadataCache(self.path)
+        self.assertEqual(merged.validators("http://a/", self.dest),
+                         {"If-None-Match": '"a"'})
+        self.assertEqual(merged.validators("http://b/", self.dest),
+                         {"If-None-Match": '"b"'})
+
+    def test_corrupt_cache_is_ignored(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, "w") as f:
+            f.write("{not json")
+        cache = HttpMetadataCache(self.path)
+        self.assertEqual(cache.validators("http://a/", self.dest), {})
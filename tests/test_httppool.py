@@ -0,0 +1,90 @@
+import os
+import shutil
+import threading
+from tempfile import mkdtemp
+from unittest import TestCase
+from urllib2 import HTTPError, URLError
+
+from codetree.config import BuildContext
+from codetree.handlers import HttpFileHandler
+from codetree.httppool import ConnectionPool
+
+from .httpserver import StandInServer
+
+
+class TestConnectionPool(TestCase):
+    def test_reuses_connections(self):
+        pool = ConnectionPool()
+        with StandInServer({"/a": "aaa", "/b": "bbb"}) as server:
+            for path in ("/a", "/b", "/a"):
+                response = pool.urlopen(server.url(path))
+                self.assertEqual(response.read(), path[1:] * 3)
+                response.close()
+        self.assertEqual(pool.opened, 1)
+        self.assertEqual(pool.reused, 2)
+
+    def test_unread_response_is_not_reused(self):
+        pool = ConnectionPool()
+        with StandInServer({"/a": "a" * 1000}) as server:
+            response = pool.urlopen(server.url("/a"))
+            response.read(10)
+            response.close()
+            pool.urlopen(server.url("/a")).close()
+        self.assertEqual(pool.opened, 2)
+
+    def test_limits_connections_per_host(self):
+        pool = ConnectionPool(max_per_host=1)
+        with StandInServer({"/a": "aaa"}) as server:
+            first = pool.urlopen(server.url("/a"))
+            waiter = threading.Thread(target=pool.urlopen, args=(server.url("/a"),))
+            waiter.start()
+            waiter.join(0.2)
+            self.assertTrue(waiter.is_alive())
+            first.read()
+            first.close()
+            waiter.join(5)
+            self.assertFalse(waiter.is_alive())
+
+    def test_follows_redirects(self):
+        pool = ConnectionPool()
+        with StandInServer({"/b": "bbb"}) as server:
+            server.redirects["/a"] = "/b"
+            response = pool.urlopen(server.url("/a"))
+            self.assertEqual(response.read(), "bbb")
+            self.assertEqual(response.geturl(), server.url("/b"))
+            response.close()
+        self.assertEqual(pool.opened, 1)
+
+    def test_errors(self):
+        pool = ConnectionPool()
+        with StandInServer() as server:
+            with self.assertRaises(HTTPError) as e:
+                pool.urlopen(server.url("/missing"))
+            self.assertEqual(e.exception.code, 404)
+            url = server.url("/")
+        with self.assertRaises(URLError):
+            pool.urlopen(url)
+
+    def test_leaves_proxied_urls_to_urllib2(self):
+        pool = ConnectionPool()
+        os.environ["http_proxy"] = "http://proxy.example.com:3128"
+        self.addCleanup(os.environ.pop, "http_proxy")
+        self.assertFalse(pool.can_open("http://example.com/"))
+        self.assertTrue(pool.can_open("https://example.com/"))
+
+
+class TestPooledDownloads(TestCase):
+    def test_directives_share_connections(self):
+        tmpdir = mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        context = BuildContext(os.path.join(tmpdir, "cache"))
+        files = dict(("/{}".format(i), str(i) * 100) for i in range(5))
+        with StandInServer(files) as server:
+            for path in files:
+                handler = HttpFileHandler(server.url(path))
+                handler.context = context
+                self.assertTrue(handler.get(os.path.join(tmpdir, path[1:])))
+        self.assertEqual(context.http_pool.opened, 1)
+        self.assertEqual(context.http_pool.reused, 4)
+        with open(os.path.join(tmpdir, "3")) as f:
+            self.assertEqual(f.read(), "3" * 100)
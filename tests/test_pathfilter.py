@@ -0,0 +1,63 @@
+import os
+import shutil
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from codetree.pathfilter import FilterError, PathFilter, split_patterns
+
+
+class TestPathFilter(TestCase):
+    def test_from_options(self):
+        self.assertIsNone(PathFilter.from_options({"mode": "export"}))
+        paths = PathFilter.from_options({"path": "conf/", "include": "*.cfg:/templates/",
+                                         "exclude": "old"})
+        self.assertEqual(paths.spec(), {"path": "conf", "include": ["*.cfg", "templates"],
+                                        "exclude": ["old"]})
+        self.assertTrue(paths.filtering)
+        self.assertFalse(PathFilter("conf").filtering)
+        self.assertEqual(split_patterns(""), [])
+
+    def test_rejects_paths_outside_source(self):
+        for path in ("/etc", "../other", "conf/../.."):
+            with self.assertRaises(FilterError):
+                PathFilter(path)
+
+    def test_selects(self):
+        paths = PathFilter(include=["*.cfg", "templates", "bin/run*"], exclude=["old"])
+        self.assertTrue(paths.selects("a.cfg"))
+        self.assertTrue(paths.selects("deep/down/a.cfg"))
+        self.assertTrue(paths.selects("templates/page/index.html"))
+        self.assertTrue(paths.selects("bin/run-tests"))
+        self.assertFalse(paths.selects("lib/run-tests"))
+        self.assertFalse(paths.selects("a.py"))
+        self.assertFalse(paths.selects("old/a.cfg"))
+        self.assertTrue(PathFilter(exclude=["*.pyc"]).selects("a.py"))
+
+    def test_may_contain(self):
+        paths = PathFilter(include=["conf/*.cfg"], exclude=["conf/old"])
+        self.assertTrue(paths.may_contain("conf"))
+        self.assertFalse(paths.may_contain("conf/old"))
+        self.assertFalse(paths.may_contain("src"))
+        # A name can match at any depth
+        self.assertTrue(PathFilter(include=["*.cfg"]).may_contain("src"))
+
+    def test_member(self):
+        paths = PathFilter("conf", exclude=["*.pyc"])
+        self.assertEqual(paths.member("conf/a.cfg"), "a.cfg")
+        self.assertEqual(paths.member("conf/sub", directory=True), "sub")
+        self.assertIsNone(paths.member("conf/a.pyc"))
+        self.assertIsNone(paths.member("conf"))
+        self.assertIsNone(paths.member("config/a.cfg"))
+
+    def test_walk(self):
+        tmpdir = mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        for name in ("conf/a.cfg", "conf/b.txt", "src/x.py", "src/deep/c.cfg"):
+            path = os.path.join(tmpdir, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, "w").close()
+        self.assertEqual(sorted(PathFilter(include=["conf"]).walk(tmpdir)),
+                         ["conf/a.cfg", "conf/b.txt"])
+        self.assertEqual(sorted(PathFilter(include=["*.cfg"]).walk(tmpdir)),
+                         ["conf/a.cfg", "src/deep/c.cfg"])
@@ -0,0 +1,167 @@
+import thread
+import threading
+import time
+from unittest import TestCase
+
+from codetree.scheduler import (
+    is_path_prefix,
+    dependency_graph,
+    Scheduler,
+)
+
+
+class FakeDirective(object):
+    def __init__(self, location, result=True, delay=0, log=None, error=None):
+        self.location = location
+        self.result = result
+        self.delay = delay
+        self.log = log if log is not None else []
+        self.error = error
+
+    def run(self):
+        self.log.append(("start", self.location))
+        time.sleep(self.delay)
+        self.log.append(("end", self.location))
+        if self.error:
+            raise self.error
+        return self.result
+
+    def __repr__(self):
+        return "FakeDirective({})".format(self.location)
+
+
+class TestDependencies(TestCase):
+    def test_is_path_prefix(self):
+        self.assertTrue(is_path_prefix("app", "app/plugins/woohoo"))
+        self.assertTrue(is_path_prefix("app/", "app"))
+        self.assertTrue(is_path_prefix(".", "app"))
+        self.assertFalse(is_path_prefix("app", "application"))
+        self.assertFalse(is_path_prefix("app/plugins", "app"))
+
+    def test_dependency_graph(self):
+        app = FakeDirective("app")
+        plugin = FakeDirective("app/plugins/woohoo")
+        other = FakeDirective("other")
+        graph = dependency_graph([app, other, plugin])
+        self.assertEqual(graph[app], set())
+        self.assertEqual(graph[other], set())
+        self.assertEqual(graph[plugin], set([app]))
+
+
+class TestScheduler(TestCase):
+    def test_serial_fatality(self):
+        log = []
+        directives = [FakeDirective("a", result=False, log=log),
+                      FakeDirective("b", log=log)]
+        self.assertFalse(Scheduler(directives, fatality=True).run())
+        self.assertEqual(log, [("start", "a"), ("end", "a")])
+        self.assertFalse(Scheduler(directives).run())
+
+    def test_parallel_respects_prefixes(self):
+        log = []
+        directives = [FakeDirective("app", delay=0.05, log=log),
+                      FakeDirective("other", delay=0.05, log=log),
+                      FakeDirective("app/plugins", log=log)]
+        self.assertTrue(Scheduler(directives, jobs=4).run())
+        self.assertLess(log.index(("end", "app")),
+                        log.index(("start", "app/plugins")))
+        # Independent directives overlap
+        self.assertLess(log.index(("start", "other")), log.index(("end", "app")))
+
+    def test_parallel_is_bounded(self):
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        class Counting(FakeDirective):
+            def run(self):
+                with lock:
+                    running.append(self)
+                    peak.append(len(running))
+                time.sleep(0.02)
+                with lock:
+                    running.remove(self)
+                return True
+
+        directives = [Counting("d{}".format(i)) for i in range(8)]
+        self.assertTrue(Scheduler(directives, jobs=3).run())
+        self.assertEqual(max(peak), 3)
+
+    def test_parallel_fatality_cancels_pending(self):
+        log = []
+        directives = [FakeDirective("a", result=False, delay=0.02, log=log),
+                      FakeDirective("a/b", log=log),
+                      FakeDirective("c", delay=0.05, log=log),
+                      FakeDirective("c/d", log=log)]
+        self.assertFalse(Scheduler(directives, jobs=2, fatality=True).run())
+        self.assertNotIn(("start", "a/b"), log)
+        self.assertNotIn(("start", "c/d"), log)
+        # Work that was already running is allowed to finish
+        self.assertIn(("end", "c"), log)
+
+    def test_parallel_without_fatality_continues(self):
+        log = []
+        directives = [FakeDirective("a", result=False, log=log),
+                      FakeDirective("a/b", log=log)]
+        self.assertFalse(Scheduler(directives, jobs=2).run())
+        self.assertIn(("end", "a/b"), log)
+
+    def test_parallel_reraises(self):
+        directives = [FakeDirective("a", error=ValueError("boom")),
+                      FakeDirective("a/b")]
+        with self.assertRaises(ValueError):
+            Scheduler(directives, jobs=2).run()
+
+    def test_interrupted(self):
+        stopped = threading.Event()
+
+        class Running(FakeDirective):
+            def run(self):
+                if self.location == "a":
+                    thread.interrupt_main()
+                # Until interrupted() stops it
+                return stopped.wait(30)
+
+        directives = [Running("a"), Running("b")]
+        start = time.time()
+        with self.assertRaises(KeyboardInterrupt):
+            Scheduler(directives, jobs=2, interrupted=stopped.set).run()
+        self.assertLess(time.time() - start, 5)
+        self.assertTrue(stopped.is_set())
+
+    def test_lanes(self):
+        running = {"main": [], "http": []}
+        peak = {"main": [], "http": []}
+        lock = threading.Lock()
+
+        class Counting(FakeDirective):
+            def __init__(self, location, lane, **kwargs):
+                super(Counting, self).__init__(location, **kwargs)
+                self.lane = lane
+
+            def run(self):
+                with lock:
+                    running[self.lane or "main"].append(self)
+                    peak[self.lane or "main"].append(len(running[self.lane or "main"]))
+                result = super(Counting, self).run()
+                with lock:
+                    running[self.lane or "main"].remove(self)
+                return result
+
+        log = []
+        directives = ([Counting("d{}".format(i), None, delay=0.02, log=log)
+                       for i in range(3)] +
+                      [Counting("h{}".format(i), "http", delay=0.02, log=log)
+                       for i in range(8)] +
+                      [Counting("d0/h", "http", log=log)])
+        scheduler = Scheduler(directives, jobs=1, lanes={"http": 3},
+                              lane=lambda d: d.lane)
+        self.assertTrue(scheduler.run())
+        self.assertEqual(max(peak["main"]), 1)
+        self.assertEqual(max(peak["http"]), 3)
+        # Lanes still honor the prefixes of other lanes
+        self.assertLess(log.index(("end", "d0")), log.index(("start", "d0/h")))
+        # Directives in the main pool keep their order
+        main = [entry for entry in log if entry[1].startswith("d") and "/" not in entry[1]]
+        self.assertEqual([location for event, location in main if event == "start"],
+                         ["d0", "d1", "d2"])
@@ -0,0 +1,222 @@
+import os
+import hashlib
+import time
+import shutil
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from mock import patch
+try:
+    from cStringIO import StringIO
+except:
+    from StringIO import StringIO
+
+from codetree import fileutils
+from codetree.checksum import HashCache
+from codetree.config import BuildContext
+from codetree.handlers import HttpFileHandler, LocalHandler
+from codetree.store import ContentStore, Deduplicator
+
+from .httpserver import StandInServer
+
+
+class TestContentStore(TestCase):
+    def setUp(self):
+        super(TestContentStore, self).setUp()
+        self.tmpdir = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.store = ContentStore(os.path.join(self.tmpdir, "store"))
+
+    def test_add_and_materialize(self):
+        digest, size = self.store.add_stream(StringIO("words words"), bufsize=4)
+        self.assertEqual(size, 11)
+        self.assertEqual(digest, hashlib.sha256("words words").hexdigest())
+        dest = os.path.join(self.tmpdir, "dest")
+        self.assertEqual(self.store.materialize(digest, dest), "hardlink")
+        self.assertTrue(os.path.samefile(dest, self.store.blob_path(digest)))
+        with open(dest) as f:
+            self.assertEqual(f.read(), "words words")
+
+    def test_lookup(self):
+        digest = self.store.add_stream(StringIO("words"))[0]
+        self.assertIsNone(self.store.lookup("http://example.com/a"))
+        self.store.record("http://example.com/a", digest, {"ETag": '"x"'})
+        entry = self.store.lookup("http://example.com/a")
+        self.assertEqual(entry["digest"], digest)
+        self.assertEqual(entry["etag"], '"x"')
+
+        # Entries for evicted blobs are ignored
+        os.unlink(self.store.blob_path(digest))
+        self.assertIsNone(self.store.lookup("http://example.com/a"))
+        self.assertIsNone(self.store.materialize(digest, os.path.join(self.tmpdir, "d")))
+
+    def test_lru_eviction(self):
+        digests = []
+        for i, body in enumerate(("a" * 10, "b" * 10, "c" * 10)):
+            digests.append(self.store.add_stream(StringIO(body))[0])
+            stamp = os.path.join(self.store.path, "access", digests[-1])
+            os.utime(stamp, (time.time() - 100 + i, time.time() - 100 + i))
+        # Using the oldest blob makes it the most recently used
+        self.store.materialize(digests[0], os.path.join(self.tmpdir, "dest"))
+
+        self.store.max_size = 20
+        self.store.evict()
+        remaining = [d for d in digests if os.path.exists(self.store.blob_path(d))]
+        self.assertEqual(remaining, [digests[0], digests[2]])
+
+
+class TestDeduplicator(TestCase):
+    def setUp(self):
+        super(TestDeduplicator, self).setUp()
+        self.tmpdir = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.context = BuildContext(cache_dir=os.path.join(self.tmpdir, "cache"))
+        self.sources = os.path.join(self.tmpdir, "sources")
+        for name, content in (("one/lib.js", "shared"), ("one/run", "script"),
+                              ("two/lib.js", "shared"), ("two/other.js", "other")):
+            path = os.path.join(self.sources, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "w") as f:
+                f.write(content)
+        os.chmod(os.path.join(self.sources, "one/run"), 0o755)
+
+    def get(self, name):
+        handler = LocalHandler(os.path.join(self.sources, name))
+        handler.context = self.context
+        dest = os.path.join(self.tmpdir, "tree", name)
+        self.assertTrue(handler.get(dest, {"method": "dedupe"}))
+        return dest
+
+    def test_identical_files_are_shared(self):
+        one, two = self.get("one"), self.get("two")
+        self.assertTrue(os.path.samefile(os.path.join(one, "lib.js"),
+                                         os.path.join(two, "lib.js")))
+        self.assertFalse(os.path.samefile(os.path.join(two, "lib.js"),
+                                          os.path.join(two, "other.js")))
+        with open(os.path.join(two, "other.js")) as f:
+            self.assertEqual(f.read(), "other")
+        self.assertEqual(self.context.dedupe.files, 4)
+        self.assertEqual(self.context.dedupe.bytes, 23)
+        # The second lib.js is all that was saved
+        self.assertEqual(self.context.dedupe.written, 17)
+
+    def test_modes(self):
+        one = self.get("one")
+        self.assertEqual(os.stat(os.path.join(one, "run")).st_mode & 0o777, 0o555)
+        self.assertEqual(os.stat(os.path.join(one, "lib.js")).st_mode & 0o777, 0o444)
+
+    def test_new_files_are_hashed_as_they_are_stored(self):
+        with patch("codetree.checksum.file_digest") as file_digest:
+            one = self.get("one")
+        self.assertFalse(file_digest.called)
+        lib = os.path.join(self.sources, "one/lib.js")
+        self.assertEqual(self.context.hash_cache.cached(lib, "sha256"),
+                         hashlib.sha256("shared").hexdigest())
+        self.assertTrue(os.path.samefile(os.path.join(one, "lib.js"),
+                                         self.context.dedupe.store.blob_path(
+                                             hashlib.sha256("shared").hexdigest())))
+
+    def test_unchanged_files_are_not_hashed_again(self):
+        self.get("one")
+        self.context.dedupe.reset()
+        with patch("codetree.checksum.file_digest") as file_digest:
+            self.get("one")
+        self.assertFalse(file_digest.called)
+        self.assertEqual(self.context.dedupe.written, 0)
+
+    def test_across_filesystems(self):
+        materialize = fileutils.materialize
+        copy = lambda source, dest, methods=None: materialize(source, dest, ("copy",))
+        with patch("codetree.store.fileutils.materialize", side_effect=copy), \
+                patch("codetree.store.fileutils.same_filesystem", return_value=False):
+            one = self.get("one")
+            self.assertEqual(self.context.dedupe.copies, 2)
+            self.context.dedupe.reset()
+            with patch("codetree.store.fileutils.materialize") as materialized:
+                self.get("one")
+        # Copies with the stored content are left alone
+        self.assertFalse(materialized.called)
+        self.assertEqual(self.context.dedupe.written, 0)
+        self.assertEqual(self.context.dedupe.copies, 0)
+        self.assertEqual(os.stat(os.path.join(one, "run")).st_mode & 0o777, 0o555)
+
+    def test_own_store_without_store_option(self):
+        dedupe = Deduplicator(os.path.join(self.tmpdir, "dedupe"),
+                              HashCache(os.path.join(self.tmpdir, "checksums.json")))
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, "dedupe")))
+        self.assertEqual(dedupe.store.path, os.path.join(self.tmpdir, "dedupe"))
+
+
+class TestStoredDownloads(TestCase):
+    def setUp(self):
+        super(TestStoredDownloads, self).setUp()
+        self.tmpdir = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.cache_dir = os.path.join(self.tmpdir, "cache")
+
+    def fetch(self, url, tree, options=None, **store_options):
+        handler = HttpFileHandler(url)
+        handler.context = BuildContext(self.cache_dir, store=True, **store_options)
+        dest = os.path.join(self.tmpdir, tree)
+        result = handler.get(dest, options)
+        handler.context.close()
+        return result, dest
+
+    def test_shared_between_trees(self):
+        with StandInServer({"/foo.txt": "words words"}) as server:
+            url = server.url("/foo.txt")
+            result, first = self.fetch(url, "first")
+            self.assertTrue(result)
+            result, second = self.fetch(url, "second")
+            self.assertTrue(result)
+            # Revalidated, not downloaded again
+            self.assertEqual(len(server.requests), 2)
+            self.assertIn("if-none-match", server.requests[1][1])
+            self.assertTrue(os.path.samefile(first, second))
+
+            # Fresh entries are used without a request
+            result, third = self.fetch(url, "third", store_max_age=60)
+            self.assertTrue(result)
+            self.assertEqual(len(server.requests), 2)
+            with open(third) as f:
+                self.assertEqual(f.read(), "words words")
+
+    def test_changed_upstream(self):
+        with StandInServer({"/foo.txt": "words words"}) as server:
+            url = server.url("/foo.txt")
+            self.fetch(url, "first")
+            server.files["/foo.txt"] = "new words"
+            result, second = self.fetch(url, "second")
+            with open(second) as f:
+                self.assertEqual(f.read(), "new words")
+
+    def test_evicted_before_materialized(self):
+        with StandInServer({"/foo.txt": "words words"}) as server:
+            with patch.object(ContentStore, "materialize", return_value=None):
+                result, dest = self.fetch(server.url("/foo.txt"), "first")
+            self.assertTrue(result)
+            with open(dest) as f:
+                self.assertEqual(f.read(), "words words")
+
+    def test_stored_copy_must_match_every_pin(self):
+        pins = {"sha256": hashlib.sha256("words words").hexdigest(),
+                "sha512": hashlib.sha512("other words").hexdigest()}
+        with StandInServer({"/foo.txt": "words words"}) as server:
+            url = server.url("/foo.txt")
+            self.fetch(url, "first")
+            dest = os.path.join(self.tmpdir, "second")
+            with open(dest, "w") as f:
+                f.write("mine")
+            result, dest = self.fetch(url, "second", dict(pins, overwrite="true"))
+            self.assertFalse(result)
+            with open(dest) as f:
+                self.assertEqual(f.read(), "mine")
+
+            pins["sha512"] = hashlib.sha512("words words").hexdigest()
+            requests = len(server.requests)
+            result, dest = self.fetch(url, "second", dict(pins, overwrite="true"))
+            self.assertTrue(result)
+            self.assertEqual(len(server.requests), requests)
+            with open(dest) as f:
+                self.assertEqual(f.read(), "words words")
@@ -0,0 +1,83 @@
+import os
+import time
+import threading
+
+from mock import patch
+
+from codetree import watch
+from codetree.watch import PollingMonitor, Watcher
+
+from .test_config import ConfigTestCase, write
+
+
+class TestPollingMonitor(ConfigTestCase):
+    def test_notices_changes(self):
+        source = os.path.join(self.sources, "content")
+        os.mkdir(source)
+        other = os.path.join(self.sources, "other")
+        monitor = PollingMonitor([source, other], interval=0.05)
+        self.assertEqual(monitor.wait(0), set())
+        write(os.path.join(source, "a"))
+        self.assertEqual(monitor.wait(1), set([source]))
+        write(other)
+        self.assertEqual(monitor.wait(1), set([other]))
+        self.assertEqual(monitor.wait(0.1), set())
+
+
+@patch.object(watch, "pyinotify", None)
+class TestWatcher(ConfigTestCase):
+    def setUp(self):
+        super(TestWatcher, self).setUp()
+        self.source = os.path.join(self.sources, "content")
+        os.mkdir(self.source)
+        write(os.path.join(self.source, "a"), "a")
+        self.cfgfile = os.path.join(self.tmpdir, "codetree.cfg")
+        self.write_config("content  {}".format(self.source), "app  @")
+
+    def write_config(self, *lines):
+        write(self.cfgfile, "\n".join(lines) + "\n")
+
+    def start(self, **kwargs):
+        watcher = Watcher([self.cfgfile], {"cache_dir": self.cache_dir}, **kwargs)
+        watcher.settle = 0.1
+        thread = threading.Thread(target=watcher.run)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(watcher.stop)
+        return watcher
+
+    def wait_for(self, condition, timeout=10):
+        deadline = time.time() + timeout
+        while not condition():
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.05)
+
+    def read(self, path):
+        try:
+            with open(path) as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def test_rebuilds_changes(self):
+        watcher = self.start(poll_interval=3600)
+        self.wait_for(lambda: self.read("content/a") == "a")
+        context = watcher.context
+
+        with patch.object(watcher.config, "build", wraps=watcher.config.build) as _build:
+            write(os.path.join(self.source, "a"), "changed")
+            self.wait_for(lambda: self.read("content/a") == "changed")
+            self.wait_for(lambda: _build.called)
+            self.assertEqual([d.location for d in _build.call_args[1]["only"]], ["content"])
+
+        self.write_config("content  {}".format(self.source), "app  @", "more  @")
+        self.wait_for(lambda: os.path.isdir("more"))
+        # The caches outlive the config
+        self.assertIs(watcher.context, context)
+
+    def test_polls_other_sources(self):
+        watcher = self.start(poll_interval=0.2)
+        self.wait_for(lambda: os.path.isdir("app"))
+        os.rmdir("app")
+        self.wait_for(lambda: os.path.isdir("app"))
+        self.assertEqual([d.location for d in watcher.polled()], ["app"])